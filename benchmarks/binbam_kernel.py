@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+"""
+throughput of the vectorized binbam counting kernel compared to the original
+per-alignment loop on a synthetic sorted bam file; also checks that both give
+the same counts.  The conversion of alignments to arrays, which takes most of
+the time of the kernel, is timed separately against the per-read tuples it
+replaced
+
+usage: binbam_kernel.py [n_reads] [binsize]
+"""
+
+import sys
+import os
+import time
+import random
+import shutil
+import logging
+import itertools
+import tempfile
+import numpy
+import pysam
+
+from gosr.common import bam as bamsplit
+from gosr.tools import binbam
+
+def count_loop(bamfile, references, bins, binsize, fragsize, n_redundancy,
+        by_strand): # the original per-alignment loop
+    n_aln   = 0
+    n_rmred = 0
+    n_igno  = 0
+    shift   = fragsize / 2
+    for _, alns in itertools.groupby(bamfile, lambda x: (x.tid, x.pos)):
+        all_alns = [x for x in alns if not x.is_unmapped]
+        n_aln   += len(all_alns)
+        plus     = [x for x in all_alns if not x.is_reverse][0:n_redundancy]
+        minus    = [x for x in all_alns if x.is_reverse][0:n_redundancy]
+        for aln in itertools.chain(plus, minus):
+            chrom = bamfile.getrname(aln.tid)
+            if chrom == "chrM":
+                n_igno += 1
+                continue
+            n_rmred += 1
+            if aln.alen != aln.rlen:
+                n_igno += 1
+                continue
+            if not aln.is_reverse:
+                bin_nr = (aln.pos + shift) // binsize
+            else:
+                bin_nr = (aln.aend - 1 - shift) // binsize
+            n_aln += 1
+            try:
+                if not by_strand:
+                    bins[chrom][bin_nr] += 1
+                elif not aln.is_reverse:
+                    bins[chrom][0][bin_nr] += 1
+                else:
+                    bins[chrom][1][bin_nr] += 1
+            except IndexError:
+                pass
+    return n_aln, n_rmred, n_igno
+
+def tuple_rows(alns, blocksize): # per-read tuples converted by numpy.array
+    alns = iter(alns)
+    while True:
+        rows = [(a.tid, a.pos, a.flag, a.alen or 0, a.rlen)
+                for a in itertools.islice(alns, blocksize)]
+        if not rows:
+            return
+        yield numpy.array(rows, dtype = numpy.int64)
+
+def make_bam(filename, n):
+    """n random 36nt reads with pile ups, unmapped and gapped reads"""
+    chroms = [("chr1", 20000000), ("chr2", 15000000), ("chrM", 16299)]
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": c, "LN": l} for c, l in chroms]}
+    recs = []
+    for _ in xrange(n):
+        tid = random.choice([0, 0, 1, 2])
+        pos = random.randint(0, chroms[tid][1] - 40)
+        if random.random() < 0.3:
+            pos = pos // 5000 * 5000
+        recs.append((tid, pos))
+    recs.sort()
+    out = pysam.Samfile(filename, "wb", header = header)
+    for i, (tid, pos) in enumerate(recs):
+        a = pysam.AlignedSegment()
+        a.query_name      = "r%d" % i
+        a.query_sequence  = "A" * 36
+        a.flag            = random.choice([0, 16, 0, 16, 4])
+        a.reference_id    = tid
+        a.reference_start = pos
+        a.mapping_quality = 30
+        a.cigarstring     = random.random() < 0.03 and "20M2D16M" or "36M"
+        out.write(a)
+    out.close()
+
+def list_bins(chrominfo, binsize): # plain lists for the per-alignment loop
+    return dict((c, [[0] * (l // binsize), [0] * (l // binsize)])
+            for c, l in chrominfo.items())
+
+def timeit(counter, make_bins, filename, binsize):
+    bam  = pysam.Samfile(filename, "rb")
+    bins = make_bins(dict(zip(bam.references, bam.lengths)), binsize)
+    start  = time.time()
+    counts = counter(bam, bam.references, bins, binsize, 200, 3, True)
+    return counts, bins, time.time() - start
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO)
+    n       = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+    binsize = len(sys.argv) > 2 and int(sys.argv[2]) or 100
+    tmpdir  = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "reads.bam")
+        make_bam(filename, n)
+        results = []
+        for name, counter, make_bins in (("per-read loop", count_loop, list_bins),
+                ("vectorized", binbam.count_alignments,
+                    lambda c, b: binbam.make_bins(c, b, True))):
+            counts, bins, elapsed = timeit(counter, make_bins, filename, binsize)
+            results.append((counts, bins))
+            print "%-14s %9d reads %7.2fs %10.0f reads/s" % (name, n, elapsed,
+                    n / elapsed)
+        (c1, b1), (c2, b2) = results
+        same = c1 == c2 and all(b1[c][s] == b2[c][s].dense().tolist()
+                for c in b1 for s in (0, 1))
+        print "identical counts:", same
+        for name, extract in (("per-read rows", tuple_rows),
+                ("flat blocks", bamsplit.alignment_arrays)):
+            bam     = pysam.Samfile(filename, "rb")
+            start   = time.time()
+            n_rows  = sum(len(b) for b in extract(bam, binbam.BLOCKSIZE))
+            elapsed = time.time() - start
+            bam.close()
+            print "%-14s %9d reads %7.2fs %10.0f reads/s (conversion only)" % (
+                    name, n_rows, elapsed, n_rows / elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
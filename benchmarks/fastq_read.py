@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+"""
+throughput of gosr.common.fastq.read compared to the original line based
+generator on synthetic 4-line fastq, fasta and multi-line fastq files; also
+checks that both give the same records
+
+usage: fastq_read.py [n_reads] [read_length]
+"""
+
+import sys
+import os
+import time
+import random
+import tempfile
+
+from gosr.common import fastq
+
+def read_lines(fp): # the original line based generator
+    last = None
+    while True:
+        if not last:
+            for l in fp:
+                if l[0] in '>@':
+                    last = l[:-1]
+                    break
+        if not last: break
+        name, seqs, last = last[1:].split()[0], [], None
+        for l in fp:
+            if l[0] in '@+>':
+                last = l[:-1]
+                break
+            seqs.append(l[:-1])
+        if not last or last[0] != '+':
+            yield name, ''.join(seqs), None
+            if not last: break
+        else:
+            seq, leng, seqs = ''.join(seqs), 0, []
+            seqlen = len(seq)
+            for l in fp:
+                seqs.append(l[:-1])
+                leng += len(l) - 1
+                if leng >= seqlen:
+                    last = None
+                    yield name, seq, ''.join(seqs);
+                    break
+            if last:
+                yield name, seq, None
+                break
+
+def wrap(s, width):
+    return "\n".join(s[i:i + width] for i in xrange(0, len(s), width))
+
+def make_fastq(filename, n, length, kind = "fastq"):
+    """write n random reads of the given length as 4-line fastq, fasta or
+    fastq with sequence and quality wrapped at 60 characters (multi-line)"""
+    seq  = "".join(random.choice("ACGT") for _ in range(length * 10))
+    qual = "".join(chr(random.randint(35, 73)) for _ in range(length * 10))
+    with open(filename, "w") as fh:
+        for i in xrange(n):
+            o = random.randint(0, length * 9)
+            s, q = seq[o:o + length], qual[o:o + length]
+            if kind == "fasta":
+                fh.write(">read%d/1 length=%d\n%s\n" % (i, length, wrap(s, 60)))
+            elif kind == "multi-line":
+                fh.write("@read%d/1 length=%d\n%s\n+\n%s\n" % (i, length,
+                    wrap(s, 60), wrap(q, 60)))
+            else:
+                fh.write("@read%d/1 length=%d\n%s\n+\n%s\n" % (i, length, s, q))
+
+def timeit(reader, filename):
+    start = time.time()
+    with open(filename) as fh:
+        records = list(reader(fh))
+    return records, time.time() - start
+
+if __name__ == "__main__":
+    n      = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+    length = len(sys.argv) > 2 and int(sys.argv[2]) or 100
+    fd, filename = tempfile.mkstemp(suffix = ".fq")
+    os.close(fd)
+    try:
+        for kind in ("fastq", "fasta", "multi-line"):
+            make_fastq(filename, n, length, kind)
+            mb      = os.path.getsize(filename) / 1e6
+            results = []
+            for name, reader in (("line based", read_lines), ("block based", fastq.read)):
+                records, elapsed = timeit(reader, filename)
+                results.append(records)
+                print "%-10s %-12s %9d reads %7.2fs %10.0f reads/s %7.1f MB/s" % (
+                        kind, name, len(records), elapsed, len(records) / elapsed,
+                        mb / elapsed)
+            print "%-10s identical records: %s" % (kind, results[0] == results[1])
+    finally:
+        os.unlink(filename)
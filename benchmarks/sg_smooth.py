@@ -0,0 +1,31 @@
+#! /usr/bin/env python
+"""
+time and largest deviation of blocked (and FFT) Savitzky-Golay smoothing
+compared to savitzky_golay_filter on a whole chromosome of random counts
+
+usage: sg_smooth.py [n_bins] [window_size,...]
+"""
+
+import sys
+import time
+import numpy
+
+from gosr.common import dsp
+
+def timed(func, *args, **kwargs):
+    start  = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+if __name__ == "__main__":
+    n       = len(sys.argv) > 1 and int(sys.argv[1]) or 10000000
+    windows = len(sys.argv) > 2 and map(int, sys.argv[2].split(",")) or [5, 21, 151, 501]
+    y       = numpy.random.poisson(2, n).astype(numpy.float64)
+    for w in windows:
+        ref, t_ref = timed(dsp.savitzky_golay_filter, y, w, 2)
+        res, t_blk = timed(dsp.savitzky_golay_blocks, y, w, 2)
+        out = numpy.empty(n, dtype = numpy.float32)
+        _, t_f32   = timed(dsp.savitzky_golay_blocks, y, w, 2, out = out)
+        print "window %4d: whole array %6.2fs  blocks %6.2fs  blocks->float32 %6.2fs" \
+                "  max deviation %.2g / %.2g" % (w, t_ref, t_blk, t_f32,
+                numpy.abs(res - ref).max(), numpy.abs(out - ref).max())
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+"""
+throughput of the block based tssd density compared to a per-read loop over
+the same TSS index on a bam file with random TSSs; also checks that both
+give the same counts
+
+usage: tssd_density.py bamfile [n_tss]
+"""
+
+import sys
+import time
+import random
+import logging
+import numpy
+import pysam
+
+from gosr.common.intervals import TssIndex
+from gosr.tools import tssd
+
+def density_loop(tsspos, bamfile, up, down): # per read lookups
+    d    = {"left": numpy.zeros(up + down + 1, dtype = "i"),
+            "right": numpy.zeros(up + down + 1, dtype = "i")}
+    locd = {'+': {'+': "left", "-": "right"}, '-': {"+": "right", "-": "left"}}
+    n_reads = 0
+    for aln in bamfile:
+        if aln.is_unmapped:
+            continue
+        n_reads += 1
+        strand   = aln.is_reverse and "-" or "+"
+        five     = aln.aend - 1 if aln.is_reverse else aln.pos
+        tss      = tsspos.find(bamfile.getrname(aln.tid), five)
+        if tss is not None:
+            start, end, tss_strand, _ = tss
+            anchor = start if tss_strand == "+" else end - 1
+            d[locd[tss_strand][strand]][abs(five - anchor)] += 1
+    return d, n_reads
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.WARN)
+    filename = sys.argv[1]
+    n_tss    = len(sys.argv) > 2 and int(sys.argv[2]) or 20000
+    up, down = 2200, 2200
+    bam      = pysam.Samfile(filename, "rb")
+    tsss     = []
+    for _ in xrange(n_tss):
+        chrom = random.choice(bam.references)
+        tsss.append((chrom, random.randint(0, bam.lengths[bam.references.index(chrom)]),
+            random.choice("+-")))
+    bam.close()
+    tsspos  = TssIndex.build(tsss, up, down)
+    results = []
+    for name, func in (("per-read loop", density_loop), ("blocks", tssd.make_density)):
+        bam     = pysam.Samfile(filename, "rb")
+        start   = time.time()
+        d, n    = func(tsspos, bam, up, down)
+        elapsed = time.time() - start
+        bam.close()
+        results.append((d, n))
+        print "%-14s %9d reads %7.2fs %10.0f reads/s" % (name, n, elapsed,
+                n / elapsed)
+    (d1, n1), (d2, n2) = results
+    print "identical counts:", n1 == n2 and all((d1[k] == d2[k]).all()
+            for k in ("left", "right"))
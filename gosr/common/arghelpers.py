@@ -28,3 +28,43 @@ def check_or_make_dir(s):
             return s
         except OSError, e:
             raise argparse.ArgumentTypeError("Could not create directory: %s" % e)
+
+def physical_memory():
+    """size of the physical memory in bytes; None if it is not known"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def memory_size(s):
+    """size in bytes of a memory size given as for unix sort: a number
+    followed by b, K, M, G or T (K if there is no suffix), or by % for a
+    percentage of the physical memory; raises ArgumentTypeError for anything
+    else"""
+    units = {"b": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if s[-1:].isdigit():
+        s += "K"
+    if s[-1:] == "%":
+        units["%"] = (physical_memory() or 0) / 100.0
+        if not units["%"]:
+            raise argparse.ArgumentTypeError("Size of physical memory unknown: %s" % s)
+    try:
+        return int(float(s[:-1]) * units[s[-1]])
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError("Invalid memory size: %s" % s)
+
+def add_output_options(cmdline):
+    """add options for the output file and its compression to a subcommand
+    parser; see file.output_file"""
+    group = cmdline.add_argument_group("output")
+    group.add_argument("-o", "--output", default = "-",
+            help = "Output file; '-' writes to stdout [%(default)s]")
+    group.add_argument("-z", "--compress", default = "auto",
+            choices = ["auto", "none", "gzip", "bgzf"],
+            help = """Output compression; 'auto' gzip compresses output files
+            ending in .gz [%(default)s]""")
+    group.add_argument("--level", type = int, default = 6,
+            choices = range(10), metavar = "0-9",
+            help = "Compression level [%(default)s]")
+    group.add_argument("--compress-threads", type = int, default = 1,
+            help = "Threads used for bgzf compression [%(default)s]")
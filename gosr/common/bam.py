@@ -0,0 +1,134 @@
+"""
+splitting of unindexed bam files into ranges of bgzf blocks, and conversion
+of alignments to arrays
+
+A bam file is cut at bgzf block boundaries near evenly spaced file offsets.
+The alignment records of a range are the records that start in its blocks;
+as records do not respect block boundaries, the first record starting in a
+range is found by decompressing its first blocks and checking candidate
+positions until a chain of consecutive valid records is found.  Positions
+are bgzf virtual offsets (compressed block offset << 16 | offset in the
+uncompressed block) as used by pysam's tell and seek.
+"""
+
+import os
+import zlib
+import struct
+import itertools
+import numpy
+
+from gosr.common.file import _next_bgzf_block
+
+CHAIN = 4 # consecutive records that have to be valid at a resync point
+
+_core       = struct.Struct("<iiiBBHHHiiii")
+_NAME_CHARS = "".join(chr(c) for c in xrange(33, 127) if chr(c) != "@")
+
+def bgzf_blocks(fh, offset): # this is a generator function
+    """yields (file offset, uncompressed data) of the bgzf blocks starting
+    at file offset"""
+    while True:
+        fh.seek(offset)
+        header = fh.read(18)
+        if len(header) < 18:
+            return
+        bsize = struct.unpack("<H", header[16:18])[0]
+        cdata = fh.read(bsize - 17)
+        yield offset, zlib.decompress(cdata[:-8], -15)
+        offset += bsize + 1
+
+def record_size(buf, i, lengths):
+    """size of the bam record at position i of buf; 0 if there is no
+    plausible record at i, -1 if the record does not end within buf.
+    lengths are the reference lengths"""
+    if i + 36 > len(buf):
+        return -1
+    bsize, ref, pos, l_name, _, _, n_cigar, _, l_seq, next_ref, next_pos, _ = \
+            _core.unpack_from(buf, i)
+    if not (-1 <= ref < len(lengths) and -1 <= next_ref < len(lengths)) or \
+            l_name < 2 or l_seq < 0 or \
+            bsize < 32 + l_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq or \
+            pos < -1 or ref >= 0 and pos > lengths[ref] or \
+            next_pos < -1 or next_ref >= 0 and next_pos > lengths[next_ref]:
+        return 0
+    if i + 4 + bsize > len(buf):
+        return -1
+    if buf[i + 35 + l_name] != "\0" or \
+            buf[i + 36:i + 35 + l_name].translate(None, _NAME_CHARS):
+        return 0
+    return 4 + bsize
+
+def _chain(buf, i, lengths, at_eof):
+    """True if CHAIN consecutive valid records (or at least one valid
+    record followed by the end of the data) start at position i of buf"""
+    for n in xrange(CHAIN):
+        if at_eof and n > 0 and i == len(buf):
+            return True
+        size = record_size(buf, i, lengths)
+        if size <= 0:
+            # a record continuing beyond the loaded data is accepted after
+            # at least one complete record
+            return size < 0 and n > 0 and not at_eof
+        i += size
+    return True
+
+def first_record(filename, offset, lengths):
+    """virtual offset of the first record starting in or after the bgzf
+    block at file offset; None if there is none"""
+    with open(filename, "rb") as fh:
+        blocks = bgzf_blocks(fh, offset)
+        starts = []  # (block offset, position in buf) of the loaded blocks
+        buf    = ""
+        at_eof = False
+        b      = 0
+        while True:
+            # keep enough data after the candidate block for a chain of
+            # records
+            while not at_eof and (len(starts) <= b + 1 or
+                    len(buf) - starts[b][1] < 0x40000):
+                block = next(blocks, None)
+                if block is None:
+                    at_eof = True
+                else:
+                    starts.append((block[0], len(buf)))
+                    buf += block[1]
+            if b >= len(starts):
+                return None
+            first = starts[b][1]
+            last  = b + 1 < len(starts) and starts[b + 1][1] or len(buf)
+            for i in xrange(first, last):
+                if _chain(buf, i, lengths, at_eof):
+                    return starts[b][0] << 16 | (i - first)
+            b += 1
+
+def split(filename, n, first):
+    """split the records of a bam file into about n ranges of bgzf blocks;
+    first is the virtual offset of the first record (after the header).
+    Returns (start block offset, end block offset) pairs; the range of
+    records starting in the first range begins at first, the last range
+    ends at the end of the file (end is None)"""
+    size   = os.path.getsize(filename)
+    bounds = set()
+    with open(filename, "rb") as fh:
+        for i in xrange(1, n):
+            b = _next_bgzf_block(fh, size * i // n)
+            if b > first >> 16 and b < size:
+                bounds.add(b)
+    bounds = [first >> 16] + sorted(bounds)
+    return zip(bounds, bounds[1:] + [None])
+
+def alignment_arrays(alns, blocksize): # this is a generator function
+    """yields blocks of up to blocksize alignments of an iterable of pysam
+    alignments as int64 arrays of rows (reference id, position, flag,
+    aligned length on the reference (0 if unmapped), read length).  The
+    values of a block are collected into one flat list, which numpy.fromiter
+    writes into an array allocated once for the whole block; numpy.array on
+    a list of per-read tuples takes about twice as long to convert"""
+    alns = iter(alns)
+    while True:
+        flat = [v for a in itertools.islice(alns, blocksize) for v in
+                (a.reference_id, a.reference_start, a.flag,
+                    a.reference_length or 0, a.query_length)]
+        if not flat:
+            return
+        yield numpy.fromiter(flat, numpy.int64, len(flat)).reshape(-1, 5)
@@ -0,0 +1,221 @@
+"""
+bigWig writer for fixed span bins
+
+Writes version 4 bigWig files: a chromosome B+ tree, zlib compressed data
+sections of up to ITEMS_PER_SLOT variableStep items, an R-tree index over the
+sections, and zoom levels (summaries over 4, 16, 64, ... bins) with their own
+R-tree indices.  The layout follows the UCSC bbi format.
+"""
+
+import zlib
+import struct
+import numpy
+
+BIGWIG_MAGIC   = 0x888FFC26
+BPT_MAGIC      = 0x78CA8C91
+CIRTREE_MAGIC  = 0x2468ACE0
+BLOCKSIZE      = 256  # items per index node
+ITEMS_PER_SLOT = 1024 # items per data section
+MAX_ZOOMS      = 10
+
+def _tree_levels(n, blocksize):
+    """number of nodes per level (root first) of a tree with n items"""
+    levels = [max(1, -(-n // blocksize))]
+    while levels[0] > 1:
+        levels.insert(0, -(-levels[0] // blocksize))
+    return levels
+
+def write_chrom_tree(fh, chroms):
+    """B+ tree of (name, id, size) sorted by name; ids have to be assigned
+    in name order"""
+    keysize   = max(len(name) for name, _, _ in chroms)
+    blocksize = min(BLOCKSIZE, len(chroms))
+    fh.write(struct.pack("<IIIIQQ", BPT_MAGIC, blocksize, keysize, 8,
+        len(chroms), 0))
+    levels    = _tree_levels(len(chroms), blocksize)
+    nodesize  = 4 + blocksize * (keysize + 8)
+    start     = fh.tell()
+    offsets   = [start + nodesize * sum(levels[:i]) for i in range(len(levels))]
+    for depth, n_nodes in enumerate(levels):
+        # items below one entry of a node at this depth
+        span   = blocksize ** (len(levels) - 1 - depth)
+        isleaf = depth == len(levels) - 1
+        for node in xrange(n_nodes):
+            first = node * blocksize
+            items = range(first, min(first + blocksize, -(-len(chroms) // span)))
+            out   = [struct.pack("<BBH", isleaf, 0, len(items))]
+            for i in items:
+                name, cid, size = chroms[i * span]
+                key = name.ljust(keysize, "\0")
+                if isleaf:
+                    out.append(key + struct.pack("<II", cid, size))
+                else:
+                    out.append(key + struct.pack("<Q", offsets[depth + 1] + i * nodesize))
+            out.append("\0" * ((blocksize - len(items)) * (keysize + 8)))
+            fh.write("".join(out))
+
+def write_rtree(fh, blocks, end_offset):
+    """R-tree index of data blocks given as (chrom_id, start, end, offset,
+    size) in file order"""
+    blocksize = min(BLOCKSIZE, max(len(blocks), 1))
+    first     = blocks[0] if blocks else (0, 0, 0)
+    last      = blocks[-1] if blocks else (0, 0, 0)
+    fh.write(struct.pack("<IIQIIIIQII", CIRTREE_MAGIC, blocksize, len(blocks),
+        first[0], first[1], last[0], last[2], end_offset, ITEMS_PER_SLOT, 0))
+    levels    = _tree_levels(len(blocks), blocksize)
+    start     = fh.tell()
+    # all levels but the last consist of inner nodes
+    nodesizes = [4 + blocksize * 24] * (len(levels) - 1) + [4 + blocksize * 32]
+    offsets   = [start + sum(n * size for n, size in zip(levels[:i], nodesizes))
+            for i in range(len(levels))]
+    for depth, n_nodes in enumerate(levels):
+        span   = blocksize ** (len(levels) - 1 - depth)
+        isleaf = depth == len(levels) - 1
+        for node in xrange(n_nodes):
+            first = node * blocksize
+            items = range(first, min(first + blocksize, -(-len(blocks) // span)))
+            out   = [struct.pack("<BBH", isleaf, 0, len(items))]
+            for i in items:
+                lo = blocks[i * span]
+                hi = blocks[min((i + 1) * span, len(blocks)) - 1]
+                if isleaf:
+                    out.append(struct.pack("<IIIIQQ", lo[0], lo[1], hi[0], hi[2],
+                        lo[3], lo[4]))
+                else:
+                    out.append(struct.pack("<IIIIQ", lo[0], lo[1], hi[0], hi[2],
+                        offsets[depth + 1] + i * nodesizes[depth + 1]))
+            out.append("\0" * ((blocksize - len(items)) * (isleaf and 32 or 24)))
+            fh.write("".join(out))
+
+def _summaries(starts, ends, values, reduction):
+    """zoom records (start, end, bases, min, max, sum, sum of squares) of
+    items summarized over windows of reduction bases"""
+    zoom  = starts // reduction
+    first = numpy.concatenate(([0], numpy.flatnonzero(zoom[1:] != zoom[:-1]) + 1))
+    bases = (ends - starts).astype(numpy.float64)
+    return (zoom[first] * reduction, ends[numpy.append(first[1:], len(ends)) - 1],
+            numpy.add.reduceat(ends - starts, first),
+            numpy.minimum.reduceat(values, first),
+            numpy.maximum.reduceat(values, first),
+            numpy.add.reduceat(values * bases, first),
+            numpy.add.reduceat(values * values * bases, first))
+
+class BigWigWriter(object):
+    """Write a bigWig file of fixed span items.  chroms is a list of (name,
+    size); data is added per chromosome with add(name, starts, values) and
+    written when the writer is closed.  reductions are the zoom levels in
+    bases; by default they are chosen from span * 4, span * 16, ...  (see
+    _reductions)"""
+    def __init__(self, filename, chroms, span, reductions = None):
+        self.filename   = filename
+        self.span       = span
+        self.reductions = reductions and sorted(reductions)[:MAX_ZOOMS]
+        self.sizes      = dict(chroms)
+        names           = sorted(self.sizes)
+        self.ids        = dict((n, i) for i, n in enumerate(names))
+        self.data       = {}
+    def add(self, chrom, starts, values):
+        """items starting at starts (sorted, 0-based) with values"""
+        if len(starts):
+            self.data[chrom] = (numpy.asarray(starts, dtype = numpy.int64),
+                    numpy.asarray(values, dtype = numpy.float64))
+    def __enter__(self):
+        return self
+    def __exit__(self, etype, evalue, traceback):
+        if etype is None:
+            self.close()
+    def _items(self):
+        """(chrom id, starts, ends, values) in chromosome id order"""
+        for chrom in sorted(self.data, key = self.ids.get):
+            starts, values = self.data[chrom]
+            ends = numpy.minimum(starts + self.span, self.sizes[chrom])
+            yield self.ids[chrom], starts, ends, values
+    def _write_blocks(self, fh, records):
+        """write zlib compressed blocks; records yields (chrom id, start,
+        end, payload) per block.  Returns the index entries and the largest
+        uncompressed block"""
+        blocks, maxbuf = [], 0
+        for cid, start, end, payload in records:
+            data   = zlib.compress(payload)
+            maxbuf = max(maxbuf, len(payload))
+            blocks.append((cid, start, end, fh.tell(), len(data)))
+            fh.write(data)
+        return blocks, maxbuf
+    def _data_records(self):
+        for cid, starts, ends, values in self._items():
+            for i in xrange(0, len(starts), ITEMS_PER_SLOT):
+                s, v = starts[i:i + ITEMS_PER_SLOT], values[i:i + ITEMS_PER_SLOT]
+                e    = ends[i:i + ITEMS_PER_SLOT]
+                items = numpy.empty(len(s), dtype = [("start", "<u4"), ("value", "<f4")])
+                items["start"], items["value"] = s, v
+                header = struct.pack("<IIIIIBBH", cid, s[0], e[-1], 0, self.span,
+                        2, 0, len(s))
+                yield cid, int(s[0]), int(e[-1]), header + items.tostring()
+    def _zoom_records(self, reduction):
+        dtype = [("cid", "<u4"), ("start", "<u4"), ("end", "<u4"), ("bases", "<u4"),
+                 ("min", "<f4"), ("max", "<f4"), ("sum", "<f4"), ("sumsq", "<f4")]
+        for cid, starts, ends, values in self._items():
+            zs = _summaries(starts, ends, values, reduction)
+            for i in xrange(0, len(zs[0]), ITEMS_PER_SLOT):
+                rec = numpy.empty(len(zs[0][i:i + ITEMS_PER_SLOT]), dtype = dtype)
+                rec["cid"] = cid
+                for name, col in zip(("start", "end", "bases", "min", "max", "sum", "sumsq"), zs):
+                    rec[name] = col[i:i + ITEMS_PER_SLOT]
+                yield cid, int(rec["start"][0]), int(rec["end"][-1]), rec.tostring()
+    def _reductions(self):
+        """zoom levels: summaries over 4, 16, ... items; a level is used if
+        it has at most half as many records as the previous one"""
+        if self.reductions:
+            return self.reductions
+        n_items = sum(len(s) for s, _ in self.data.values())
+        result, reduction = [], self.span * 4
+        while len(result) < MAX_ZOOMS and n_items > len(self.data) and \
+                reduction < 2 ** 31:
+            n = sum(len(numpy.unique(s // reduction)) for s, _ in self.data.values())
+            if n * 2 <= n_items:
+                result.append(reduction)
+                n_items = n
+            reduction *= 4
+        return result
+    def close(self):
+        chroms     = sorted((n, self.ids[n], s) for n, s in self.sizes.iteritems())
+        reductions = self._reductions()
+        with open(self.filename, "wb") as fh:
+            fh.write("\0" * (64 + 24 * len(reductions) + 40))
+            chrom_tree = fh.tell()
+            write_chrom_tree(fh, chroms)
+            # data sections and index
+            full_data = fh.tell()
+            n_blocks  = sum(-(-len(s) // ITEMS_PER_SLOT) for s, _ in self.data.values())
+            fh.write(struct.pack("<Q", n_blocks))
+            blocks, maxbuf = self._write_blocks(fh, self._data_records())
+            full_index = fh.tell()
+            write_rtree(fh, blocks, full_index)
+            zooms = []
+            for reduction in reductions:
+                zoom_data = fh.tell()
+                n_records = sum(len(numpy.unique(s // reduction)) for s, _ in self.data.values())
+                fh.write(struct.pack("<I", n_records))
+                zblocks, zmax = self._write_blocks(fh, self._zoom_records(reduction))
+                maxbuf     = max(maxbuf, zmax)
+                zoom_index = fh.tell()
+                write_rtree(fh, zblocks, zoom_index)
+                zooms.append((reduction, zoom_data, zoom_index))
+            fh.write(struct.pack("<I", BIGWIG_MAGIC))
+            # header, zoom headers and total summary
+            fh.seek(0)
+            fh.write(struct.pack("<IHHQQQHHQQIQ", BIGWIG_MAGIC, 4, len(zooms),
+                chrom_tree, full_data, full_index, 0, 0, 0, 64 + 24 * len(zooms),
+                maxbuf, 0))
+            for reduction, zoom_data, zoom_index in zooms:
+                fh.write(struct.pack("<IIQQ", reduction, 0, zoom_data, zoom_index))
+            bases, vmin, vmax, vsum, vsumsq = 0, 0.0, 0.0, 0.0, 0.0
+            if self.data:
+                items  = list(self._items())
+                values = numpy.concatenate([v for _, _, _, v in items])
+                length = numpy.concatenate([e - s for _, s, e, _ in items])
+                bases  = int(length.sum())
+                vmin, vmax = float(values.min()), float(values.max())
+                vsum   = float((values * length).sum())
+                vsumsq = float((values * values * length).sum())
+            fh.write(struct.pack("<Qdddd", bases, vmin, vmax, vsum, vsumsq))
@@ -0,0 +1,145 @@
+"""
+lazily allocated, chunked storage of per-bin values along a chromosome
+
+Bins are grouped into chunks of a fixed number of bins; a chunk is only
+allocated when a value in it is set, so memory scales with the covered part of
+a chromosome rather than its length.  Integer chunks can start out narrow (e.g.
+uint16) and are widened individually when a count would overflow.
+"""
+
+import numpy
+
+CHUNKSIZE    = 65536          # bins per chunk
+FILTER_BLOCK = 16 * CHUNKSIZE # bins passed to the function of filtered at a time
+
+# next wider type of integer chunks that overflow
+_WIDER = {numpy.dtype(numpy.uint8):  numpy.dtype(numpy.uint16),
+          numpy.dtype(numpy.uint16): numpy.dtype(numpy.uint32),
+          numpy.dtype(numpy.uint32): numpy.dtype(numpy.uint64),
+          numpy.dtype(numpy.int16):  numpy.dtype(numpy.int32),
+          numpy.dtype(numpy.int32):  numpy.dtype(numpy.int64)}
+
+class ChunkedBins(object):
+    """n_bins values in lazily allocated chunks of chunksize bins; bins in
+    chunks that were never allocated are 0"""
+    def __init__(self, n_bins, dtype = numpy.int32, chunksize = CHUNKSIZE):
+        self.n_bins    = n_bins
+        self.dtype     = numpy.dtype(dtype)
+        self.chunksize = chunksize
+        self.chunks    = {}
+    def __len__(self):
+        return self.n_bins
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.chunks.itervalues())
+    def _chunk(self, i):
+        """chunk i; allocated if necessary"""
+        chunk = self.chunks.get(i)
+        if chunk is None:
+            chunk = numpy.zeros(min(self.chunksize, self.n_bins - i * self.chunksize),
+                    dtype = self.dtype)
+            self.chunks[i] = chunk
+        return chunk
+    def _pieces(self, idx):
+        """split sorted bin numbers by chunk; yields chunk number, slice"""
+        cid   = idx // self.chunksize
+        start = numpy.concatenate(([0], numpy.flatnonzero(cid[1:] != cid[:-1]) + 1))
+        end   = numpy.append(start[1:], len(idx))
+        for s, e in zip(start.tolist(), end.tolist()):
+            yield int(cid[s]), slice(s, e)
+    def add(self, idx, values):
+        """add values to bins idx; idx has to be sorted, unique and within
+        0 <= idx < n_bins"""
+        if len(idx) == 0:
+            return
+        for i, sl in self._pieces(idx):
+            chunk = self._chunk(i)
+            off   = idx[sl] - i * self.chunksize
+            if chunk.dtype.kind in "ui":
+                new = chunk[off].astype(numpy.int64) + values[sl]
+                top = new.max()
+                while top > numpy.iinfo(chunk.dtype).max:
+                    chunk = chunk.astype(_WIDER[chunk.dtype])
+                    self.chunks[i] = chunk
+                chunk[off] = new
+            else:
+                chunk[off] += values[sl]
+    def set(self, start, values):
+        """set bins start to start + len(values) to values; chunks that are
+        not allocated are only allocated for non-zero values"""
+        end, cs = start + len(values), self.chunksize
+        for i in xrange(start // cs, (end - 1) // cs + 1):
+            lo, hi = max(start, i * cs), min(end, (i + 1) * cs)
+            part   = values[lo - start:hi - start]
+            if i in self.chunks or part.any():
+                self._chunk(i)[lo - i * cs:hi - i * cs] = part
+    def nonzero(self):
+        """bin numbers and values of all non-zero bins"""
+        idx, vals = [], []
+        for i in sorted(self.chunks):
+            chunk = self.chunks[i]
+            nz    = numpy.flatnonzero(chunk)
+            idx.append(nz + i * self.chunksize)
+            vals.append(chunk[nz])
+        if not idx:
+            return numpy.zeros(0, dtype = numpy.int64), numpy.zeros(0, dtype = self.dtype)
+        return numpy.concatenate(idx), numpy.concatenate(vals)
+    def dense(self, start = 0, end = None, dtype = None):
+        """bins start to end as a dense array"""
+        end, cs = self.n_bins if end is None else end, self.chunksize
+        out     = numpy.zeros(end - start, dtype = dtype or self.dtype)
+        for i in xrange(start // cs, (max(end, 1) - 1) // cs + 1):
+            chunk = self.chunks.get(i)
+            if chunk is not None:
+                lo, hi = max(start, i * cs), min(end, (i + 1) * cs)
+                out[lo - start:hi - start] = chunk[lo - i * cs:hi - i * cs]
+        return out
+    def covered(self, gap = 0):
+        """(start, end) bin ranges of allocated chunks; ranges less than or
+        equal to gap bins apart are joined"""
+        ranges = []
+        for i in sorted(self.chunks):
+            s, e = i * self.chunksize, min((i + 1) * self.chunksize, self.n_bins)
+            if ranges and s - ranges[-1][1] <= gap:
+                ranges[-1][1] = e
+            else:
+                ranges.append([s, e])
+        return [tuple(r) for r in ranges]
+    def aggregated(self, factor, n_bins = None):
+        """ChunkedBins of the sums of groups of factor consecutive bins; only
+        the first n_bins groups (default: all complete groups) are kept.
+        Each covered range is summed with a reshape of its dense values"""
+        n_bins = self.n_bins // factor if n_bins is None else n_bins
+        result = ChunkedBins(n_bins, self.dtype, self.chunksize)
+        wide   = self.dtype.kind in "ui" and numpy.int64 or numpy.float64
+        # ranges closer than factor bins could share a group
+        for s, e in self.covered(gap = factor):
+            lo, hi = s // factor, min(-(-e // factor), n_bins)
+            if hi <= lo:
+                continue
+            sums = self.dense(lo * factor, hi * factor, wide).reshape(hi - lo,
+                    factor).sum(axis = 1)
+            nz   = numpy.flatnonzero(sums)
+            result.add(nz + lo, sums[nz])
+        return result
+    def filtered(self, func, half_window, dtype = numpy.float64,
+            blocksize = FILTER_BLOCK):
+        """ChunkedBins of dtype of func applied to the bins; func maps an
+        array of dtype to an array of the same length (it may modify and
+        return its argument) in which each value depends only on the values
+        within half_window bins (like a smoothing filter).  func is applied
+        to blocks of about blocksize bins of the covered ranges with
+        half_window bins of context on each side, so the result is the same
+        as applying it to all bins at once while only one block is held as
+        a dense array"""
+        h         = half_window
+        blocksize = max(blocksize, 2 * h, 1)
+        result    = ChunkedBins(self.n_bins, dtype, self.chunksize)
+        for s, e in self.covered(gap = 2 * h):
+            out_lo, out_hi = max(0, s - h), min(self.n_bins, e + h)
+            for lo in xrange(out_lo, out_hi, blocksize):
+                hi     = min(lo + blocksize, out_hi)
+                in_lo  = max(0, lo - h)
+                out    = func(self.dense(in_lo, min(self.n_bins, hi + h), dtype))
+                result.set(lo, out[lo - in_lo:hi - in_lo])
+        return result
@@ -0,0 +1,163 @@
+"""
+on-disk cache for data derived from input files (parsed genomes, indices)
+
+Entries live in the directory given by $GOSR_CACHE_DIR (default
+~/.cache/gosr).  An entry is keyed by a kind and the path, size and
+modification time of the file it was derived from, so a changed source file
+does not hit a stale entry.  Entries that should be replaced rather than
+accumulate when their source changes are keyed by kind and path only and
+record the size and modification time themselves.  Entries are written to a
+temporary file and renamed into place, so readers never see a partial entry.
+Setting GOSR_CACHE_DIR to an empty string disables the cache.
+
+The cache is limited to $GOSR_CACHE_SIZE (a size like 500M or 20G, default
+10G; 0 for no limit).  Whenever an entry is written, the least recently used
+entries are removed until the cache fits; entries count as used when they
+are written or read (see touch).
+"""
+
+import os
+import errno
+import fcntl
+import contextlib
+import hashlib
+import logging
+import tempfile
+import argparse
+
+from gosr.common import arghelpers
+
+CACHE_ENV      = "GOSR_CACHE_DIR"
+CACHE_SIZE_ENV = "GOSR_CACHE_SIZE"
+CACHE_SIZE     = "10G" # default limit of the total size of all entries
+
+def cache_dir():
+    """the cache directory, created if necessary; None if caching is
+    disabled or the directory can not be created"""
+    path = os.environ.get(CACHE_ENV)
+    if path is None:
+        path = os.path.join(os.path.expanduser("~"), ".cache", "gosr")
+    if not path:
+        return None
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            logging.debug("can not create cache directory %s: %s", path, e)
+            return None
+    return path
+
+def size_limit():
+    """limit of the total size of the cache in bytes; None for no limit"""
+    spec = os.environ.get(CACHE_SIZE_ENV) or CACHE_SIZE
+    try:
+        return arghelpers.memory_size(spec) or None
+    except argparse.ArgumentTypeError:
+        logging.warn("Ignoring invalid %s=%s", CACHE_SIZE_ENV, spec)
+        return arghelpers.memory_size(CACHE_SIZE)
+
+def source_stamp(source):
+    """size and modification time (in microseconds) of file source"""
+    st = os.stat(source)
+    return st.st_size, int(st.st_mtime * 1e6)
+
+def entry_path(kind, source, ext = "", stamped = True):
+    """path of the cache entry of the given kind derived from file source;
+    None if caching is disabled.  If stamped is False, the path does not
+    depend on the size and modification time of source, and the caller has
+    to record them in the entry and detect stale entries itself (see
+    is_stale)"""
+    path = cache_dir()
+    if path is None:
+        return None
+    key = "%s\0%s" % (kind, os.path.abspath(source))
+    if stamped:
+        key += "\0%d\0%d" % source_stamp(source)
+    return os.path.join(path, "%s-%s%s" % (kind, hashlib.sha1(key).hexdigest(), ext))
+
+def is_stale(source, stamp):
+    """True if file source changed since stamp (from source_stamp) was
+    taken"""
+    return tuple(stamp) != source_stamp(source)
+
+@contextlib.contextmanager
+def locked(path):
+    """hold an exclusive lock on path + '.lock' for the duration of a with
+    block, so that concurrent processes building the same entry wait for
+    the first one instead of all building it; without a usable lock file
+    the block runs unlocked"""
+    try:
+        fh = open(path + ".lock", "a")
+    except IOError, e:
+        logging.debug("can not lock cache entry %s: %s", path, e)
+        yield
+        return
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        yield
+    finally:
+        fh.close()
+
+def remove(*paths):
+    """remove cache entries; missing files are ignored"""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logging.debug("can not remove cache entry %s: %s", path, e)
+
+def touch(*paths):
+    """mark cache entries as recently used; missing files are ignored"""
+    for path in paths:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+def prune(keep = None):
+    """remove the least recently used entries until the cache is within
+    size_limit.  The files of an entry share the name up to the first '.'
+    and are removed together; the entry of path keep is never removed.
+    Lock files and partially written files are left alone"""
+    path, limit = cache_dir(), size_limit()
+    if path is None or limit is None:
+        return
+    keep    = keep and os.path.basename(keep).split(".")[0]
+    entries = {}
+    for name in os.listdir(path):
+        if name.startswith(".tmp-") or name.endswith(".lock"):
+            continue
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        entry = entries.setdefault(name.split(".")[0], [0, 0, []])
+        entry[0] = max(entry[0], st.st_mtime)
+        entry[1] += st.st_size
+        entry[2].append(name)
+    total = sum(e[1] for e in entries.itervalues())
+    for key, (_, size, names) in sorted(entries.items(), key = lambda e: e[1][0]):
+        if total <= limit:
+            break
+        if key != keep:
+            logging.debug("removing cache entry %s (%d bytes)", key, size)
+            remove(*[os.path.join(path, n) for n in names])
+            total -= size
+
+def write_atomic(path, writer):
+    """call writer with a file object open for writing and rename the
+    result to path; failures are logged and otherwise ignored"""
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path),
+                prefix = ".tmp-" + os.path.basename(path))
+        with os.fdopen(fd, "wb") as fh:
+            writer(fh)
+        os.rename(tmp, path)
+        tmp = None
+        prune(keep = path)
+    except (IOError, OSError), e:
+        logging.debug("can not write cache entry %s: %s", path, e)
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
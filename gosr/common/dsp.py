@@ -1,5 +1,39 @@
+"""
+digital signal processing helpers
+"""
+
 import numpy
 
+BLOCKSIZE  = 1048576 # values smoothed at a time by savitzky_golay_blocks
+FFT_WINDOW = 128     # smallest window convolved with an FFT
+FFT_BLOCK  = 16384   # FFT size; small FFTs are faster per value
+
+_coefficients = {} # filter coefficients and their FFTs
+
+def sg_coefficients(window_size, order, deriv = 0):
+    """Savitzky-Golay convolution coefficients; memoized per window size,
+    order and derivative.  The returned array must not be modified"""
+    key = (window_size, order, deriv)
+    m   = _coefficients.get(key)
+    if m is None:
+        half_window = (window_size - 1) // 2
+        b = numpy.mat([[k**i for i in range(order + 1)]
+            for k in range(-half_window, half_window + 1)])
+        m = numpy.linalg.pinv(b).A[deriv]
+        m.flags.writeable = False
+        _coefficients[key] = m
+    return m
+
+def _fft_convolve(m, y):
+    """numpy.convolve(m, y, mode = 'valid') computed with an FFT"""
+    n    = len(y) + len(m) - 1
+    nfft = 1 << (n - 1).bit_length()
+    key  = (m.tostring(), nfft)
+    fm   = _coefficients.get(key)
+    if fm is None:
+        fm = _coefficients[key] = numpy.fft.rfft(m, nfft)
+    return numpy.fft.irfft(numpy.fft.rfft(y, nfft) * fm, nfft)[len(m) - 1:len(y)]
+
 def savitzky_golay_filter(y, window_size, order, deriv=0):
     r"""Smooth (and optionally differentiate) data with a Savitzky-Golay filter.
     The Savitzky-Golay filter removes high frequency noise from data.
@@ -57,14 +91,69 @@ def savitzky_golay_filter(y, window_size, order, deriv=0):
         raise TypeError("window_size size must be a positive odd number")
     if window_size < order + 2:
         raise TypeError("window_size is too small for the polynomials order")
-    order_range = range(order+1)
     half_window = (window_size -1) // 2
-    # precompute coefficients
-    b = numpy.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = numpy.linalg.pinv(b).A[deriv]
+    m = sg_coefficients(window_size, order, deriv)
     # pad the signal at the extremes with
     # values taken from the signal itself
     firstvals = y[0] - numpy.abs( y[1:half_window+1][::-1] - y[0] )
     lastvals = y[-1] + numpy.abs(y[-half_window-1:-1][::-1] - y[-1])
     y = numpy.concatenate((firstvals, y, lastvals))
     return numpy.convolve( m, y, mode='valid')
+
+def _padded(y, h):
+    """y as float64 with h values added on each side as in
+    savitzky_golay_filter; a signal of h or fewer values is padded repeatedly
+    (the padded signal is padded again) until h values are added"""
+    p = numpy.asarray(y, dtype = numpy.float64)
+    n = len(p)
+    while len(p) < n + 2 * h:
+        if len(p) == 1:
+            return numpy.repeat(p, 2 * h + 1)
+        k = min(h, len(p) - 1)
+        p = numpy.concatenate((p[0] - numpy.abs(p[1:k + 1][::-1] - p[0]), p,
+            p[-1] + numpy.abs(p[-k - 1:-1][::-1] - p[-1])))
+    o = (len(p) - n) // 2 - h
+    return p[o:o + n + 2 * h]
+
+def savitzky_golay_blocks(y, window_size, order, deriv = 0, out = None,
+        blocksize = BLOCKSIZE):
+    """savitzky_golay_filter of y computed in blocks of blocksize values
+    (about FFT_BLOCK values with an FFT), so that only one block and its
+    context are held in float64 at a time.
+    out (e.g. a float32 array) receives the result; it can be y itself, in
+    which case y is smoothed in place.  Windows of FFT_WINDOW or more values
+    are convolved with an FFT.  Signals of half a window or less are padded
+    repeatedly (see _padded).  Returns out"""
+    window_size, order = abs(int(window_size)), abs(int(order))
+    if window_size % 2 != 1 or window_size < 1:
+        raise TypeError("window_size size must be a positive odd number")
+    if window_size < order + 2:
+        raise TypeError("window_size is too small for the polynomials order")
+    h = (window_size - 1) // 2
+    if out is None:
+        out = numpy.empty(len(y), dtype = numpy.float64)
+    m = sg_coefficients(window_size, order, deriv)
+    if len(y) <= h:
+        out[:] = numpy.convolve(m, _padded(y, h), mode = "valid")
+        return out
+    blocksize = max(blocksize, 4 * window_size)
+    if window_size >= FFT_WINDOW:
+        # blocks with their context fill an FFT of a power of 2 exactly
+        convolve  = _fft_convolve
+        nfft      = max(FFT_BLOCK, 1 << (8 * window_size - 1).bit_length())
+        blocksize = nfft - 2 * (window_size - 1)
+    else:
+        convolve  = lambda m, y: numpy.convolve(m, y, mode = "valid")
+    # padding as in savitzky_golay_filter; prev holds the h (unsmoothed)
+    # values in front of the current block
+    y0, yn = float(y[0]), float(y[-1])
+    prev   = y0 - numpy.abs(numpy.asarray(y[1:h + 1][::-1], dtype = numpy.float64) - y0)
+    last   = yn + numpy.abs(numpy.asarray(y[-h - 1:-1][::-1], dtype = numpy.float64) - yn)
+    for s in xrange(0, len(y), blocksize):
+        e     = min(s + blocksize, len(y))
+        ahead = numpy.asarray(y[e:e + h], dtype = numpy.float64)
+        seg   = numpy.concatenate((prev, numpy.asarray(y[s:e], dtype = numpy.float64),
+                ahead, last[:h - len(ahead)]))
+        prev  = seg[e - s:e - s + h].copy()
+        out[s:e] = convolve(m, seg)
+    return out
@@ -1,31 +1,443 @@
-def read(fp): # this is a generator function
-    last = None # this is a buffer keeping the last unprocessed line
-    while True: # mimic closure; is it a bad idea?
+"""
+fasta/fastq parsing
+
+The parser reads its input in large blocks.  Runs of well formed 4-line fastq
+records are split out of a block in one go and validated with a few
+whole-block string operations, runs of fasta records are split apart at
+their headers, and junk lines between records are skipped with str.find.
+From the first record that is neither (multi-line fastq, for example), the
+rest of the input is read by the original readfq generator on lines split
+from the input in small blocks.
+"""
+
+import re
+from itertools import izip, chain, islice
+from operator import itemgetter
+import numpy
+
+BLOCKSIZE    = 4 * 1024 * 1024
+FAST_WINDOW  = 16384 # smallest piece of a block parsed by the fast path
+LINE_BLOCK   = 65536 # bytes split into lines at a time by the line based path
+
+class _Buffer(object):
+    """a file object that is read in large blocks"""
+    def __init__(self, fp, blocksize):
+        self.fp        = fp
+        self.blocksize = blocksize
+        self.buf       = ""
+        self.pos       = 0
+        self.eof       = False
+    def fill(self):
+        """append the next block to the unconsumed part of the buffer; at
+        least as much is read as is left unconsumed, so that a record larger
+        than a block is assembled in linear time.  Returns False at EOF"""
+        if self.eof:
+            return False
+        block = self.fp.read(max(self.blocksize, len(self.buf) - self.pos))
+        if not block:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        return True
+
+_name_re = re.compile(r"@(\S*)[^\n]*")
+_first   = itemgetter(0)
+
+def _name(header):
+    """record name from a header line without the leading '@' or '>'"""
+    if " " in header or "\t" in header:
+        return header.split()[0]
+    return header
+
+def _fastq_records(lines):
+    """returns names, seqs, quals of the leading well formed 4-line fastq
+    records in a list of lines; most checks are done on joined strings so that
+    the common case stays out of per-record python code"""
+    n     = len(lines) // 4
+    heads = lines[0:4 * n:4]
+    seqs  = lines[1:4 * n:4]
+    plus  = lines[2:4 * n:4]
+    quals = lines[3:4 * n:4]
+    hj    = "\n".join(heads)
+    pj    = "\n".join(plus)
+    try:
+        seq_start = set(map(_first, seqs))
+    except IndexError: # empty sequence line
+        seq_start = set("@")
+    if not (hj.startswith("@") and hj.count("\n@") == n - 1
+            and pj.startswith("+") and pj.count("\n+") == n - 1
+            and seq_start.isdisjoint("@+>")
+            and map(len, seqs) == map(len, quals)):
+        # find the first record that does not fit
+        for i in xrange(n):
+            h, s, p, q = lines[4 * i:4 * i + 4]
+            if not (h[:1] == "@" and p[:1] == "+" and s[:1] and
+                    s[0] not in "@+>" and len(q) >= len(s)):
+                n = i
+                break
+        heads, seqs, quals = heads[:n], seqs[:n], quals[:n]
+        hj = "\n".join(heads)
+    if " " not in hj and "\t" not in hj:
+        names = hj[1:].split("\n@") if n else []
+    elif hj.startswith(("@ ", "@\t")) or "\n@ " in hj or "\n@\t" in hj:
+        names = [_name(h[1:]) for h in heads]
+    else:
+        names = _name_re.findall(hj)
+    return names, seqs, quals
+
+def _line_ends(buf, pos):
+    """positions of the newlines ending the 4 lines starting at position pos
+    of buf; None if buf holds fewer than 4 complete lines from pos"""
+    e1 = buf.find("\n", pos)
+    e2 = buf.find("\n", e1 + 1) if e1 != -1 else -1
+    e3 = buf.find("\n", e2 + 1) if e2 != -1 else -1
+    e4 = buf.find("\n", e3 + 1) if e3 != -1 else -1
+    if e4 == -1:
+        return None
+    return e1, e2, e3, e4
+
+def _record_start(buf):
+    """position of the first line in buf that starts a 4-line fastq record
+    followed by another record or the end of buf; len(buf) if there is
+    none"""
+    if buf.startswith("@"):
+        i = 0
+    else:
+        i = buf.find("\n@") + 1
+    while i > 0 or i == 0 and buf.startswith("@"):
+        ends = _line_ends(buf, i)
+        if ends is None:
+            break
+        e1, e2, e3, e4 = ends
+        if buf.startswith("+", e2 + 1) and e2 - e1 == e4 - e3 and \
+                buf[e1 + 1] not in "@+>" and \
+                (e4 + 1 == len(buf) or buf.startswith("@", e4 + 1)):
+            return i
+        i = buf.find("\n@", i) + 1
+    return len(buf)
+
+def _record_end(buf, pos):
+    """position of the newline ending the 4-line fastq record starting at
+    position pos of buf; -1 if there is no complete 4-line record at pos"""
+    ends = buf.startswith("@", pos) and _line_ends(buf, pos)
+    if not ends:
+        return -1
+    e1, e2, e3, e4 = ends
+    if buf.startswith("+", e2 + 1) and e2 - e1 == e4 - e3:
+        return e4
+    return -1
+
+def _fasta_records(buf, pos, end):
+    """(name, seq, None) tuples of the fasta records from position pos of
+    buf, which starts a '>' header, to position end, which ends the input or
+    is followed by a '>' header; and the position after the last of them.
+    They stop before the record holding the first line starting with '@' or
+    '+', so there may be none"""
+    if buf.find("@", pos, end) != -1 or buf.find("+", pos, end) != -1:
+        bad = [i for i in (buf.find("\n@", pos, end), buf.find("\n+", pos, end))
+                if i != -1]
+        if bad:
+            end = buf.rfind("\n>", pos, min(bad))
+            if end == -1:
+                return [], pos
+    recs = buf[pos + 1:end].split("\n>")
+    try:
+        return [(head.split(None, 1)[0], seq.replace("\n", ""), None) for
+                head, _, seq in (r.partition("\n") for r in recs)], end + 1
+    except IndexError:
+        # a header without a name; one without a sequence either (e.g. a
+        # truncated last record) is not a record
+        recs = [((head.split(None, 1) or [""])[0], seq.replace("\n", ""), None)
+                for head, _, seq in (r.partition("\n") for r in recs)]
+        return [r for r in recs if r[0] or r[1]], end + 1
+
+def _line_blocks(src): # this is a generator function
+    """yields lists of the lines (without newlines) of the rest of the
+    buffer and the file, split LINE_BLOCK bytes at a time"""
+    parts = [src.buf[src.pos:]] # text following the last newline
+    size  = min(src.blocksize, LINE_BLOCK)
+    while True:
+        block = not src.eof and src.fp.read(size)
+        if not block:
+            rest = "".join(parts)
+            if rest: # the last line may lack its newline
+                yield (rest[:-1] if rest.endswith("\n") else rest).split("\n")
+            return
+        end = block.rfind("\n")
+        if end == -1:
+            parts.append(block)
+            continue
+        parts.append(block[:end])
+        yield "".join(parts).split("\n")
+        parts = [block[end + 1:]]
+
+def _line_records(src): # this is a generator function
+    """yields (name, seq, qual) of records of any shape from the rest of the
+    input; this is the original readfq generator on lines split from
+    blocks of the input, which is as fast as iterating over a file"""
+    lines = chain.from_iterable(_line_blocks(src))
+    last  = None # this is a buffer keeping the last unprocessed line
+    while True:
         if not last: # the first record or a record following a fastq
-            for l in fp: # search for the start of the next record
-                if l[0] in '>@': # fasta/q header line
-                    last = l[:-1] # save this line
+            for l in lines: # search for the start of the next record
+                if l and l[0] in ">@": # fasta/q header line
+                    last = l # save this line
                     break
         if not last: break
-        name, seqs, last = last[1:].split()[0], [], None
-        for l in fp: # read the sequence
-            if l[0] in '@+>':
-                last = l[:-1]
+        name, seqs, last = (last[1:].split(None, 1) or [""])[0], [], None
+        for l in lines: # read the sequence
+            if l and l[0] in "@+>":
+                last = l
                 break
-            seqs.append(l[:-1])
-        if not last or last[0] != '+': # this is a fasta record
-            yield name, ''.join(seqs), None # yield a fasta record
+            seqs.append(l)
+        if not last or last[0] != "+": # this is a fasta record
+            seq = "".join(seqs)
+            if name or seq: # a header without name and sequence is skipped
+                yield name, seq, None # yield a fasta record
             if not last: break
         else: # this is a fastq record
-            seq, leng, seqs = ''.join(seqs), 0, []
+            seq, leng, seqs = "".join(seqs), 0, []
             seqlen = len(seq)
-            for l in fp: # read the quality
-                seqs.append(l[:-1])
-                leng += len(l) - 1
+            for l in lines: # read the quality
+                seqs.append(l)
+                leng += len(l)
                 if leng >= seqlen: # have read enough quality
                     last = None
-                    yield name, seq, ''.join(seqs); # yield a fastq record
+                    yield name, seq, "".join(seqs) # yield a fastq record
                     break
             if last: # reach EOF before reading enough quality
                 yield name, seq, None # yield a fasta record instead
                 break
+
+def _read_runs(fp, blocksize, resync = False): # this is a generator function
+    """generator of iterables of (name, seq, qual) tuples; the fast paths
+    return runs of 4-line fastq records and of fasta records.  From the
+    first record that is neither (multi-line fastq, a truncated last
+    record), the rest of the input is read line by line by _line_records"""
+    src = _Buffer(fp, blocksize)
+    src.fill()
+    if resync:
+        src.pos = _record_start(src.buf)
+    window = FAST_WINDOW
+    while True:
+        # fast path: complete 4-line fastq records following pos.  It is only
+        # tried where a 4-line record starts, and on a window that grows with
+        # the data the previous try consumed
+        buf, pos = src.buf, src.pos
+        if pos < len(buf) and buf[pos] not in ">@": # skip junk lines
+            e = buf.find("\n", pos)
+            if e != -1:
+                src.pos = e + 1
+                continue
+        end = _record_end(buf, pos)
+        if end != -1:
+            end   = max(end, buf.rfind("\n", pos, pos + window))
+            lines = buf[pos:end].split("\n")
+            names, seqs, quals = _fastq_records(lines)
+            if names:
+                yield izip(names, seqs, quals)
+                rest    = lines[4 * len(names):]
+                src.pos = end + 1 - sum(map(len, rest)) - len(rest)
+                window  = max(FAST_WINDOW, 2 * (src.pos - pos))
+                continue
+        elif buf.startswith(">", pos):
+            # fasta records in a window that ends before a header
+            end = buf.rfind("\n>", pos, pos + window)
+            if end == -1:
+                end = buf.find("\n>", pos + window)
+            if end == -1 and src.fill():
+                continue # the last record in the buffer may not be complete
+            if end == -1:
+                end = len(buf)
+            recs, src.pos = _fasta_records(buf, pos, end)
+            if recs:
+                yield recs
+                window = max(FAST_WINDOW, 2 * (src.pos - pos))
+                continue
+        elif not src.eof and buf.count("\n", pos) < 4 and src.fill():
+            continue # too little left to tell whether a 4-line record follows
+        yield _line_records(src)
+        return
+
+def read(fp, blocksize = BLOCKSIZE):
+    """iterator of (name, seq, qual) tuples from a fasta or fastq file object;
+    qual is None for fasta records and for a truncated last fastq record"""
+    return chain.from_iterable(_read_runs(fp, blocksize))
+
+#===============================================================================
+# batched records
+#===============================================================================
+
+def _pack(strings):
+    """concatenate strings into a uint8 buffer; returns buffer, offsets and
+    lengths"""
+    lengths = numpy.fromiter(map(len, strings), dtype = numpy.int64,
+            count = len(strings))
+    offsets = numpy.zeros(len(strings), dtype = numpy.int64)
+    numpy.cumsum(lengths[:-1], out = offsets[1:])
+    return numpy.frombuffer("".join(strings), dtype = numpy.uint8), offsets, lengths
+
+def _scatter(out, dst, src, offsets, lengths):
+    """copy packed segments of src (see _pack) to positions dst of out"""
+    total = int(lengths.sum())
+    if total:
+        out[numpy.arange(total) + numpy.repeat(dst - offsets, lengths)] = src[:total]
+
+class FastqBatch(object):
+    """a chunk of records in columnar form.  Names, sequences and qualities
+    are each concatenated into a contiguous uint8 buffer with per-record
+    offset and length arrays, so that transformations can be applied to
+    a whole chunk with numpy.  Records without quality (fasta records) have
+    has_qual set to False and an empty quality."""
+    def __init__(self, names, seqs, quals):
+        self.names, self.name_offsets, self.name_lengths = _pack(names)
+        self.seq, self.seq_offsets, self.seq_lengths     = _pack(seqs)
+        if None in quals:
+            self.has_qual = numpy.array([q is not None for q in quals], dtype = bool)
+            quals         = [q or "" for q in quals]
+        else:
+            self.has_qual = numpy.ones(len(quals), dtype = bool)
+        self.qual, self.qual_offsets, self.qual_lengths  = _pack(quals)
+    def __len__(self):
+        return len(self.seq_lengths)
+    def __iter__(self):
+        """yields (name, seq, qual) tuples like read"""
+        names, seqs, quals = self.names.tostring(), self.seq.tostring(), \
+                self.qual.tostring()
+        for no, nl, so, sl, qo, ql, hq in izip(self.name_offsets, self.name_lengths,
+                self.seq_offsets, self.seq_lengths, self.qual_offsets,
+                self.qual_lengths, self.has_qual):
+            yield names[no:no + nl], seqs[so:so + sl], \
+                    quals[qo:qo + ql] if hq else None
+    def format(self):
+        """chunk as fastq text (fasta for records without quality); same
+        format as '@{name}\\n{seq}\\n+\\n{qual}\\n' per record"""
+        nl, sl, ql = self.name_lengths, self.seq_lengths, self.qual_lengths
+        hq         = self.has_qual
+        rec_len    = numpy.where(hq, nl + sl + ql + 6, nl + sl + 3)
+        start      = numpy.zeros(len(self), dtype = numpy.int64)
+        numpy.cumsum(rec_len[:-1], out = start[1:])
+        out        = numpy.empty(int(rec_len.sum()), dtype = numpy.uint8)
+        out[start]           = numpy.where(hq, ord("@"), ord(">"))
+        _scatter(out, start + 1, self.names, self.name_offsets, nl)
+        out[start + nl + 1]  = ord("\n")
+        _scatter(out, start + nl + 2, self.seq, self.seq_offsets, sl)
+        out[start + nl + sl + 2] = ord("\n")
+        qstart = (start + nl + sl + 3)[hq]
+        out[qstart]          = ord("+")
+        out[qstart + 1]      = ord("\n")
+        _scatter(out, qstart + 2, self.qual, self.qual_offsets[hq], ql[hq])
+        out[qstart + ql[hq] + 2] = ord("\n")
+        return out.tostring()
+
+def read_batches(fp, n, blocksize = BLOCKSIZE, resync = False): # this is a generator function
+    """yields FastqBatch objects of n records each (the last one may be
+    shorter) from a fasta or fastq file object.  With resync, fp may start
+    in the middle of a 4-line fastq file and everything before the first
+    complete record is skipped"""
+    recs = []
+    for run in _read_runs(fp, blocksize, resync):
+        run = iter(run) # runs of fasta records are lists
+        while True:
+            recs.extend(islice(run, n - len(recs)))
+            if len(recs) < n:
+                break
+            yield FastqBatch(*zip(*recs))
+            recs = []
+    if recs:
+        yield FastqBatch(*zip(*recs))
+
+#===============================================================================
+# record aligned chunks of raw text
+#===============================================================================
+
+def read_chunks(fp, size = BLOCKSIZE): # this is a generator function
+    """yields pieces of about size bytes of a 4-line fastq file, each ending
+    on a record boundary; chunks can be parsed independently with
+    parse_chunk"""
+    rest = ""
+    while True:
+        block = fp.read(size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        buf = rest + block
+        n   = buf.count("\n")
+        if n < 4:
+            rest = buf
+            continue
+        end = buf.rfind("\n")
+        for _ in xrange(n % 4):
+            end = buf.rfind("\n", 0, end)
+        yield buf[:end + 1]
+        rest = buf[end + 1:]
+
+def parse_chunk(chunk):
+    """FastqBatch of a chunk from read_chunks; None if the chunk does not
+    consist of 4-line fastq records only"""
+    lines = (chunk.endswith("\n") and chunk[:-1] or chunk).split("\n")
+    names, seqs, quals = _fastq_records(lines)
+    if 4 * len(names) != len(lines):
+        return None
+    return FastqBatch(names, seqs, quals)
+
+def translate_quals(chunk, lut):
+    """text of a chunk from read_chunks with the quality characters
+    translated by a lookup table (256 x uint8), written as format() would
+    (header lines cut to the record name, bare '+' lines).  The chunk is
+    converted as one byte array; no per-record objects are made.  A last
+    chunk without a final newline gets one, as format() would write it.
+    Returns None if the chunk does not consist of 4-line fastq records only"""
+    if not chunk.endswith("\n"):
+        chunk += "\n"
+    buf = numpy.frombuffer(chunk, dtype = numpy.uint8)
+    nl  = numpy.flatnonzero(buf == 10)
+    if len(nl) % 4:
+        return None
+    starts = numpy.empty(len(nl), dtype = numpy.int64)
+    starts[0]  = 0
+    starts[1:] = nl[:-1] + 1
+    heads, seqs, plus, quals = (starts[i::4] for i in xrange(4))
+    seq_len, qual_len = nl[1::4] - seqs, nl[3::4] - quals
+    if not ((buf[heads] == 64).all() and (buf[plus] == 43).all()
+            and (seq_len > 0).all() and (qual_len >= seq_len).all()):
+        return None
+    first = buf[seqs]
+    if ((first == 64) | (first == 43) | (first == 62)).any():
+        return None
+    # the running sum of edges is 1 within quality lines and 2 within text
+    # that is dropped (headers from their first blank, text after '+')
+    edges = numpy.zeros(len(buf) + 1, dtype = numpy.int8)
+    edges[quals]     = 1
+    edges[nl[3::4]] -= 1
+    drop  = False
+    for c in " \t":
+        if c in chunk:
+            drop = True
+            break
+    if drop:
+        blanks = numpy.flatnonzero(buf == 32)
+        if "\t" in chunk:
+            blanks = numpy.union1d(blanks, numpy.flatnonzero(buf == 9))
+        line   = numpy.searchsorted(nl, blanks)
+        blanks, line = blanks[line % 4 == 0], line[line % 4 == 0]
+        first_blank = numpy.ones(len(blanks), dtype = bool)
+        first_blank[1:] = line[1:] != line[:-1]
+        blanks, line = blanks[first_blank], line[first_blank]
+        if (blanks == starts[line] + 1).any(): # no name before the blank
+            return None
+        edges[blanks]   += 2
+        edges[nl[line]] -= 2
+    plus_text = nl[2::4] - plus > 1
+    if plus_text.any():
+        drop = True
+        edges[plus[plus_text] + 1]   += 2
+        edges[nl[2::4][plus_text]]   -= 2
+    state = numpy.cumsum(edges[:-1], dtype = numpy.int8)
+    out   = numpy.where(state == 1, numpy.frombuffer(chunk.translate(lut.tostring()),
+            dtype = numpy.uint8), buf)
+    if drop:
+        out = out[state != 2]
+    return out.tostring()
@@ -1,37 +1,329 @@
-import subprocess
-import logging
+import io
 import sys
+import time
+import zlib
+import struct
+import logging
+import subprocess
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+READSIZE   = 4 * 1024 * 1024 # bytes read from disk at a time
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+
+def gzip_format(header):
+    """returns 'bgzf', 'gzip' or None depending on the first bytes of a file;
+    header should contain at least 18 bytes if available"""
+    if not header.startswith("\x1f\x8b"):
+        return None
+    if len(header) >= 18 and ord(header[3]) & 4 and \
+            header[12:14] == "BC" and header[14:16] == "\x02\x00":
+        return "bgzf"
+    return "gzip"
+
+def _next_bgzf_block(fh, offset):
+    """file position of the first bgzf block starting at or after offset; a
+    candidate block header has to be followed by another block or EOF"""
+    window = 0x20000
+    pos    = offset
+    while True:
+        fh.seek(pos)
+        data = fh.read(window + 17)
+        if len(data) < 18:
+            return pos + len(data)
+        i = data.find(BGZF_MAGIC)
+        while i != -1 and i < window:
+            if gzip_format(data[i:i + 18]) == "bgzf":
+                bsize = struct.unpack("<H", data[i + 16:i + 18])[0]
+                fh.seek(pos + i + bsize + 1)
+                following = fh.read(4)
+                if following in ("", BGZF_MAGIC):
+                    return pos + i
+            i = data.find(BGZF_MAGIC, i + 1)
+        pos += window
+
+class _GzipReader(io.RawIOBase):
+    """in-process zlib decompression of a (multi-member) gzip stream"""
+    def __init__(self, fh, blocksize = READSIZE):
+        self.fh        = fh
+        self.blocksize = blocksize
+        self.dec       = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = ""
+        self.pos     = 0
+        self.n_in    = 0
+        self.n_out   = 0
+    def readable(self):
+        return True
+    def _more(self):
+        """decompress input until there is output; returns False at EOF"""
+        while True:
+            data = self.dec.unused_data.lstrip("\x00")
+            if data: # start of the next gzip member
+                self.dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self.fh.read(self.blocksize)
+                if not data:
+                    self.pending, self.pos = self.dec.flush(), 0
+                    return len(self.pending) > 0
+                self.n_in += len(data)
+            self.pending, self.pos = self.dec.decompress(data), 0
+            if self.pending:
+                return True
+    def readinto(self, b):
+        if self.pos >= len(self.pending) and not self._more():
+            return 0
+        n = min(len(b), len(self.pending) - self.pos)
+        b[:n] = memoryview(self.pending)[self.pos:self.pos + n]
+        self.pos   += n
+        self.n_out += n
+        return n
+    def close(self):
+        self.fh.close()
+        super(_GzipReader, self).close()
+
+def _inflate_bgzf(block):
+    """decompress one bgzf block given as (cdata, crc, isize)"""
+    cdata, crc, isize = block
+    data = zlib.decompress(cdata, -15)
+    if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+        raise IOError("bgzf block failed integrity check")
+    return data
+
+class _BgzfReader(_GzipReader):
+    """decompression of bgzf files; independent blocks are decompressed
+    in batches by a pool of threads (zlib releases the GIL) while the next
+    batch is read from disk"""
+    def __init__(self, fh, threads, blocksize = READSIZE):
+        _GzipReader.__init__(self, fh, blocksize)
+        self.batch   = max(1, blocksize // 0x10000) * threads
+        self.pool    = threads > 1 and ThreadPool(threads) or None
+        self.next    = self._submit()
+    def _blocks(self):
+        """read the next batch of compressed blocks"""
+        blocks = []
+        for _ in xrange(self.batch):
+            header = self.fh.read(12)
+            if not header:
+                break
+            if len(header) < 12 or not header.startswith("\x1f\x8b"):
+                raise IOError("truncated or invalid bgzf block header")
+            xlen  = struct.unpack("<H", header[10:12])[0]
+            extra = self.fh.read(xlen)
+            bsize = None
+            i = 0
+            while i + 4 <= len(extra):
+                slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+                if extra[i:i + 2] == "BC":
+                    bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+                i += 4 + slen
+            if bsize is None:
+                raise IOError("gzip member without bgzf block size")
+            rest = self.fh.read(bsize - xlen - 11)
+            if len(rest) != bsize - xlen - 11:
+                raise IOError("truncated bgzf block")
+            self.n_in += bsize + 1
+            crc, isize = struct.unpack("<II", rest[-8:])
+            blocks.append((rest[:-8], crc, isize))
+        return blocks
+    def _submit(self):
+        blocks = self._blocks()
+        if self.pool is None:
+            return blocks
+        return self.pool.map_async(_inflate_bgzf, blocks)
+    def _more(self):
+        while True:
+            if self.pool is None:
+                blocks = self.next
+                if not blocks:
+                    return False
+                data = [_inflate_bgzf(b) for b in blocks]
+            else:
+                data = self.next.get()
+                if not data:
+                    return False
+            self.next = self._submit()
+            self.pending, self.pos = "".join(data), 0
+            if self.pending:
+                return True
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+        _GzipReader.close(self)
 
 class FileOrGzip(object):
-    """Wrap regular file, gzipped file, or stdin in a context"""
-    def __init__(self, filename):
+    """Wrap regular file, gzipped file, or stdin in a context.  Compression is
+    detected from the file header, not the file name.  bgzf files are
+    decompressed in process with `threads` threads, other gzip files in
+    process with zlib or, if backend is 'pigz' (or threads > 1 and pigz is
+    available), by an external pigz process.
+
+    blocksize is the size of reads from disk.  For regular and bgzf files,
+    reading can start at a byte offset other than 0 (not with the pigz
+    backend); for bgzf files, reading starts at the first block at or after
+    offset"""
+    def __init__(self, filename, threads = 1, backend = None,
+            blocksize = READSIZE, offset = 0):
+        self.filename = filename
         self.filetype = None
-        if filename.endswith(".gz"):
-            self.gz = subprocess.Popen(["zcat", filename], stdout = subprocess.PIPE,
-                    stderr = subprocess.PIPE, close_fds = True)
+        self.raw      = None
+        self.offset   = offset
+        if filename == "-":
+            fh = io.open(sys.stdin.fileno(), "rb", blocksize, closefd = False)
+        else:
+            fh = io.open(filename, "rb", blocksize)
+        fmt = gzip_format(fh.peek(18)[:18])
+        if offset:
+            if filename == "-" or fmt == "gzip":
+                fh.close()
+                raise ValueError("reading from an offset requires a regular or bgzf file")
+            if fmt is not None and backend == "pigz":
+                fh.close()
+                raise ValueError("reading from an offset is not supported with pigz")
+            if fmt == "bgzf":
+                self.offset = _next_bgzf_block(fh, offset)
+            fh.seek(self.offset)
+        if fmt is not None and filename != "-" and (backend == "pigz" or
+                backend is None and fmt == "gzip" and threads > 1 and
+                find_executable("pigz") is not None):
+            fh.close()
+            self.gz = subprocess.Popen(["pigz", "-dc", "-p", str(threads), filename],
+                    stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                    close_fds = True)
             self.fh = self.gz.stdout
+            self.filetype = "pigz"
+        elif fmt == "bgzf" and backend in (None, "bgzf"):
+            self.raw = _BgzfReader(fh, threads, blocksize)
+            self.filetype = "bgzf"
+        elif fmt is not None:
+            self.raw = _GzipReader(fh, blocksize)
             self.filetype = "gzip"
         elif filename == "-":
-            self.fh = sys.stdin
+            self.fh = fh
             self.filetype = "stdin"
         else:
-            self.fh = open(filename, "r")
+            self.fh = fh
             self.filetype = "regular"
+        if self.raw is not None:
+            self.fh = io.BufferedReader(self.raw, blocksize)
+        self.start = time.time()
     def __enter__(self):
         return self.fh
+    def bytes_read(self):
+        """number of bytes read from disk so far; None for stdin and pigz"""
+        if self.raw is not None:
+            return self.raw.n_in
+        if self.filetype == "regular":
+            return self.fh.raw.tell() - self.offset
+        return None
     def __exit__(self, etype, evalue, traceback):
-        if self.filetype in ("gzip", "regular"):
+        if self.filetype != "stdin":
             self.fh.close()
-        if self.filetype == "gzip":
+        if self.raw is not None:
+            elapsed = max(time.time() - self.start, 1e-6)
+            logging.debug("%s [%s]: %.1f MB -> %.1f MB in %.2fs (%.1f MB/s decompressed)",
+                    self.filename, self.filetype, self.raw.n_in / 1e6,
+                    self.raw.n_out / 1e6, elapsed, self.raw.n_out / 1e6 / elapsed)
+        if self.filetype == "pigz":
             err = self.gz.stderr.read()
-            self.fh.close()
             self.gz.wait()
             if self.gz.returncode != 0:
-                # ignore complaint about broken pipe from zcat
+                # ignore complaint about broken pipe from pigz
                 if "Broken pipe" not in err:
-                    logging.error("gzip exited with return code %d", self.gz.returncode)
+                    logging.error("pigz exited with return code %d", self.gz.returncode)
                     logging.error(err)
                     sys.exit(1)
-        if etype is not None:
+        # a generator reading from the file may be closed before the end
+        if etype is not None and etype is not GeneratorExit:
             logging.error("An exception occured while in FileOrGzip context:")
 
+#===============================================================================
+# output
+#===============================================================================
+
+WRITESIZE  = 4 * 1024 * 1024 # bytes buffered before compressing/writing
+BGZF_BLOCK = 0xff00          # uncompressed bytes per bgzf block
+BGZF_EOF   = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00" \
+             "\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+def _deflate_bgzf(args):
+    """compress one piece of data into a bgzf block"""
+    data, level = args
+    c     = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    return struct.pack("<BBBBIBBHBBHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+            ord("B"), ord("C"), 2, len(cdata) + 25) + cdata + \
+            struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+class FileOrGzipWriter(object):
+    """Write to stdout or a file in a context, optionally gzip or bgzf
+    compressed.  Writes are collected into large blocks before being
+    compressed and written.  With compression 'auto', file names ending in
+    .gz are gzip compressed.  bgzf output is also valid gzip; its blocks are
+    compressed by `threads` threads"""
+    def __init__(self, filename, compression = "auto", level = 6, threads = 1):
+        if compression == "auto":
+            compression = filename.endswith(".gz") and "gzip" or "none"
+        self.filename    = filename
+        self.compression = compression
+        self.level       = level
+        self.buf         = []
+        self.size        = 0
+        self.pending     = None
+        self.pool        = None
+        if filename == "-":
+            self.fh = sys.stdout
+        else:
+            self.fh = open(filename, "wb")
+        if compression == "gzip":
+            self.comp = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == "bgzf" and threads > 1:
+            self.pool = ThreadPool(threads)
+    def __enter__(self):
+        return self
+    def write(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= WRITESIZE:
+            self.flush()
+    def flush(self):
+        """compress and write everything buffered so far"""
+        data = "".join(self.buf)
+        self.buf, self.size = [], 0
+        if self.compression == "none":
+            self.fh.write(data)
+        elif self.compression == "gzip":
+            self.fh.write(self.comp.compress(data))
+        else:
+            pieces = [(data[i:i + BGZF_BLOCK], self.level)
+                    for i in xrange(0, len(data), BGZF_BLOCK)]
+            if self.pool is None:
+                self.fh.write("".join(_deflate_bgzf(p) for p in pieces))
+            else:
+                # compress this batch while the previous one is written
+                if self.pending is not None:
+                    self.fh.write("".join(self.pending.get()))
+                self.pending = self.pool.map_async(_deflate_bgzf, pieces)
+    def close(self):
+        self.flush()
+        if self.pending is not None:
+            self.fh.write("".join(self.pending.get()))
+            self.pending = None
+        if self.pool is not None:
+            self.pool.close()
+        if self.compression == "gzip":
+            self.fh.write(self.comp.flush())
+        elif self.compression == "bgzf":
+            self.fh.write(BGZF_EOF)
+        if self.filename == "-":
+            self.fh.flush()
+        else:
+            self.fh.close()
+    def __exit__(self, etype, evalue, traceback):
+        self.close()
+        if etype is not None:
+            logging.error("An exception occured while in FileOrGzipWriter context:")
+
+def output_file(args):
+    """FileOrGzipWriter for the options added by arghelpers.add_output_options"""
+    return FileOrGzipWriter(args.output, args.compress, args.level,
+            args.compress_threads)
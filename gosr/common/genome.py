@@ -1,13 +1,24 @@
 """
 basic information about common genomes
+
+Besides the built-in genomes, a Genome can be loaded from a chrom.sizes file,
+a fasta index (.fai) or the header of a BAM file with load().  The chromosome
+order of the file is the sort order.  Parsed genomes are cached on disk (see
+gosr.common.cache).
 """
 
+import os
 import sys
+import bisect
 import logging
+import numpy
+from gosr.common import cache
 
 class Genome(object):
     """Utility class to store and retrieve basic properties of chromosomes of a
-    genome"""
+    genome.  Chromosome names are interned as integer ids (their index in
+    the sort order); sizes and offsets are kept in int64 arrays so that
+    whole arrays of positions can be mapped at once"""
     def __init__(self, chromosomes, sizes):
         """takes a list of chromosome names and a list of sizes and creates
         a standard data structure for accessing information about each
@@ -20,18 +31,32 @@ class Genome(object):
             logging.error(sizes)
             sys.exit(1)
         self.chromosomes = chromosomes
+        self.sizes       = numpy.array(sizeL, dtype = numpy.int64)
+        self.offsets     = numpy.zeros(len(sizeL), dtype = numpy.int64)
+        numpy.cumsum(self.sizes[:-1], out = self.offsets[1:])
+        offsetL          = self.offsets.tolist()
         self.__size      = dict(zip(chromosomes, sizeL))
         self.__order     = dict(zip(chromosomes, range(len(chromosomes))))
-        self.__offsets   = dict(zip(chromosomes, 
-            [sum(sizeL[0:i]) for i in range(len(sizeL))]))
-        self.__offset_list = sorted(self.__offsets.items(), key = lambda x: x[1])
+        self.__offsets   = dict(zip(chromosomes, offsetL))
+        self.__offset_list = offsetL
     
+    def __contains__(self, chrom):
+        return chrom in self.__order
     def size(self, chrom):
         """size of chrom"""
         return self.__size[chrom]
     def order(self, chrom):
         """sort order of chromosome"""
         return self.__order[chrom]
+    def chrom_id(self, chrom):
+        """integer id of chrom (same as its sort order)"""
+        return self.__order[chrom]
+    def chrom_ids(self, chroms):
+        """int64 array of the ids of a sequence of chromosome names; raises
+        KeyError for unknown chromosomes"""
+        order = self.__order
+        return numpy.fromiter((order[c] for c in chroms), dtype = numpy.int64,
+                count = len(chroms))
     def offset(self, chrom):
         """0-based offset of start of chrom if chromosomes are concatenated in
         sort order"""
@@ -44,20 +69,89 @@ class Genome(object):
         """Position of base pos (1-based) in chrom if chromosomes were
         concatenated in sort order; result is 0-based"""
         return self.__offsets[chrom] + pos - 1
+    def cpos_array(self, chrom_ids, pos):
+        """cpos of arrays of chromosome ids and 0-based positions"""
+        return self.offsets[chrom_ids] + pos
     def cpos2chrom(self, cpos0):
         """Take a 0-based position in the concatenated genome and
         return a chrom, pos tuple that maps the concatenated genome
         position to a chromosome and a 0-based position"""
         assert cpos0 >= 0
-        chrom  = None
-        offset = None
-        for c, o in self.__offset_list:
-            if cpos0 >= o:
-                chrom = c
-                offset = o
-            else:
-                break
-        return chrom, cpos0 - offset    
+        i = bisect.bisect_right(self.__offset_list, cpos0) - 1
+        return self.chromosomes[i], cpos0 - self.__offset_list[i]
+    def cpos2chrom_array(self, cpos0):
+        """cpos2chrom of an array of positions; returns arrays of chromosome
+        ids and 0-based positions"""
+        ids = numpy.searchsorted(self.offsets, cpos0, side = "right") - 1
+        return ids, cpos0 - self.offsets[ids]
+
+#===============================================================================
+# loading genomes from files
+#===============================================================================
+
+def read_sizes(filename):
+    """chromosome names and sizes from a chrom.sizes or .fai file (name and
+    size are the first two tab or space separated columns)"""
+    names, sizes = [], []
+    with open(filename) as fh:
+        for line in fh:
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) < 2 or not fields[1].isdigit():
+                raise ValueError("%s: not a chrom.sizes or .fai line: %r"
+                        % (filename, line))
+            names.append(fields[0])
+            sizes.append(long(fields[1]))
+    return names, sizes
+
+def bam_sizes(filename):
+    """chromosome names and sizes from the header of a BAM file"""
+    import pysam
+    bam = pysam.Samfile(filename, "rb")
+    try:
+        return list(bam.references), [long(l) for l in bam.lengths]
+    finally:
+        bam.close()
+
+def _read_cached(path):
+    data = numpy.load(path)
+    return data["names"].tostring().split("\n"), data["sizes"].tolist()
+
+def _write_cached(fh, names, sizes):
+    numpy.savez(fh, names = numpy.frombuffer("\n".join(names), dtype = numpy.uint8),
+            sizes = numpy.array(sizes, dtype = numpy.int64))
+
+def from_file(filename):
+    """Genome from a chrom.sizes, .fai or BAM file; the parsed names and
+    sizes are cached in compact binary form"""
+    path = cache.entry_path("genome", filename, ".npz")
+    if path is not None and os.path.exists(path):
+        try:
+            genome = Genome(*_read_cached(path))
+            cache.touch(path)
+            return genome
+        except (IOError, ValueError, KeyError), e:
+            logging.debug("ignoring unreadable cache entry %s: %s", path, e)
+    if filename.endswith((".bam", ".sam")):
+        names, sizes = bam_sizes(filename)
+    else:
+        names, sizes = read_sizes(filename)
+    if not names:
+        raise ValueError("%s does not contain any chromosomes" % filename)
+    if path is not None:
+        cache.write_atomic(path, lambda fh: _write_cached(fh, names, sizes))
+    return Genome(names, sizes)
+
+def load(spec):
+    """Genome for a built-in genome name or a chrom.sizes, .fai or BAM
+    file; raises ValueError if spec is neither"""
+    if isinstance(BUILTIN.get(spec), Genome):
+        return BUILTIN[spec]
+    if os.path.isfile(spec):
+        return from_file(spec)
+    raise ValueError("Genome %s is neither a built-in genome (%s) nor a file"
+            % (spec, ", ".join(sorted(BUILTIN))))
 
 #===============================================================================
 # Data
@@ -85,3 +179,5 @@ hg18 = Genome(("chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8",
         158821424, 146274826, 140273252, 135374737, 134452384, 132349534,
         114142980, 106368585, 100338915, 88827254, 78774742, 76117153, 63811651,
         62435964, 46944323, 49691432, 154913754, 57772954, 16571))
+
+BUILTIN = {"mm9": mm9, "hg19": hg19, "hg18": hg18}
@@ -0,0 +1,96 @@
+"""
+sorted array index of non-overlapping windows around TSSs
+
+Windows are kept per chromosome as sorted numpy arrays of window starts,
+ends (half open), strands and TSS positions, so that the window containing
+a position is found with a binary search (numpy.searchsorted), for single
+positions or whole arrays of positions at once.
+"""
+
+import bisect
+import numpy
+
+FIELDS      = ("starts", "ends", "minus", "tss")
+FIELD_TYPES = (numpy.int64, numpy.int64, bool, numpy.int64)
+
+class TssIndex(object):
+    """windows around TSSs; chroms maps a chromosome name to the arrays
+    (starts, ends, minus, tss) of its windows in position order.  minus is
+    True for windows of minus strand TSSs"""
+    def __init__(self, chroms = None, n_tss = None):
+        self.chroms = chroms or {}
+        # number of TSSs the windows were chosen from
+        self.n_tss  = len(self) if n_tss is None else n_tss
+    def __len__(self):
+        return sum(len(c[0]) for c in self.chroms.itervalues())
+    @classmethod
+    def build(cls, tsss, upstream, downstream):
+        """index of the windows from upstream to downstream of TSSs given
+        as (chrom, pos, strand) tuples.  A window is only used if it does
+        not overlap any window used before it, so the order of tsss
+        decides which of a set of overlapping windows is used"""
+        windows = {}
+        tsss    = list(tsss)
+        for chrom, pos, strand in tsss:
+            if strand == "+":
+                start, end = pos - upstream, pos + downstream + 1
+            else:
+                start, end = pos - downstream, pos + upstream + 1
+            starts, ends, rest = windows.setdefault(chrom, ([], [], []))
+            # windows are disjoint, so the last window starting before end
+            # is the only one that can overlap
+            i = bisect.bisect_left(starts, end)
+            if i > 0 and ends[i - 1] > start:
+                continue
+            starts.insert(i, start)
+            ends.insert(i, end)
+            rest.insert(i, (strand == "-", pos))
+        chroms = {}
+        for chrom, (starts, ends, rest) in windows.iteritems():
+            chroms[chrom] = (numpy.array(starts, dtype = numpy.int64),
+                    numpy.array(ends, dtype = numpy.int64),
+                    numpy.array([m for m, _ in rest], dtype = bool),
+                    numpy.array([p for _, p in rest], dtype = numpy.int64))
+        return cls(chroms, len(tsss))
+    def write(self, fh):
+        """save the index to a file object in numpy .npz format"""
+        names  = sorted(self.chroms)
+        arrays = [self.chroms[c] for c in names] or \
+                [tuple(numpy.zeros(0, dtype = d) for d in FIELD_TYPES)]
+        fields = dict((f, numpy.concatenate([a[i] for a in arrays]))
+                for i, f in enumerate(FIELDS))
+        numpy.savez(fh, names = numpy.frombuffer("\n".join(names), dtype = numpy.uint8),
+                counts = numpy.array([len(self.chroms[c][0]) for c in names],
+                    dtype = numpy.int64),
+                n_tss = numpy.array(self.n_tss), **fields)
+    @classmethod
+    def read(cls, filename):
+        """index saved with write"""
+        data   = numpy.load(filename)
+        counts = data["counts"]
+        names  = len(counts) and data["names"].tostring().split("\n") or []
+        bounds = numpy.append(0, numpy.cumsum(counts)).tolist()
+        fields = [data[f] for f in FIELDS]
+        chroms = dict((c, tuple(f[bounds[i]:bounds[i + 1]] for f in fields))
+                for i, c in enumerate(names))
+        return cls(chroms, int(data["n_tss"]))
+    def lookup(self, chrom, pos):
+        """window numbers (in chroms[chrom]) of the windows containing the
+        positions in array pos; -1 for positions outside of all windows"""
+        pos = numpy.asarray(pos)
+        if chrom not in self.chroms:
+            return numpy.repeat(numpy.int64(-1), len(pos))
+        starts, ends = self.chroms[chrom][:2]
+        i = numpy.searchsorted(starts, pos, side = "right") - 1
+        i[(i < 0) | (pos >= ends[numpy.maximum(i, 0)])] = -1
+        return i
+    def find(self, chrom, pos):
+        """(start, end, strand, tss) of the window containing position pos;
+        None if there is none"""
+        if chrom not in self.chroms:
+            return None
+        starts, ends, minus, tss = self.chroms[chrom]
+        i = int(numpy.searchsorted(starts, pos, side = "right")) - 1
+        if i < 0 or pos >= ends[i]:
+            return None
+        return int(starts[i]), int(ends[i]), minus[i] and "-" or "+", int(tss[i])
@@ -1,78 +1,449 @@
 """
-sort file by chromosome, position, with the chromosome
-sort order given by the genome module; sorting is done by assuming that column
-1 is chromosome and column 2 is a position.  Strand is ignored in sorting.
+sort file by chromosome, position, with the chromosome sort order given by
+the genome (a built-in genome or a chrom.sizes, .fai or BAM file); sorting is
+done by assuming that column 1 is chromosome and column 2 is a position.
+Strand is ignored in sorting.
 
-Output is to stdout
+Input is read in chunks that take about the memory given with -S to sort.
+Each chunk is sorted in memory; if the input does not fit into one chunk, the
+sorted chunks are written to temporary files (in the directory given with -T)
+and merged.  Lines with the same chromosome and position keep their input
+order.  Consecutive chunks that continue each other (as in sorted input or a
+concatenation of sorted files) are chained instead of merged.  Chunks of an
+uncompressed input file that are in order already are not written to
+temporary files but read from the input again, so that sorted input is
+copied straight from the input to the output.
+
+With --threads, chunks are sorted by a pool of processes while input is being
+read, and each chromosome is then merged separately; the merged chromosomes
+are concatenated in genome order.
+
+Several input files are sorted together.  With --merge, each input file has to
+be sorted already and the files are merged in a single streaming pass.  With
+--check, the input is only checked for sortedness (exit status 1 if it is not
+sorted).
+
+Output is to stdout or the file given with -o
 """
 
+import os
 import sys
+import time
+import heapq
+import shutil
 import logging
 import argparse
-import shlex
-import subprocess
-import signal
+import tempfile
+import itertools
+import collections
+import multiprocessing
+from cStringIO import StringIO
+from itertools import izip, islice, repeat
+import numpy
 from gosr.common import arghelpers
 from gosr.common import genome
-from gosr.common.file import FileOrGzip
-
-def start_unix_sort(mem):
-    """start up an external sort process for bed file; returns 2 popen
-    objects (the sort and the cut); This is a coroutine! prime and close!"""
-    cmdline = shlex.split("sort -S%s -k1,1g -" % mem)
-    logging.info("sort call: %s", cmdline)
-    sortproc = subprocess.Popen(cmdline, stdin = subprocess.PIPE, 
-            stdout = subprocess.PIPE, shell = False)
-    cutproc  = subprocess.Popen(shlex.split("cut -f2-"), 
-            stdin = sortproc.stdout, shell = False, 
-            preexec_fn = sortproc.stdin.close)
-    def _exit_nicely(signr, frame):
-        logging.warn("Received signal %d; terminating subprocesses and exiting",
-                signr)
-        sortproc.terminate()
-        cutproc.terminate()
-        sys.exit(1)
-    signal.signal(signal.SIGINT, _exit_nicely)
+from gosr.common.file import FileOrGzip, output_file, WRITESIZE
+
+RUNBLOCK    = 65536   # most lines read from a run at a time while merging
+KEYBLOCK    = 4096    # lines split into fields at a time
+READBLOCK   = 1 << 20 # bytes read at a time while a chunk is collected
+LINE_MEMORY = 100     # bytes of memory per line besides its text (string
+                      # object, list entries, keys and sort order)
+
+# text of a sorted run is in file path from byte offset on (size bytes, lines
+# lines); its int64 keys are in file keys, or computed from the lines again
+# when keys is None (runs left in place in the input)
+Run = collections.namedtuple("Run", "path offset size lines keys first last")
+
+def line_keys(lines, chroms):
+    """int64 sort keys (position in the concatenated genome) of bed lines;
+    raises ValueError for lines that can not be sorted.  Lines are split
+    KEYBLOCK at a time so that their fields do not pile up"""
+    keys = numpy.empty(len(lines), dtype = numpy.int64)
+    for s in xrange(0, len(lines), KEYBLOCK):
+        block = lines[s:s + KEYBLOCK]
+        try:
+            fields = [l.split("\t", 2) for l in block]
+            keys[s:s + len(block)] = chroms.cpos_array(
+                    chroms.chrom_ids([f[0] for f in fields]),
+                    numpy.array([f[1] for f in fields], dtype = numpy.int64))
+        except (KeyError, IndexError, ValueError):
+            for l in block:
+                f = l.split("\t", 2)
+                if len(f) < 3 or f[0] not in chroms or not f[1].isdigit():
+                    raise ValueError("can not sort line: %r" % l)
+            raise
+    return keys
+
+def is_sorted(keys):
+    return bool((keys[1:] >= keys[:-1]).all())
+
+def sort_chunk(lines, chroms):
+    """sort lines stably by their keys; returns keys, lines"""
+    keys = line_keys(lines, chroms)
+    if is_sorted(keys):
+        return keys, lines
+    order = numpy.argsort(keys, kind = "mergesort")
+    return keys[order], [lines[i] for i in order]
+
+def chunk_memory(n_bytes, n_lines):
+    """estimated memory needed to sort n_lines lines of n_bytes of text"""
+    return n_bytes + LINE_MEMORY * n_lines
+
+def read_lines(filenames, size): # this is a generator function
+    """yields (lines, last, source) with lists of lines from the input files
+    in turn that take about size bytes of memory (see chunk_memory) to sort;
+    last is True for the final list.  source is (filename, byte offset) of
+    the lines in a regular file, None for compressed input and stdin"""
+    for i, filename in enumerate(filenames):
+        infile = FileOrGzip(filename)
+        with infile as fh:
+            regular = infile.filetype == "regular"
+            lines, used, offset = [], 0, 0
+            while True:
+                block = fh.readlines(READBLOCK)
+                if not block:
+                    break
+                lines.extend(block)
+                used += chunk_memory(sum(map(len, block)), len(block))
+                if used >= size:
+                    if not lines[-1].endswith("\n"):
+                        lines[-1] += "\n"
+                    yield lines, i == len(filenames) - 1 and not fh.peek(1), \
+                            regular and (filename, offset) or None
+                    offset += sum(map(len, lines))
+                    lines, used = [], 0
+            if lines:
+                if not lines[-1].endswith("\n"):
+                    lines[-1] += "\n"
+                yield lines, i == len(filenames) - 1, \
+                        regular and (filename, offset) or None
+
+def read_line_chunks(filenames, size): # this is a generator function
+    """yields (text, source) with pieces of text ending on a line boundary
+    from the input files in turn that take about size bytes of memory (see
+    chunk_memory) to sort; source is as for read_lines"""
+    for filename in filenames:
+        infile = FileOrGzip(filename)
+        with infile as fh:
+            regular      = infile.filetype == "regular"
+            blocks, used = [], 0
+            offset       = 0
+            while True:
+                block = fh.read(READBLOCK)
+                if block:
+                    blocks.append(block)
+                    used += chunk_memory(len(block), block.count("\n"))
+                    if used < size:
+                        continue
+                text = "".join(blocks)
+                if not block:
+                    if text:
+                        yield text.endswith("\n") and text or text + "\n", \
+                                regular and (filename, offset) or None
+                    break
+                end = text.rfind("\n") + 1
+                if end == 0:
+                    continue
+                yield text[:end], regular and (filename, offset) or None
+                offset      += end
+                rest         = text[end:]
+                blocks, used = [rest], chunk_memory(len(rest), 0)
+
+def write_run(tmpdir, runid, keys, lines):
+    """spill a sorted chunk to a text file with a binary file of its keys"""
+    prefix = os.path.join(tmpdir, "run%05d" % runid)
+    keys.tofile(prefix + ".keys")
+    with open(prefix + ".txt", "wb") as fh:
+        fh.writelines(lines)
+    return Run(prefix + ".txt", 0, sum(map(len, lines)), len(lines),
+            prefix + ".keys", int(keys[0]), int(keys[-1]))
+
+def input_run(source, keys, lines):
+    """run of a chunk that was sorted already, left in place in its input
+    file; source is (filename, byte offset) as from read_lines"""
+    return Run(source[0], source[1], sum(map(len, lines)), len(lines), None,
+            int(keys[0]), int(keys[-1]))
+
+def make_run(tmpdir, runid, keys, lines, source):
+    """spill a sorted chunk to tmpdir; a chunk of a regular file that was in
+    order already (source given, see read_lines) is left in place instead"""
+    if source is not None:
+        return input_run(source, keys, lines)
+    return write_run(tmpdir, runid, keys, lines)
+
+def merge_block(size, n_runs):
+    """lines read from each of n_runs runs at a time so that a merge takes
+    about size bytes of memory"""
+    return int(min(RUNBLOCK, max(1024, size // (max(n_runs, 1) * LINE_MEMORY))))
+
+def read_run(run, runid, start = 0, end = None, byte_start = 0,
+        block = RUNBLOCK, chroms = None): # this is a generator function
+    """yields (key, runid, line) of lines start to end of a sorted run;
+    byte_start is the offset of line start from the start of the run.  Keys
+    and lines are read block lines at a time; keys of a run without a keys
+    file are computed with chroms.  The run id breaks ties between runs in
+    favour of earlier input"""
+    if end is None:
+        end = run.lines
+    with open(run.path, "rb") as fh:
+        kf = run.keys is not None and open(run.keys, "rb")
+        try:
+            if kf:
+                kf.seek(8 * start)
+            fh.seek(run.offset + byte_start)
+            for i in xrange(start, end, block):
+                lines = list(islice(fh, min(block, end - i)))
+                if not lines[-1].endswith("\n"): # end of an input file
+                    lines[-1] += "\n"
+                if kf:
+                    keys = numpy.fromfile(kf, dtype = numpy.int64,
+                            count = len(lines)).tolist()
+                else:
+                    keys = line_keys(lines, chroms).tolist()
+                for rec in izip(keys, repeat(runid), lines):
+                    yield rec
+        finally:
+            if kf:
+                kf.close()
+
+def chains(runs):
+    """group consecutive runs in which each run starts at or after the end of
+    the previous one; a chain of runs is sorted as a whole"""
+    groups = []
+    for run in runs:
+        if groups and run.first >= groups[-1][-1].last:
+            groups[-1].append(run)
+        else:
+            groups.append([run])
+    return groups
+
+def merge_runs(runs, out, block = RUNBLOCK):
+    """k-way merge of read_run generators; lines are written to out block
+    lines at a time"""
+    buf = []
+    for _, _, line in heapq.merge(*runs):
+        buf.append(line)
+        if len(buf) == block:
+            out.write("".join(buf))
+            buf = []
+    out.write("".join(buf))
+
+def write_lines(lines, out):
+    """write a list of lines RUNBLOCK lines at a time"""
+    for i in xrange(0, len(lines), RUNBLOCK):
+        out.write("".join(lines[i:i + RUNBLOCK]))
+
+def copy_runs(runs, out):
+    """concatenate the text of runs"""
+    for run in runs:
+        with open(run.path, "rb") as fh:
+            fh.seek(run.offset)
+            left = run.size
+            while left:
+                data = fh.read(min(WRITESIZE, left))
+                if not data: # end of an input file without a final newline
+                    data = "\n"
+                out.write(data)
+                left -= len(data)
+
+def sort_serial(filenames, outfile, chroms, chunksize, tmpdir):
+    """sort runs one after the other and merge them; chunksize is the memory
+    used for sorting a run and for the merge"""
+    start = time.time()
+    runs  = []
+    for lines, last, source in read_lines(filenames, chunksize):
+        keys, sorted_lines = sort_chunk(lines, chroms)
+        if not runs and last:
+            logging.info("Input fits into memory; no merge needed")
+            write_lines(sorted_lines, outfile)
+            logging.info("Time reading and sorting: %.1fs", time.time() - start)
+            return
+        runs.append(make_run(tmpdir, len(runs), keys, sorted_lines,
+            sorted_lines is lines and source or None))
+        logging.info("Sorted run %d (%d lines)%s", len(runs), len(lines),
+                runs[-1].keys is None and " is left in place" or "")
+        del keys, lines, sorted_lines
+    logging.info("Time reading and sorting %d runs: %.1fs", len(runs),
+            time.time() - start)
+    start  = time.time()
+    groups = chains(runs)
+    if len(groups) == 1:
+        logging.info("Sorted runs continue each other; concatenating them")
+        copy_runs(runs, outfile)
+    else:
+        logging.info("Merging %d chains of sorted runs", len(groups))
+        block = merge_block(chunksize, len(groups))
+        merge_runs([itertools.chain(*[read_run(r, i, block = block,
+            chroms = chroms) for r in group]) for i, group in enumerate(groups)],
+            outfile, block)
+    logging.info("Time merging: %.1fs", time.time() - start)
+
+#===============================================================================
+# parallel sort
+#===============================================================================
+
+_worker = {}
+
+def _init_worker(chroms, tmpdir):
+    _worker["tmpdir"] = tmpdir
+    _worker["chroms"] = chroms
+    # start of each chromosome and end of the last one in key space
+    _worker["bounds"] = numpy.append(chroms.offsets, chroms.sizes.sum())
+
+def _sort_run(job):
+    """pool worker: sort a chunk of text into a run (see make_run); returns
+    the run and the line and byte offsets of each chromosome in the run"""
+    runid, (chunk, source) = job
+    lines              = StringIO(chunk).readlines()
+    keys, sorted_lines = sort_chunk(lines, _worker["chroms"])
+    run   = make_run(_worker["tmpdir"], runid, keys, sorted_lines,
+            sorted_lines is lines and source or None)
+    lines = sorted_lines
+    line_bounds = numpy.searchsorted(keys, _worker["bounds"])
+    # keys before the first or after the last chromosome (negative or too
+    # large positions) go with it, as in the serial sort
+    line_bounds[0], line_bounds[-1] = 0, len(keys)
+    byte_bounds = numpy.zeros(len(lines) + 1, dtype = numpy.int64)
+    numpy.cumsum(numpy.fromiter(map(len, lines), dtype = numpy.int64,
+        count = len(lines)), out = byte_bounds[1:])
+    return run, line_bounds, byte_bounds[line_bounds]
+
+def _merge_chrom(job):
+    """pool worker: merge the parts of all runs that belong to one
+    chromosome into a file; returns its name"""
+    i, parts, block = job
+    path = os.path.join(_worker["tmpdir"], "chrom%05d.txt" % i)
+    with open(path, "wb") as out:
+        merge_runs([read_run(*p, block = block, chroms = _worker["chroms"])
+            for p in parts], out, block)
+    return path
+
+def sort_parallel(filenames, outfile, chroms, chunksize, tmpdir, threads):
+    """runs are sorted by a pool of processes while input is read; then
+    each chromosome is merged by a worker and the results are concatenated
+    in genome order.  chunksize is the memory used by a worker for sorting a
+    run or merging a chromosome"""
+    start   = time.time()
+    pool    = multiprocessing.Pool(threads, _init_worker, (chroms, tmpdir))
+    pending = collections.deque()
+    runs    = []
     try:
-        while True:
-            data = (yield)
-            sortproc.stdin.write(data)
-    except GeneratorExit:
-        sortproc.stdin.close()
-        returncode1 = sortproc.wait()
-        returncode2 = cutproc.wait()
-        if returncode1 != 0 or returncode2 != 0:
-            logging.error("subprocesses exited abnormally (sort: %d, cut: %d)",
-                    returncode1, returncode1)
-            sys.exit()
+        for runid, chunk in enumerate(read_line_chunks(filenames, chunksize)):
+            pending.append(pool.apply_async(_sort_run, ((runid, chunk),)))
+            if len(pending) >= 2 * threads:
+                runs.append(pending.popleft().get())
+        while pending:
+            runs.append(pending.popleft().get())
+        logging.info("Time reading and sorting %d runs: %.1fs", len(runs),
+                time.time() - start)
+        start = time.time()
+        if len(chains([r[0] for r in runs])) == 1:
+            logging.info("Sorted runs continue each other; concatenating them")
+            copy_runs([r[0] for r in runs], outfile)
+            jobs = []
+        else:
+            logging.info("Merging runs of %d chromosomes", len(chroms.chromosomes))
+            jobs = []
+            for i in xrange(len(chroms.chromosomes)):
+                parts = [(run, runid, lb[i], lb[i + 1], bb[i])
+                        for runid, (run, lb, bb) in enumerate(runs) if lb[i + 1] > lb[i]]
+                if parts:
+                    jobs.append((i, parts, merge_block(chunksize, len(parts))))
+        for path in pool.imap(_merge_chrom, jobs):
+            with open(path, "rb") as merged:
+                for data in iter(lambda: merged.read(WRITESIZE), ""):
+                    outfile.write(data)
+            os.unlink(path)
+        logging.info("Time merging: %.1fs", time.time() - start)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+#===============================================================================
+# presorted input
+#===============================================================================
+
+def read_keyed(filename, chroms): # this is a generator function
+    """yields blocks of (keys, lines) of a file"""
+    for lines, _, _ in read_lines([filename], WRITESIZE):
+        yield line_keys(lines, chroms), lines
+
+def check_sorted(filenames, chroms):
+    """returns the 1-based number of the first line (counted across all
+    inputs) that is out of order; None if the input is sorted"""
+    last, n = None, 0
+    for filename in filenames:
+        for keys, lines in read_keyed(filename, chroms):
+            if last is not None and keys[0] < last:
+                return n + 1
+            if not is_sorted(keys):
+                return n + int(numpy.flatnonzero(keys[1:] < keys[:-1])[0]) + 2
+            last = keys[-1]
+            n   += len(lines)
+    return None
+
+def _sorted_input(filename, fileid, chroms): # this is a generator function
+    """yields (key, fileid, line) of a sorted file; raises ValueError if the
+    file is not sorted"""
+    last, n = None, 0
+    for keys, lines in read_keyed(filename, chroms):
+        if last is not None and keys[0] < last or not is_sorted(keys):
+            raise ValueError("%s is not sorted (near line %d); run without --merge"
+                    % (filename, n + 1))
+        last = keys[-1]
+        n   += len(lines)
+        for rec in izip(keys.tolist(), repeat(fileid), lines):
+            yield rec
+
+def merge_sorted(filenames, outfile, chroms):
+    """streaming k-way merge of sorted files"""
+    start = time.time()
+    merge_runs([_sorted_input(f, i, chroms) for i, f in enumerate(filenames)],
+            outfile)
+    logging.info("Time merging %d files: %.1fs", len(filenames), time.time() - start)
 
 def sort_bed(args):
     """sort bed-like file by chrom and start pos"""
     try:
-        chroms = getattr(genome, args.genome)
-    except AttributeError:
-        logging.error("Genome %s not available", args.genome)
+        chroms = genome.load(args.genome)
+    except (ValueError, IOError), e:
+        logging.error(e)
         sys.exit(1)
-   
-    sortproc = start_unix_sort(args.S)
-    sortproc.next()
-
-    outlst = []
-    n      = 0
-    out    = "{0}\t{1}"
-    logging.info("Start feeding sort")
-    with FileOrGzip(args.infile) as fh:
-        for line in fh:
-            chrom, pos, _ = line.split("\t", 2)
-            outlst.append(out.format(chroms.cpos(chrom, long(pos)), line))
-            n += 1
-            if n == 100000:
-                sortproc.send("".join(outlst))
-                outlst = []
-                n      = 0
-    sortproc.send("".join(outlst))
-    sortproc.close()
-    logging.info("Done feeding sort; Waiting for sort to finish")
+    if args.check:
+        try:
+            lineno = check_sorted(args.infile, chroms)
+        except ValueError, e:
+            logging.error(e)
+            sys.exit(1)
+        if lineno is not None:
+            logging.info("Input is not sorted: line %d is out of order", lineno)
+            sys.exit(1)
+        logging.info("Input is sorted")
+        return
+    # in parallel mode, threads workers sort chunks while the text of up to
+    # 2 * threads chunks (about a third of their memory) waits for them
+    chunksize = max(args.S // (args.threads > 1 and 2 * args.threads or 1),
+            1024 * 1024)
+    tmpdir    = None
+    try:
+        with output_file(args) as outfile:
+            if args.merge:
+                merge_sorted(args.infile, outfile, chroms)
+                return
+            tmpdir = tempfile.mkdtemp(prefix = "bed-sort.", dir = args.T)
+            if args.threads > 1:
+                sort_parallel(args.infile, outfile, chroms, chunksize, tmpdir,
+                        args.threads)
+            else:
+                sort_serial(args.infile, outfile, chroms, chunksize, tmpdir)
+    except ValueError, e:
+        logging.error(e)
+        sys.exit(1)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors = True)
 
 #===============================================================================
 # interface
@@ -85,12 +456,27 @@ def setup(commands):
             formatter_class = argparse.RawDescriptionHelpFormatter,
             description     = __doc__)
     cmdline.add_argument("infile", type = arghelpers.infilename_check,
-            help = "Input bed file to be sorted; can be gzip'ed")
+            nargs = "+",
+            help = "Input bed file(s) to be sorted; can be gzip'ed")
     cmdline.add_argument("genome",
-            choices = ["mm9", "hg19", "hg18"],
-            help = "Input bed file to be sorted")
-    cmdline.add_argument("-S", default = "1G",
-            help = """memory size; passed on to external unix sort; see 'man
-            sort'; [%(default)s]""")
+            help = """Genome defining the chromosome sort order: a built-in
+            genome (%s), or a chrom.sizes, .fai or BAM file whose chromosome
+            order is used""" % ", ".join(sorted(genome.BUILTIN)))
+    cmdline.add_argument("-S", default = "1G", type = arghelpers.memory_size,
+            help = """memory size; a number followed by b, K, M, G or T, or
+            by %% for a percentage of the physical memory, as for unix sort
+            (K if there is no suffix) [%(default)s]""")
+    cmdline.add_argument("-T", default = None, type = arghelpers.check_or_make_dir,
+            help = """Directory for temporary files [system temp dir]""")
+    cmdline.add_argument("-p", "--threads", type = int, default = 1,
+            help = """Number of processes sorting runs and merging
+            chromosomes [%(default)s]""")
+    mode = cmdline.add_mutually_exclusive_group()
+    mode.add_argument("-m", "--merge", action = "store_true", default = False,
+            help = """Merge input files that are each sorted already; memory
+            use is bounded by the number of input files""")
+    mode.add_argument("-c", "--check", action = "store_true", default = False,
+            help = """Only check whether the input is sorted; exit status is
+            1 if it is not""")
+    arghelpers.add_output_options(cmdline)
     cmdline.set_defaults(func = sort_bed)
-
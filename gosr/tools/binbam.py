@@ -3,130 +3,593 @@
 """
 Calculate density of reads in bins across the genome from bam file.
 Output units:  RPKM
-Output format: Bedgraph
+Output format: wiggle (variableStep), bedGraph or bigWig (--format)
 
 * Input sort order does matter
-* Output goes to stdout
+* Output goes to stdout or the file given with -o
+* Bins are allocated in chunks as reads are found in them, so memory use
+  scales with the covered part of the genome
+* With --threads, an indexed bam file is split into regions that are counted
+  in parallel; the result is the same as counting serially
+* With --format matrix, any number of bam files with the same references are
+  counted by a pool of processes into one genome wide bins x samples matrix
+  of raw counts, saved with per sample RPKM factors and the chromosome layout
+  (names, sizes and first row of each chromosome)
+* Several bin sizes can be counted in one pass (e.g. 25,100,1000); the
+  larger sizes are sums of the bins of the smallest one
+* Raw counts are cached per bam file and counting parameters, so changing
+  smoothing, track name or output format does not re-read the bam file; the
+  cached counts are discarded when the bam file changes (--no-cache).  The
+  cache keeps about 5 bytes per non-zero bin and is limited in size
+  ($GOSR_CACHE_SIZE, see gosr.common.cache)
 * Currently ignores chrM and gapped or local alignemts (where the
   aligned length is not the same as the read length).
 
 TODO: handle gapped/local alignments?
-TODO: variable size binning
 """
 
+import os
+import re
+import json
 import argparse
 import logging
 import sys
 import itertools
+import multiprocessing
 import numpy
 import pysam
 
 from gosr.common import arghelpers
+from gosr.common import bam as bamsplit
+from gosr.common import cache
 from gosr.common import dsp
+from gosr.common.bins import ChunkedBins
+from gosr.common.bigwig import BigWigWriter
+from gosr.common.file import FileOrGzipWriter
 
 
-def make_bins(chrominfo, binsize, by_strand):
-    """create a dictionary with one array of bins per chromosome"""
+def make_bins(chrominfo, binsize, by_strand, dtype = numpy.int32):
+    """create a dictionary with one lazily allocated ChunkedBins per
+    chromosome (two if by_strand); integer chunks of dtype are widened when
+    they overflow"""
     result = {}
     for name, l in chrominfo.items():
         n_bins = l // binsize  #reads in last bin are discarded
         if not by_strand:
-            result[name] = numpy.zeros(n_bins, dtype = numpy.int32)
+            result[name] = ChunkedBins(n_bins, dtype)
         else:
-            result[name] = [numpy.zeros(n_bins, dtype = numpy.int32),
-                            numpy.zeros(n_bins, dtype = numpy.int32)]
+            result[name] = [ChunkedBins(n_bins, dtype), ChunkedBins(n_bins, dtype)]
     return result
 
-def binbam(bamfile, binsize, fragsize, chrominfo, n_redundancy, by_strand):
-    """count aligned reads per bin in bamfile; *bamfile needs to be sorted*"""
-    bins = make_bins(chrominfo, binsize, by_strand)
-    n_aln   = 0
-    n_rmred = 0
-    n_igno  = 0
-    shift   = fragsize / 2
-    for _, alns in itertools.groupby(bamfile, lambda x: (x.tid, x.pos)):
-        # split up into plus and minus strand
-        all_alns = [x for x in alns if not x.is_unmapped]
-        n_aln   += len(all_alns)
-        plus     = [x for x in all_alns if not x.is_reverse][0:n_redundancy]
-        minus    = [x for x in all_alns if x.is_reverse][0:n_redundancy]
-        for aln in itertools.chain(plus, minus):
-            chrom = bamfile.getrname(aln.tid)
-            if chrom == "chrM":
-                n_igno += 1
-                continue
-            n_rmred += 1
-            if aln.alen != aln.rlen:
-                logging.debug("Not a end-to-end alignment, or alignment gapped")
-                logging.debug(str(aln))
-                n_igno += 1
-                continue
-            if not aln.is_reverse:
-                bin_nr = (aln.pos + shift) // binsize
+BLOCKSIZE = 65536 # alignments converted to arrays at a time
+
+def _count_block(block, is_chrm, bins, binsize, shift, n_redundancy, by_strand,
+        references):
+    """count a block of alignments given as rows of (tid, pos, flag, alen,
+    rlen); the block has to consist of complete (tid, pos) groups.  Returns
+    the counters as in count_alignments"""
+    tid, pos, flag, alen, rlen = block.T
+    mapped = (flag & 4) == 0
+    n_aln  = int(mapped.sum())
+    # rank of each mapped alignment within its (tid, pos, strand) group
+    new_group = numpy.ones(len(tid), dtype = bool)
+    new_group[1:] = (tid[1:] != tid[:-1]) | (pos[1:] != pos[:-1])
+    group     = numpy.cumsum(new_group)[mapped]
+    reverse   = (flag[mapped] & 16) != 0
+    key       = group * 2 + reverse
+    order     = numpy.argsort(key, kind = "mergesort")
+    skey      = key[order]
+    first     = numpy.ones(len(skey), dtype = bool)
+    first[1:] = skey[1:] != skey[:-1]
+    idx       = numpy.arange(len(skey))
+    rank      = numpy.empty(len(skey), dtype = numpy.int64)
+    rank[order] = idx - numpy.maximum.accumulate(numpy.where(first, idx, 0))
+    keep      = rank < n_redundancy
+    # chrM is ignored and not counted towards the normalization
+    tid, pos, alen, rlen = tid[mapped][keep], pos[mapped][keep], \
+            alen[mapped][keep], rlen[mapped][keep]
+    reverse   = reverse[keep]
+    chrm      = is_chrm[tid]
+    n_igno    = int(chrm.sum())
+    n_rmred   = len(tid) - n_igno
+    # gapped or clipped alignments are ignored
+    ok        = ~chrm & (alen == rlen)
+    n_gapped  = n_rmred - int(ok.sum())
+    if n_gapped:
+        logging.debug("Ignored %d alignments that are gapped or not end-to-end",
+                n_gapped)
+    n_igno   += n_gapped
+    tid, pos, alen, reverse = tid[ok], pos[ok], alen[ok], reverse[ok]
+    n_aln    += len(tid)
+    bin_nr    = numpy.where(reverse, pos + alen - 1 - shift, pos + shift) // binsize
+    for t in numpy.unique(tid):
+        chrom = references[t]
+        for strand in (by_strand and (0, 1) or (None,)):
+            sel = tid == t
+            if strand is not None:
+                sel &= reverse == bool(strand)
+                target = bins[chrom][strand]
             else:
-                bin_nr = (aln.aend - 1 - shift) // binsize
-            n_aln += 1
-            try:
-                if not by_strand:
-                    bins[chrom][bin_nr] += 1
-                elif not aln.is_reverse:
-                    bins[chrom][0][bin_nr] += 1
-                else:
-                    bins[chrom][1][bin_nr] += 1
-            except IndexError:
-                logging.debug("BIN OUT OF RANGE: %s: pos[%d] -> bin[%d]", chrom, aln.pos, bin_nr)
-    # normalization factor
+                target = bins[chrom]
+            b = bin_nr[sel]
+            # negative bins count from the end like python indices
+            n_bins = len(target)
+            valid  = (b >= -n_bins) & (b < n_bins)
+            if not valid.all():
+                logging.debug("%d bins out of range on %s", (~valid).sum(), chrom)
+                b = b[valid]
+            b[b < 0] += n_bins
+            if len(b):
+                lo     = b.min()
+                counts = numpy.bincount(b - lo)
+                nz     = numpy.flatnonzero(counts)
+                target.add(nz + lo, counts[nz])
+    return n_aln, n_rmred, n_igno
+
+def count_alignments(alns, references, bins, binsize, fragsize, n_redundancy,
+        by_strand):
+    """count alignments from a sorted iterable of alignments into bins;
+    returns the number of aligned reads, of reads after removing redundancy
+    and of ignored reads.  Alignments are converted to arrays in blocks
+    (see gosr.common.bam.alignment_arrays) and counted with numpy;
+    at most n_redundancy alignments per position and strand are counted"""
+    is_chrm = numpy.array([r == "chrM" for r in references] + [False])
+    shift   = fragsize / 2
+    totals  = numpy.zeros(3, dtype = numpy.int64)
+    carry   = numpy.zeros((0, 5), dtype = numpy.int64)
+    blocks  = bamsplit.alignment_arrays(alns, BLOCKSIZE)
+    while True:
+        rows = next(blocks, None)
+        if rows is None:
+            block, carry = carry, None
+        else:
+            block = numpy.vstack((carry, rows))
+            # keep the last (tid, pos) group for the next block
+            change = numpy.flatnonzero((block[1:, 0] != block[:-1, 0]) |
+                    (block[1:, 1] != block[:-1, 1]))
+            k = len(change) and change[-1] + 1 or 0
+            block, carry = block[:k], block[k:]
+        if len(block):
+            totals += _count_block(block, is_chrm, bins, binsize, shift,
+                    n_redundancy, by_strand, references)
+        if carry is None:
+            return tuple(totals.tolist())
+
+def log_counts(n_aln, n_rmred, n_igno, binsize):
+    """log counts and return the normalization factor"""
     rpkm_factor = (1e6 / n_rmred) * (1000.0 / binsize)
     logging.info("Aligned reads:                %8d", n_aln)
     logging.info(" after removing redundancy:   %8d", n_rmred)
     logging.info(" normalization factor:        %f", rpkm_factor)
     logging.info("Ignored reads:                %8d", n_igno)
-    return bins, rpkm_factor
+    return rpkm_factor
+
+def binbam(bamfile, binsize, fragsize, chrominfo, n_redundancy, by_strand,
+        dtype = numpy.int32):
+    """count aligned reads per bin in bamfile; *bamfile needs to be sorted*"""
+    bins = make_bins(chrominfo, binsize, by_strand, dtype)
+    n_aln, n_rmred, n_igno = count_alignments(bamfile, bamfile.references,
+            bins, binsize, fragsize, n_redundancy, by_strand)
+    return bins, log_counts(n_aln, n_rmred, n_igno, binsize)
+
+#===============================================================================
+# region parallel binning of indexed bam files
+#===============================================================================
+
+REGIONSIZE = 20000000 # chromosomes are split into regions of this size
+
+_worker = {}
+
+def _init_worker(filename, binsize, fragsize, n_redundancy, by_strand, dtype):
+    _worker["bam"]  = pysam.Samfile(filename, "rb")
+    _worker["args"] = (binsize, fragsize, n_redundancy, by_strand, dtype)
+
+def _bin_region(region):
+    """pool worker: count the alignments starting in a region into bins for
+    its whole chromosome; returns the chromosome, the counters and the
+    non-zero bins as (indices, counts) per strand (or one pair)"""
+    chrom, length, start, end = region
+    binsize, fragsize, n_redundancy, by_strand, dtype = _worker["args"]
+    bam  = _worker["bam"]
+    bins = make_bins({chrom: length}, binsize, by_strand, dtype)
+    alns = (a for a in bam.fetch(chrom, start, end) if start <= a.pos < end)
+    counts = count_alignments(alns, bam.references, bins, binsize, fragsize,
+            n_redundancy, by_strand)
+    stores = by_strand and bins[chrom] or [bins[chrom]]
+    return chrom, counts, [b.nonzero() for b in stores]
+
+def regions(chrominfo, size = REGIONSIZE):
+    """(chrom, length, start, end) tuples covering all chromosomes"""
+    return [(chrom, length, start, min(start + size, length))
+            for chrom, length in chrominfo
+            for start in xrange(0, length, size)]
+
+def binbam_parallel(filename, binsize, fragsize, chrominfo, n_redundancy,
+        by_strand, threads, dtype = numpy.int32):
+    """binbam with the regions of an indexed bam file counted by a pool of
+    processes; the result is identical to binbam"""
+    bins = make_bins(dict(chrominfo), binsize, by_strand, dtype)
+    jobs = regions(chrominfo)
+    logging.info("Binning %d regions with %d processes", len(jobs), threads)
+    pool = multiprocessing.Pool(threads, _init_worker,
+            (filename, binsize, fragsize, n_redundancy, by_strand, dtype))
+    totals = numpy.zeros(3, dtype = numpy.int64)
+    try:
+        for chrom, counts, arrays in pool.imap_unordered(_bin_region, jobs):
+            totals += counts
+            targets = by_strand and bins[chrom] or [bins[chrom]]
+            for target, (idx, n) in zip(targets, arrays):
+                target.add(idx, n)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return bins, log_counts(*(totals.tolist() + [binsize]))
+
+#===============================================================================
+# cache of raw counts
+#===============================================================================
+
+def cache_entry(filename, binsize, fragsize, n_redundancy, by_strand):
+    """path (without extension) of the count cache entry of a bam file for
+    the given counting parameters; None if caching is disabled.  An entry
+    consists of two .npy files with the bin numbers (.idx.npy) and counts
+    (.cnt.npy) of all non-zero bins, grouped by chromosome and strand and in
+    the narrowest type that fits, which are memory mapped when read, and a
+    .json file of metadata with the offset of each group that is written
+    last"""
+    return cache.entry_path("binbam-%d-%d-%d-%d" % (binsize, fragsize,
+        n_redundancy, by_strand), filename, stamped = False)
+
+def _narrow(values, types):
+    """values as the first integer type of types that can hold them"""
+    top = len(values) and int(values.max()) or 0
+    for t in types:
+        if top <= numpy.iinfo(t).max:
+            return values.astype(t, copy = False)
+
+def save_counts(path, filename, bins, chrominfo, rpkm_factor, params):
+    """write the raw counts of bins to the cache entry path"""
+    by_strand = params["by_strand"]
+    idx, cnt  = [numpy.zeros(0, dtype = numpy.int64)], [numpy.zeros(0, dtype = numpy.int64)]
+    offsets   = [0]
+    for chrom, _ in chrominfo:
+        for store in by_strand and bins[chrom] or [bins[chrom]]:
+            i, n = store.nonzero()
+            idx.append(i)
+            cnt.append(n)
+            offsets.append(offsets[-1] + len(i))
+    idx  = _narrow(numpy.concatenate(idx), (numpy.uint32, numpy.int64))
+    cnt  = _narrow(numpy.concatenate(cnt), (numpy.uint8, numpy.uint16,
+        numpy.uint32, numpy.int64))
+    meta = dict(params, source = os.path.abspath(filename),
+            stamp = cache.source_stamp(filename), chroms = chrominfo,
+            rpkm_factor = rpkm_factor, offsets = offsets)
+    cache.write_atomic(path + ".idx.npy", lambda fh: numpy.save(fh, idx))
+    cache.write_atomic(path + ".cnt.npy", lambda fh: numpy.save(fh, cnt))
+    cache.write_atomic(path + ".json", lambda fh: json.dump(meta, fh))
+
+def _load_mapped(path):
+    """array in .npy file path, memory mapped unless it is empty (which
+    can not be mapped)"""
+    try:
+        return numpy.load(path, mmap_mode = "r")
+    except ValueError:
+        return numpy.load(path)
+
+def load_counts(path, filename, chrominfo, params, dtype = numpy.int32):
+    """bins and normalization factor from the cache entry path; None if
+    there is no usable entry.  Stale entries (the bam file changed) are
+    removed"""
+    files = [path + ".json", path + ".idx.npy", path + ".cnt.npy"]
+    try:
+        with open(files[0]) as fh:
+            meta = json.load(fh)
+        idx     = _load_mapped(files[1])
+        cnt     = _load_mapped(files[2])
+        factor  = meta["rpkm_factor"]
+        offsets = meta["offsets"]
+        stale   = cache.is_stale(filename, meta["stamp"]) or \
+                len(idx) != len(cnt) or len(idx) != offsets[-1] or \
+                [tuple(c) for c in meta["chroms"]] != list(chrominfo) or \
+                any(meta[k] != v for k, v in params.items())
+    except (IOError, ValueError, KeyError, IndexError), e:
+        # KeyError: an entry written by an older version
+        logging.debug("no usable count cache entry %s: %s", path, e)
+        return None
+    if stale:
+        logging.info("Cached counts of %s are out of date; recounting", filename)
+        cache.remove(*files)
+        return None
+    cache.touch(*files)
+    by_strand = params["by_strand"]
+    bins      = make_bins(dict(chrominfo), params["binsize"], by_strand, dtype)
+    stores    = [s for c, _ in chrominfo for s in by_strand and bins[c] or [bins[c]]]
+    # the mapped arrays are added to the bins without an intermediate copy
+    for store, s, e in zip(stores, offsets[:-1], offsets[1:]):
+        store.add(idx[s:e], cnt[s:e])
+    logging.info("Using cached counts of %s (normalization factor %f)", filename,
+            factor)
+    return bins, factor
+
+#===============================================================================
+# count matrix of several bam files
+#===============================================================================
+
+def rpkm_factor(n_rmred, binsize):
+    """reads per kb per million factor; 0 counted reads give the factor of
+    1 read"""
+    return (1e6 / max(n_rmred, 1)) * (1000.0 / binsize)
+
+def _init_sample_worker(binsize, fragsize, n_redundancy, by_strand, dtype, sg):
+    _worker["args"] = (binsize, fragsize, n_redundancy, by_strand, dtype, sg)
+
+def _bin_sample(filename):
+    """pool worker: count (and smooth) all alignments of a bam file; returns
+    the file name, the counters and the non-zero bins of each chromosome as
+    (indices, values) per strand (or one pair)"""
+    binsize, fragsize, n_redundancy, by_strand, dtype, sg = _worker["args"]
+    bam = pysam.Samfile(filename, "rb")
+    try:
+        bins = make_bins(dict(zip(bam.references, bam.lengths)), binsize,
+                by_strand, dtype)
+        counts = count_alignments(bam, bam.references, bins, binsize, fragsize,
+                n_redundancy, by_strand)
+    finally:
+        bam.close()
+    if sg > 0:
+        smooth(bins, sg, by_strand, numpy.float32)
+    return filename, counts, dict((chrom, [b.nonzero() for b in
+        (by_strand and stores or [stores])]) for chrom, stores in bins.items())
+
+def matrix_layout(chrominfo, binsize):
+    """number of bins of each chromosome and the row of its first bin in the
+    genome wide matrix; chromosomes are in the given (bam header) order"""
+    n_bins  = numpy.array([l // binsize for _, l in chrominfo], dtype = numpy.int64)
+    offsets = numpy.zeros(len(n_bins), dtype = numpy.int64)
+    numpy.cumsum(n_bins[:-1], out = offsets[1:])
+    return n_bins, offsets
+
+def open_matrix(filename, shape, dtype):
+    """the count matrix; memory mapped if filename ends in .npy"""
+    if filename.endswith(".npy"):
+        return numpy.lib.format.open_memmap(filename, mode = "w+", dtype = dtype,
+                shape = shape)
+    return numpy.zeros(shape, dtype = dtype)
 
-def output_wiggle(bins, binsize, norm_factor, by_strand, name, extra_trackline = ""):
-    """write all non-empty bins to bedgraph format strings; always includes
+def save_matrix(filename, counts, meta):
+    """write the matrix and its metadata: a compressed .npz with one array
+    per metadata field, or a .npy (already written by open_matrix) with a
+    .json file of the metadata next to it"""
+    if isinstance(counts, numpy.memmap):
+        counts.flush()
+        with open(re.sub(r"\.npy$", "", filename) + ".json", "w") as fh:
+            json.dump(dict((k, numpy.asarray(v).tolist()) for k, v in meta.items()),
+                    fh, indent = 1)
+    else:
+        with open(filename, "wb") as fh:
+            numpy.savez_compressed(fh, counts = counts, **meta)
+
+def binbam_matrix(filenames, outfile, binsize, fragsize, chrominfo, n_redundancy,
+        by_strand, threads, sg):
+    """count each bam file in a pool of processes into one column of a
+    genome wide (bins x samples) matrix; with by_strand the matrix has a
+    third axis for the strands.  chrominfo is the (name, length) list shared
+    by all files"""
+    n_bins, offsets = matrix_layout(chrominfo, binsize)
+    row    = dict((c, o) for (c, _), o in zip(chrominfo, offsets))
+    column = dict((f, i) for i, f in enumerate(filenames))
+    shape  = (int(n_bins.sum()), len(filenames)) + (by_strand and (2,) or ())
+    counts = open_matrix(outfile, shape, sg > 0 and numpy.float32 or numpy.int32)
+    totals = numpy.zeros((len(filenames), 3), dtype = numpy.int64)
+    params = (binsize, fragsize, n_redundancy, by_strand, numpy.int32, sg)
+    if threads > 1:
+        pool    = multiprocessing.Pool(threads, _init_sample_worker, params)
+        results = pool.imap_unordered(_bin_sample, filenames)
+    else:
+        pool    = None
+        _init_sample_worker(*params)
+        results = itertools.imap(_bin_sample, filenames)
+    try:
+        for filename, n, arrays in results:
+            col = column[filename]
+            totals[col] = n
+            logging.info("Binned %s: %d aligned reads, %d after removing "
+                    "redundancy", filename, n[0], n[1])
+            for chrom, strands in arrays.items():
+                for strand, (idx, values) in enumerate(strands):
+                    target = by_strand and (idx + row[chrom], col, strand) or \
+                            (idx + row[chrom], col)
+                    counts[target] = values
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    meta = {"samples":       numpy.array(filenames),
+            "rpkm_factors":  numpy.array([rpkm_factor(n, binsize) for n in totals[:, 1]]),
+            "n_aligned":     totals[:, 0],
+            "n_rmred":       totals[:, 1],
+            "n_ignored":     totals[:, 2],
+            "chroms":        numpy.array([c for c, _ in chrominfo]),
+            "chrom_sizes":   numpy.array([l for _, l in chrominfo], dtype = numpy.int64),
+            "chrom_offsets": offsets,
+            "binsize":       binsize,
+            "frag_size":     fragsize,
+            "n_redundancy":  n_redundancy,
+            "by_strand":     by_strand,
+            "sg":            sg}
+    save_matrix(outfile, counts, meta)
+    return shape
+
+def process_matrix(args):
+    """driver for --format matrix"""
+    if args.output == "-" or "-" in args.infile:
+        logging.error("matrix output needs bam files and an output file (-o)")
+        sys.exit(1)
+    if len(set(args.infile)) != len(args.infile):
+        logging.error("bam files given more than once")
+        sys.exit(1)
+    chrominfo = None
+    for filename in args.infile:
+        bam  = pysam.Samfile(filename, "rb")
+        info = zip(bam.references, bam.lengths)
+        bam.close()
+        if chrominfo is None:
+            chrominfo = info
+        elif info != chrominfo:
+            logging.error("References of %s differ from %s", filename, args.infile[0])
+            sys.exit(1)
+    threads = max(1, min(args.threads, len(args.infile)))
+    logging.info("Binning %d bam files with %d processes", len(args.infile), threads)
+    shape = binbam_matrix(args.infile, args.output, args.binsize, args.frag_size,
+            chrominfo, args.n_redundancy, args.by_strand, threads, args.sg)
+    logging.info("DONE (%s matrix written to %s)", " x ".join(map(str, shape)),
+            args.output)
+
+TRACKLINE = "track type=%s alwaysZero=on visibility=full maxHeightPixels=100:80:50 "
+TEXTROWS  = 100000 # rows formatted at a time
+
+def format_rows(fmt, *columns): # this is a generator function
+    """yields the rows of columns formatted with fmt (a format string for
+    one row) as text; each block of TEXTROWS rows is formatted with a single
+    string operation"""
+    m = len(columns)
+    for i in xrange(0, len(columns[0]), TEXTROWS):
+        cols = [c[i:i + TEXTROWS].tolist() for c in columns]
+        flat = [None] * (len(cols[0]) * m)
+        for j, col in enumerate(cols):
+            flat[j::m] = col
+        yield (fmt * len(cols[0])) % tuple(flat)
+
+def tracks(bins, norm_factor, by_strand, name):
+    """(track name, {chrom: bins}, normalization factor) of each track; with
+    by_strand, the minus strand track has negative values"""
+    if not by_strand:
+        return [(name, bins, norm_factor)]
+    return [("%s[%s]" % (name, strand and "-" or "+"),
+             dict((chrom, b[strand]) for chrom, b in bins.items()),
+             strand and -norm_factor or norm_factor) for strand in (0, 1)]
+
+def nonzero_bins(store, binsize, norm_factor):
+    """0-based starts and normalized values of bins with positive counts"""
+    idx, counts = store.nonzero()
+    pos = counts > 0
+    return idx[pos] * binsize, counts[pos] * norm_factor
+
+def output_wiggle(out, bins, binsize, norm_factor, by_strand, name, extra_trackline = ""):
+    """write all non-empty bins to out in wiggle format; always includes
     minimal track line; Output is in 1-based wiggle format."""
+    for track, stores, nf in tracks(bins, norm_factor, by_strand, name):
+        out.write(TRACKLINE % "wiggle_0" + ("name='%s'" % track) + extra_trackline + "\n")
+        for chrom in sorted(stores.keys()):
+            out.write("variableStep chrom=%s span=%d\n" % (chrom, binsize))
+            starts, values = nonzero_bins(stores[chrom], binsize, nf)
+            for text in format_rows("%d\t%.8f\n", starts + 1, values):
+                out.write(text)
+
+def output_bedgraph(out, bins, binsize, norm_factor, by_strand, name, extra_trackline = ""):
+    """write all non-empty bins to out in bedgraph format (0-based, half
+    open) with a minimal track line per track"""
+    for track, stores, nf in tracks(bins, norm_factor, by_strand, name):
+        out.write(TRACKLINE % "bedGraph" + ("name='%s'" % track) + extra_trackline + "\n")
+        for chrom in sorted(stores.keys()):
+            starts, values = nonzero_bins(stores[chrom], binsize, nf)
+            fmt = chrom.replace("%", "%%") + "\t%d\t%d\t%.8f\n"
+            for text in format_rows(fmt, starts, starts + binsize, values):
+                out.write(text)
+
+def bigwig_names(filename, by_strand):
+    """output file names; with by_strand, one file per strand named
+    <base>.plus.bw and <base>.minus.bw"""
     if not by_strand:
-        print "track type=wiggle_0 alwaysZero=on visibility=full maxHeightPixels=100:80:50 " \
-                + ("name='%s'" % name) + extra_trackline
-        for chrom in sorted(bins.keys()):
-            print "variableStep chrom=%s span=%d" % (chrom, binsize)
-            non_zero_bins = numpy.nonzero(bins[chrom] > 0)
-            result = numpy.column_stack((non_zero_bins[0] * binsize + 1,
-                bins[chrom][non_zero_bins] * norm_factor))
-            numpy.savetxt(sys.stdout, result, "%d\t%.8f")
-    else:
-        for strand in (0, 1):
-            if strand == 0:
-                nf = norm_factor
-            else:
-                nf = -norm_factor
-            print "track type=wiggle_0 alwaysZero=on visibility=full maxHeightPixels=100:80:50 " \
-                    + ("name='%s[%s]'" % (name, strand and '-' or '+')) + extra_trackline
-            for chrom in sorted(bins.keys()):
-                print "variableStep chrom=%s span=%d" % (chrom, binsize)
-                non_zero_bins = numpy.nonzero(bins[chrom][strand] > 0)
-                result = numpy.column_stack((non_zero_bins[0] * binsize + 1,
-                    bins[chrom][strand][non_zero_bins] * nf))
-                numpy.savetxt(sys.stdout, result, "%d\t%.8f")
-
-def smooth(bins, window_size, by_strand):
+        return [filename]
+    base = re.sub(r"\.(bw|bigwig)$", "", filename, flags = re.I)
+    return [base + ".plus.bw", base + ".minus.bw"]
+
+def output_bigwig(filename, bins, chrominfo, binsize, norm_factor, by_strand, name,
+        zooms = None):
+    """write all non-empty bins to bigwig file(s); zooms are the zoom levels
+    in bases (chosen by the writer by default)"""
+    for fn, (track, stores, nf) in zip(bigwig_names(filename, by_strand),
+            tracks(bins, norm_factor, by_strand, name)):
+        logging.info("Writing track %s to %s", track, fn)
+        with BigWigWriter(fn, chrominfo.items(), binsize, zooms) as bw:
+            for chrom in stores:
+                bw.add(chrom, *nonzero_bins(stores[chrom], binsize, nf))
+
+def smooth(bins, window_size, by_strand, dtype = numpy.float64):
+    """savitzky-golay filter the covered ranges of each chromosome; ranges
+    are smoothed in place in blocks, and the result is stored as dtype"""
+    sg = lambda y: dsp.savitzky_golay_blocks(y, window_size, order = 2, deriv = 0,
+            out = y)
     for chrom in bins:
         if not by_strand:
-            bins[chrom] = dsp.savitzky_golay_filter(bins[chrom], window_size, 
-                    order = 2, deriv = 0)
+            bins[chrom] = bins[chrom].filtered(sg, window_size // 2, dtype)
         else:
-            bins[chrom][0] = dsp.savitzky_golay_filter(bins[chrom][0], window_size, 
-                    order = 2, deriv = 0)
-            bins[chrom][1] = dsp.savitzky_golay_filter(bins[chrom][1], window_size, 
-                    order = 2, deriv = 0)
+            bins[chrom][0] = bins[chrom][0].filtered(sg, window_size // 2, dtype)
+            bins[chrom][1] = bins[chrom][1].filtered(sg, window_size // 2, dtype)
+
+def aggregate(bins, chrominfo, binsize, factor, by_strand):
+    """bins summed over groups of factor bins; the result is the same as
+    counting with binsize * factor, except for reads before the start of a
+    chromosome, which are counted at the end of the chromosome in both"""
+    result = {}
+    for chrom, stores in bins.items():
+        n_bins = chrominfo[chrom] // (binsize * factor)
+        if not by_strand:
+            result[chrom] = stores.aggregated(factor, n_bins)
+        else:
+            result[chrom] = [s.aggregated(factor, n_bins) for s in stores]
+    return result
+
+def resolution_names(filename, binsizes):
+    """output file name of each binsize; <base>.<binsize>bp.<ext> if there
+    is more than one"""
+    if len(binsizes) == 1:
+        return [filename]
+    base, ext = os.path.splitext(filename)
+    if ext == ".gz":
+        base, ext = os.path.splitext(base)
+        ext      += ".gz"
+    return ["%s.%dbp%s" % (base, b, ext) for b in binsizes]
 
 ################################################################################
 # tool interface
 ################################################################################
+def binsizes(s):
+    """sorted list of comma separated bin sizes; coarser sizes have to be
+    multiples of the finest one"""
+    try:
+        sizes = sorted(set(int(b) for b in s.split(",")))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid bin size(s): %s" % s)
+    if sizes[0] < 1 or any(b % sizes[0] for b in sizes):
+        raise argparse.ArgumentTypeError("Bin sizes have to be positive "
+                "multiples of the smallest bin size: %s" % s)
+    return sizes
+
 def process(args):
     """pipeline driver"""
 
+    sizes, args.binsize = args.binsize, args.binsize[0]
+    if len(sizes) > 1 and args.format == "matrix":
+        logging.error("matrix output takes a single bin size")
+        sys.exit(1)
+    if args.format == "matrix":
+        process_matrix(args)
+        return
+    if len(args.infile) > 1:
+        logging.error("Several bam files can only be binned with --format matrix")
+        sys.exit(1)
+    args.infile = args.infile[0]
+    if args.format == "bigwig" and args.output == "-":
+        logging.error("bigwig output needs an output file (-o)")
+        sys.exit(1)
+    if len(sizes) > 1 and args.output == "-":
+        logging.error("Several bin sizes need an output file (-o)")
+        sys.exit(1)
     bamfile   = pysam.Samfile(args.infile, "rb")
     try:
         chrominfo = dict(zip(bamfile.references, bamfile.lengths))
@@ -142,16 +605,62 @@ def process(args):
     logging.info("Track line extra options: \"%s\"", args.track_line)
     if args.sg > 0:
         logging.info("Smoothing output with savitzky-golay filter, order 2, width %d bins", args.sg)
+    threads = args.threads
+    dtype   = args.compact and numpy.uint16 or numpy.int32
+    if threads > 1 and args.infile == "-":
+        logging.warn("Reading from stdin; --threads needs an indexed bam file")
+        threads = 1
+    elif threads > 1:
+        try:
+            bamfile.fetch(bamfile.references[0], 0, 1)
+        except (ValueError, IOError):
+            logging.warn("No index found for %s; counting serially", args.infile)
+            threads = 1
+    header = zip(bamfile.references, bamfile.lengths)
+    params = {"binsize": args.binsize, "frag_size": args.frag_size,
+              "n_redundancy": args.n_redundancy, "by_strand": args.by_strand}
+    entry  = None
+    if args.infile != "-" and not args.no_cache:
+        entry = cache_entry(args.infile, args.binsize, args.frag_size,
+                args.n_redundancy, args.by_strand)
+    cached = entry and load_counts(entry, args.infile, header, params, dtype)
     try:
-        bins, norm_factor = binbam(bamfile, args.binsize, args.frag_size,
-                chrominfo, args.n_redundancy, args.by_strand)
+        if cached:
+            bins, norm_factor = cached
+        elif threads > 1:
+            bins, norm_factor = binbam_parallel(args.infile, args.binsize,
+                    args.frag_size, header, args.n_redundancy, args.by_strand,
+                    threads, dtype)
+        else:
+            bins, norm_factor = binbam(bamfile, args.binsize, args.frag_size,
+                    chrominfo, args.n_redundancy, args.by_strand, dtype)
     finally:
         bamfile.close()
+    if entry and not cached:
+        save_counts(entry, args.infile, bins, header, norm_factor, params)
     
-    logging.info("DONE")
-    if args.sg > 0:
-        smooth(bins, args.sg, args.by_strand)
-    output_wiggle(bins, args.binsize, norm_factor, args.by_strand, args.name, args.track_line)
+    stores = args.by_strand and sum(bins.values(), []) or bins.values()
+    logging.info("DONE (%.1f MB of bins)", sum(b.nbytes for b in stores) / 1e6)
+    if args.format == "bigwig":
+        # coarser bin sizes become zoom levels of the finest track
+        if args.sg > 0:
+            smooth(bins, args.sg, args.by_strand)
+        output_bigwig(args.output, bins, chrominfo, args.binsize, norm_factor,
+                args.by_strand, args.name, sizes[1:])
+        return
+    # coarser resolutions are derived from the raw counts before smoothing
+    levels = [(b, b == args.binsize and bins or aggregate(bins, chrominfo,
+        args.binsize, b // args.binsize, args.by_strand)) for b in sizes]
+    writer = args.format == "bedgraph" and output_bedgraph or output_wiggle
+    for filename, (binsize, level) in zip(resolution_names(args.output, sizes), levels):
+        if args.sg > 0:
+            smooth(level, args.sg, args.by_strand)
+        if len(sizes) > 1:
+            logging.info("Writing %d bp bins to %s", binsize, filename)
+        with FileOrGzipWriter(filename, args.compress, args.level,
+                args.compress_threads) as out:
+            writer(out, level, binsize, norm_factor / (binsize // args.binsize),
+                    args.by_strand, args.name, args.track_line)
 
 def setup(commands):
     """set up command line parser"""
@@ -160,9 +669,15 @@ def setup(commands):
             formatter_class = argparse.RawDescriptionHelpFormatter,
             description     = __doc__)
     cmdline.add_argument("infile", type = arghelpers.infilename_check,
-            help = "Bam file; use '-' for stdin")
-    cmdline.add_argument("binsize", type = int,
-            help = "Size of bins to use")
+            nargs = "+",
+            help = """Bam file; use '-' for stdin.  Several bam files can be
+            given with --format matrix""")
+    cmdline.add_argument("binsize", type = binsizes,
+            help = """Size of bins to use; several comma separated sizes are
+            counted in one pass at the smallest size and summed up for the
+            larger ones, which have to be multiples of it.  Each size is
+            written to <base>.<size>bp.<ext> of the output file; for bigwig
+            output, the larger sizes are zoom levels of one file""")
     cmdline.add_argument("name",
             help = "Name of track")
     cmdline.add_argument("-f", "--frag-size", type = int,
@@ -183,4 +698,26 @@ def setup(commands):
             help = """include extra options in track line. 'track type=bedGraph
             alwaysZero=on visibility=full maxHeightPixels=100:80:50' is always
             included""")
+    cmdline.add_argument("--format", default = "wiggle",
+            choices = ["wiggle", "bedgraph", "bigwig", "matrix"],
+            help = """Output format; bigwig needs an output file and writes
+            <base>.plus.bw and <base>.minus.bw with --by-strand.  matrix
+            writes the raw (or smoothed) counts of all bam files as a
+            bins x samples matrix to a compressed .npz file, or to a memory
+            mappable .npy file with a .json file of metadata if the output
+            file ends in .npy [%(default)s]""")
+    cmdline.add_argument("-p", "--threads", type = int, default = 1,
+            help = """Number of processes counting regions of the genome in
+            parallel; needs an indexed bam file.  With --format matrix, the
+            number of bam files counted at the same time [%(default)s]""")
+    cmdline.add_argument("--compact", default = False, action = "store_true",
+            help = """Keep counts as 16 bit integers; bins are widened in
+            chunks that overflow""")
+    cmdline.add_argument("--no-cache", default = False, action = "store_true",
+            help = """Do not use or write the cache of raw counts; by default
+            the counts of a bam file are cached (see gosr.common.cache) and
+            reused by runs with the same binsize, fragment size, redundancy
+            and strand options.  The least recently used entries are removed
+            when the cache exceeds $GOSR_CACHE_SIZE [10G]""")
+    arghelpers.add_output_options(cmdline)
     cmdline.set_defaults(func = process)
@@ -1,60 +1,216 @@
 #! /usr/bin/env python
 """
 Determine the quality score type of a fastq file based on the first few
-thousand sequences
+thousand sequences.  Reading stops early once the range of quality scores
+leaves no doubt.  With --samples, records are taken from several offsets
+across the file instead of only its start.
 
 if fastq file is '-', reads from stdin. Files ending in .gz are 
 accepted and uncompressed on the fly.
 
 On stdout returns a single string indicating score type; stderr displays log
+
+Many files (names, quoted glob patterns, or a --manifest) can be examined in
+one run, in parallel with --threads.  Then, or with --format, one tsv or json
+record per file is written with columns file, encoding, min, max (quality
+characters), records (sampled), bytes (read), confidence and error (why a
+file could not be read).  A file whose score type can not be determined has
+encoding NA and makes the exit status 1.
 """
 
+import os
 import sys
+import glob
+import json
 import logging
-import collections
 import argparse
+import itertools
+import collections
+import multiprocessing
+import numpy
 from gosr.common import fastq
 from gosr.common import arghelpers
-from gosr.common.file import FileOrGzip
-
-def guess_score_type(letter_freq_dict):
-    """returns solexa|phred64|phred33"""
-    total = sum(letter_freq_dict.values())
-    logging.info("Processed %i quality letters", total)
-    letters = [ord(x) for x in letter_freq_dict.keys()]
-    maxval = max(letters)
-    minval = min(letters)
-    logging.info("Score range: %3d - %3d", minval, maxval)
-    assert maxval <= 104
+from gosr.common.file import FileOrGzip, gzip_format, output_file
+
+SAMPLE_BLOCKSIZE = 64 * 1024 # small reads so that early exit saves I/O
+SAMPLE_BATCHSIZE = 1000
+
+Detection = collections.namedtuple("Detection",
+        "encoding minval maxval n_records n_bytes confidence")
+
+def range_score_type(minval, maxval):
+    """returns solexa|phred64|phred33|phred33+ for the range of quality
+    characters seen; None if no score type fits the range"""
+    if maxval > 104:
+        return None
     if minval < 59:
         if maxval <= 73:
-            logging.info("Score type: phred33")
             return "phred33"
         elif maxval <= 78:
-            logging.info("Score type: phred33+ with Q up to 45 (illumina currently goes to Q41)")
             return "phred33+"
-        else:
-            logging.error("score minval < 59, but maxval > 74; score not determined")
-            sys.exit(1)
+        return None
+    elif minval < 64:
+        return "solexa"
+    return "phred64"
+
+def pinned(minval, maxval):
+    """True if more data can no longer change the score type family: only
+    phred33 has characters below 59 and only solexa/phred64 above 78"""
+    return minval < 59 and maxval > 73 or maxval > 78 and minval < 64
+
+def guess_score_type(det):
+    """returns solexa|phred64|phred33|phred33+ for a Detection; logs the
+    score range and exits if no score type fits"""
+    logging.info("Sampled %d records (%s bytes read)", det.n_records,
+            det.n_bytes is None and "unknown" or det.n_bytes)
+    if det.minval is None:
+        logging.error("no quality scores found")
+        sys.exit(1)
+    logging.info("Score range: %3d - %3d", det.minval, det.maxval)
+    if det.encoding is None:
+        logging.error("score range %d - %d fits no score type", det.minval, det.maxval)
+        sys.exit(1)
+    if det.encoding == "phred33+":
+        logging.info("Score type: phred33+ (%s) with Q up to 45 (illumina "
+                "currently goes to Q41)", det.confidence)
     else:
-        if minval < 64:
-            logging.info("Score type: solexa")
-            return "solexa"
-        else:
-            logging.info("Score type: phred64")
-            return "phred64"
+        logging.info("Score type: %s (%s)", det.encoding, det.confidence)
+    return det.encoding
+
+def _gzip_format(filename):
+    with open(filename, "rb") as fh:
+        return gzip_format(fh.read(18))
+
+def detect_score_type(filename, n_records = 5000, n_samples = 1):
+    """determine the score type from up to n_records records.  Reading stops
+    as soon as the range of quality characters pins down the score type
+    family.  For regular and bgzf files, the records are sampled from
+    n_samples evenly spaced offsets across the file.  Returns a Detection;
+    encoding is None if the range fits no score type, n_bytes is None if
+    the bytes read can not be counted (stdin, pigz)"""
+    letter_hist = numpy.zeros(256, dtype = numpy.int64)
+    n_seen, n_bytes = 0, 0
+    if n_samples > 1 and (filename == "-" or _gzip_format(filename) == "gzip"):
+        logging.info("%s can not be sampled at offsets; reading from the start",
+                filename)
+        n_samples = 1
+    size    = n_samples > 1 and os.path.getsize(filename) or 0
+    letters = []
+    for i in xrange(n_samples):
+        quota = n_records * (i + 1) // n_samples - n_seen
+        fi    = FileOrGzip(filename, blocksize = SAMPLE_BLOCKSIZE,
+                offset = size * i // n_samples)
+        with fi as infile:
+            for batch in fastq.read_batches(infile, min(quota, SAMPLE_BATCHSIZE),
+                    SAMPLE_BLOCKSIZE, resync = fi.offset > 0):
+                letter_hist += numpy.bincount(batch.qual, minlength = 256)
+                n_seen += len(batch)
+                quota  -= len(batch)
+                letters = numpy.flatnonzero(letter_hist)
+                if quota <= 0 or len(letters) and pinned(letters[0], letters[-1]):
+                    break
+            read = fi.bytes_read()
+        n_bytes = None if n_bytes is None or read is None else n_bytes + read
+        if len(letters) and pinned(letters[0], letters[-1]):
+            break
+    letters = numpy.flatnonzero(letter_hist)
+    if len(letters) == 0:
+        return Detection(None, None, None, n_seen, n_bytes, "low")
+    minval, maxval = int(letters[0]), int(letters[-1])
+    if pinned(minval, maxval):
+        confidence = "unambiguous"
+    elif n_seen < 100:
+        confidence = "low"
+    else:
+        confidence = "likely"
+    return Detection(range_score_type(minval, maxval), minval, maxval,
+            n_seen, n_bytes, confidence)
+
+def _detect_file(job):
+    """pool worker: detection record for one file"""
+    filename, n_records, n_samples = job
+    rec = collections.OrderedDict((f, None) for f in FIELDS)
+    rec["file"] = filename
+    try:
+        det = detect_score_type(filename, n_records, n_samples)
+    except (IOError, OSError, ValueError), e:
+        logging.error("%s: %s", filename, e)
+        rec["error"] = str(e)
+        return rec
+    rec.update(encoding = det.encoding, min = det.minval, max = det.maxval,
+            records = det.n_records, bytes = det.n_bytes,
+            confidence = det.confidence)
+    return rec
+
+def expand_inputs(patterns, manifest = None):
+    """list of fastq files from file names, glob patterns and a manifest
+    with one file name or pattern per line ('#' starts a comment)"""
+    if manifest is not None:
+        patterns = list(patterns)
+        with open(manifest) as fh:
+            for line in fh:
+                line = line.split("#")[0].strip()
+                if line:
+                    patterns.append(line)
+    files = []
+    for pat in patterns:
+        if pat == "-" or os.path.exists(pat):
+            files.append(pat)
+            continue
+        matches = sorted(glob.glob(pat))
+        if not matches:
+            logging.error("no file matches %s", pat)
+            sys.exit(1)
+        files.extend(matches)
+    return files
+
+FIELDS = ("file", "encoding", "min", "max", "records", "bytes", "confidence",
+        "error")
+
+def _format_record(rec, fmt):
+    if fmt == "json":
+        return json.dumps(rec) + "\n"
+    return "\t".join("NA" if rec[f] is None else str(rec[f]) for f in FIELDS) + "\n"
 
 def determine_score_type(args):
-    with FileOrGzip(args.fastq) as infile:
-        count = 0
-        letter_freq = collections.defaultdict(int)
-        for rid, seq, qual in fastq.read(infile):
-            count += 1
-            for l in qual:
-                letter_freq[l] += 1
-            if count == 5000:
-                break
-        print guess_score_type(letter_freq)
+    files = expand_inputs(args.fastq, args.manifest)
+    if not files:
+        logging.error("no input files")
+        sys.exit(1)
+    if args.format is None and len(files) == 1:
+        # single file: just the score type, as always
+        score_type = guess_score_type(detect_score_type(files[0], args.n_records,
+                args.samples))
+        with output_file(args) as out:
+            out.write("%s\n" % score_type)
+        return
+    fmt  = args.format or "tsv"
+    jobs = [(f, args.n_records, args.samples) for f in files]
+    pool = None
+    if args.threads > 1 and len(files) > 1:
+        pool    = multiprocessing.Pool(min(args.threads, len(files)))
+        results = pool.imap(_detect_file, jobs)
+    else:
+        results = itertools.imap(_detect_file, jobs)
+    n_failed = 0
+    try:
+        with output_file(args) as out:
+            if fmt == "tsv":
+                out.write("\t".join(FIELDS) + "\n")
+            for rec in results:
+                if rec["encoding"] is None:
+                    n_failed += 1
+                out.write(_format_record(rec, fmt))
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    logging.info("Determined score type of %d of %d files", len(files) - n_failed,
+            len(files))
+    if n_failed:
+        sys.exit(1)
 
 #===============================================================================
 # interface
@@ -66,7 +222,20 @@ def setup(commands):
             help = """Determine score type for fastq file""",
             formatter_class = argparse.RawDescriptionHelpFormatter,
             description     = __doc__)
-    cmdline.add_argument("fastq", type = arghelpers.infilename_check,
-            help = "Fastq file")
+    cmdline.add_argument("fastq", nargs = "*",
+            help = "Fastq files or glob patterns (quoted); '-' reads from stdin")
+    cmdline.add_argument("--manifest", type = arghelpers.infilename_check,
+            help = "File with one fastq file or glob pattern per line")
+    cmdline.add_argument("-n", "--n-records", type = int, default = 5000,
+            help = "Maximal number of records to examine per file [%(default)s]")
+    cmdline.add_argument("--samples", type = int, default = 1,
+            help = """Number of evenly spaced file offsets the records are
+            taken from; needs a regular or bgzf file [%(default)s]""")
+    cmdline.add_argument("-p", "--threads", type = int, default = 1,
+            help = "Number of files examined in parallel [%(default)s]")
+    cmdline.add_argument("--format", choices = ["tsv", "json"], default = None,
+            help = """Report one record per file as tsv or json lines; the
+            default for a single file is to print only the score type, tsv
+            otherwise""")
+    arghelpers.add_output_options(cmdline)
     cmdline.set_defaults(func = determine_score_type)
-
@@ -9,7 +9,10 @@ Qp = Qs + 10*log(1+10^(Qs/-10), 10)
 
 For efficiency, this program uses a character table for
 string.maketrans that has been previously calculated
-to translate old solexa to new solexa character strings
+to translate old solexa to new solexa character strings.
+The tables are turned into 256 entry lookup tables that
+are applied to the qualities of a whole chunk of reads
+at once with numpy.
 
 phred64 is a simple left shift
 
@@ -17,15 +20,34 @@ phred33+ makes sure that q values don't exceed 40 (as
 it does in recent illumina output; currently works
 for input up to Q45).
 
-Output goes to stdout
+phred33 input is left unchanged unless it is binned.
+
+--to phred64 writes phred64 instead of phred33 (e.g.
+for solexa -> phred64).  --bin illumina8 reduces
+qualities to the 8 levels of Illumina quality binning
+(2-9 -> 6, 10-19 -> 15, 20-24 -> 22, 25-29 -> 27,
+30-34 -> 33, 35-39 -> 37, >=40 -> 40; Q0 and Q1 are
+kept), which compresses much better.
+
+With --threads N, the input is split into chunks of complete records that
+are converted by N worker processes and written in input order; output is
+identical to the serial mode.  Input that is not 4-line fastq is converted
+in the main process from the first chunk that is not.
+
+Output goes to stdout or the file given with -o
 """
 
 
 import sys
+import logging
 import argparse
+import itertools
+import collections
+import multiprocessing
 from string import maketrans
+import numpy
 
-from gosr.common.file import FileOrGzip
+from gosr.common.file import FileOrGzip, output_file
 from gosr.common import fastq
 from gosr.common import arghelpers
 
@@ -41,17 +63,112 @@ phred64_to_phred33 = maketrans(phred64, phred33)
 
 phred33plus_to_phred33 = maketrans("JKLMN", "IIIII")
 
+tables = {"phred64":  phred64_to_phred33,
+          "solexa":   solexa_to_phred33,
+          "phred33+": phred33plus_to_phred33,
+          "phred33":  maketrans("", "")}
+
+# Illumina 8 level quality binning: lower bound of each bin and its value
+illumina8 = ((2, 6), (10, 15), (20, 22), (25, 27), (30, 33), (35, 37), (40, 40))
+
+BATCHSIZE = 100000
+
+def make_lut(score_type, to = "phred33", binning = None):
+    """numpy lookup table (256 x uint8) converting quality characters of
+    score_type to phred33 or phred64, optionally binned"""
+    lut = numpy.frombuffer(tables[score_type], dtype = numpy.uint8).copy()
+    q   = lut.astype(int) - 33
+    qual_chars = (q >= 0) & (q <= 93)
+    if binning == "illumina8":
+        binned = q.copy()
+        for lower, value in illumina8:
+            binned[q >= lower] = value
+        q = numpy.where(qual_chars, binned, q)
+    if to == "phred64":
+        qual_chars &= q <= 62
+        q = numpy.where(qual_chars, q + 31, q)
+    return numpy.where(qual_chars, q + 33, lut).astype(numpy.uint8)
+
+def convert(batch, lut):
+    """translate qualities of a FastqBatch with a lookup table; returns the
+    converted fastq text"""
+    if not batch.has_qual.all():
+        logging.error("Input contains fasta or truncated fastq records")
+        sys.exit(1)
+    batch.qual = lut.take(batch.qual)
+    return batch.format()
+
+_lut = None
+def _init_worker(lut):
+    global _lut
+    _lut = lut
+
+def _convert_chunk(chunk):
+    """worker: convert a chunk of raw fastq text; None if the chunk is not
+    made of 4-line records"""
+    return fastq.translate_quals(chunk, _lut)
+
+class _Pieces(object):
+    """file like object reading from an iterator of text pieces"""
+    def __init__(self, pieces):
+        self.pieces = pieces
+    def read(self, size = -1):
+        return next(self.pieces, "")
+
+def convert_records(chunks, out, lut):
+    """parse the remaining chunks from read_chunks record by record and
+    convert them; used from the first chunk that is not 4-line fastq"""
+    for batch in fastq.read_batches(_Pieces(chunks), BATCHSIZE):
+        out.write(convert(batch, lut))
+
+def to_phred33_parallel(infile, out, lut, threads):
+    """reader -> pool of converting processes -> ordered writer; at most
+    2 * threads chunks are in flight.  From the first chunk that is not
+    4-line fastq, the rest of the input is converted by convert_records
+    in this process, so that output is the same as in serial mode"""
+    pool    = multiprocessing.Pool(threads, _init_worker, (lut,))
+    pending = collections.deque()
+    chunks  = fastq.read_chunks(infile)
+    try:
+        while True:
+            for chunk in chunks:
+                pending.append((chunk, pool.apply_async(_convert_chunk, (chunk,))))
+                if len(pending) >= 2 * threads:
+                    break
+            if not pending:
+                break
+            chunk, result = pending.popleft()
+            result        = result.get()
+            if result is None:
+                rest = [chunk] + [c for c, _ in pending]
+                pool.terminate()
+                convert_records(itertools.chain(rest, chunks), out, lut)
+                break
+            out.write(result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def to_phred33_serial(infile, out, lut):
+    """4-line fastq is converted a chunk of raw text at a time; from the
+    first chunk that is not, records are parsed one by one"""
+    chunks = fastq.read_chunks(infile)
+    for chunk in chunks:
+        result = fastq.translate_quals(chunk, lut)
+        if result is None:
+            convert_records(itertools.chain([chunk], chunks), out, lut)
+            return
+        out.write(result)
+
 def to_phred33(args):
-    if args.score_type == "phred64":
-        table = phred64_to_phred33
-    elif args.score_type == "solexa":
-        table = solexa_to_phred33
-    elif args.score_type == "phred33+":
-        table = phred33plus_to_phred33
-    out = "@{0}\n{1}\n+\n{2}"
-    with FileOrGzip(args.fastq) as infile:
-        for rid, rseq, rqual in fastq.read(infile):
-            print out.format(rid, rseq, rqual.translate(table))
+    lut = make_lut(args.score_type, args.to, args.bin)
+    with FileOrGzip(args.fastq, threads = args.threads) as infile, \
+            output_file(args) as out:
+        if args.threads > 1:
+            to_phred33_parallel(infile, out, lut, args.threads)
+        else:
+            to_phred33_serial(infile, out, lut)
 
 #===============================================================================
 # interface
@@ -63,8 +180,18 @@ def setup(commands):
             help = """changes from solexa of phred 64 to phred33""",
             formatter_class = argparse.RawDescriptionHelpFormatter,
             description     = __doc__)
-    cmdline.add_argument("score_type", choices = ["phred64", "solexa", "phred33+"],
+    cmdline.add_argument("score_type",
+            choices = ["phred64", "solexa", "phred33+", "phred33"],
             help = "Current score type")
     cmdline.add_argument("fastq", type = arghelpers.infilename_check,
             help = "Fastq file (can be .gz); '-' reads from stdin")
+    cmdline.add_argument("--to", choices = ["phred33", "phred64"],
+            default = "phred33",
+            help = "Output score type [%(default)s]")
+    cmdline.add_argument("--bin", choices = ["illumina8"], default = None,
+            help = "Bin quality scores [no binning]")
+    cmdline.add_argument("-p", "--threads", type = int, default = 1,
+            help = """Number of worker processes for the conversion; also
+            used for decompressing bgzf input [%(default)s]""")
+    arghelpers.add_output_options(cmdline)
     cmdline.set_defaults(func = to_phred33)
@@ -4,63 +4,132 @@ Given reads from bam file, calculate read density around TSSs
 listed in GTF file. Bam file does not have to be ordered or indexed.
 
 Note: * For overlapping intervals, one is chosen at random
+      * The TSS windows of a GTF file are cached (see gosr.common.cache), so
+        later runs with the same file and window size do not parse it again
 
 Also estimates fragment size by calculating the density separately
 for plus and minus strand and finding shift that leads to optimal overlap
 between the two densities.
 
 Note that this tool calculates read counts, not coverage.
+
+With --threads, the chromosomes of an indexed bam file, or ranges of bgzf
+blocks of an unindexed one, are counted by a pool of processes.
 """
 
+import os
 import logging
 import argparse
 import sys
+import multiprocessing
 import numpy
+import pysam
 import HTSeq
 
 from gosr.common import arghelpers
+from gosr.common import bam as bamsplit
+from gosr.common import cache
 from gosr.common import dsp
-
-def overlaps_any(garray, iv):
-    steps = list(garray[iv].steps())
-    if len(steps) > 1 or steps[0][1] is not None:
-        return True
-    else:
-        return False
+from gosr.common.intervals import TssIndex
+from gosr.common.file import output_file
 
 def gtf_to_tsspos(gtf, upstream, downstream):
     """extract TSSs from gtf (using 'exon_number' attribute) and
-    create a GenomicArray of non-overlapping TSSs plus the upstream
+    create a TssIndex of non-overlapping TSSs plus the upstream
     and downstream region.  Limit is extended by 200 nts on each end
     to allow for shifting to determine fragment size estimate later on"""
-    tsspos  = HTSeq.GenomicArray("auto", typecode = 'O', stranded=False)
+    tsss    = []
     n_feat  = 0
-    n_tss   = 0
-    n_used  = 0
     for feature in gtf:
         n_feat += 1
         if feature.type == "exon" and feature.attr["exon_number"] == "1":
-            n_tss += 1
-            p      = feature.iv.start_d_as_pos
-            if feature.iv.strand == "+":
-                window = HTSeq.GenomicInterval(p.chrom, p.pos - upstream,
-                        p.pos + downstream + 1, "+")
-            elif feature.iv.strand == "-":
-                window = HTSeq.GenomicInterval(p.chrom, p.pos - downstream,
-                        p.pos + upstream + 1, "-")
-            else:
+            if feature.iv.strand not in ("+", "-"):
                 logging.error("bad strand found in GTF file: %s [line %d]",
                         feature.iv.strand, n_feat)
                 sys.exit(1)
-            if not overlaps_any(tsspos, window):
-                tsspos[window] = window
-                n_used += 1
-    logging.info("found %d TSSs", n_tss)
-    logging.info(" of which %d were used (i.e. non-overlapping)", n_used)
+            tsss.append((feature.iv.chrom, feature.iv.start_d, feature.iv.strand))
+    tsspos = TssIndex.build(tsss, upstream, downstream)
+    logging.info("found %d TSSs", len(tsss))
+    logging.info(" of which %d were used (i.e. non-overlapping)", len(tsspos))
+    return tsspos, len(tsspos)
+
+def load_tsspos(filename, upstream, downstream):
+    """gtf_to_tsspos of a GTF file; the index is cached (see
+    gosr.common.cache) keyed by the GTF file and the window size.  While an
+    index is being built, other processes needing the same index wait for
+    it instead of parsing the GTF file as well"""
+    path = cache.entry_path("tss-%d-%d" % (upstream, downstream), filename, ".npz")
+    if path is None:
+        logging.info("Parsing GTF file [%s]", filename)
+        return gtf_to_tsspos(HTSeq.GFF_Reader(filename), upstream, downstream)
+    with cache.locked(path):
+        if os.path.exists(path):
+            try:
+                tsspos = TssIndex.read(path)
+                cache.touch(path)
+                logging.info("Using cached TSS index of %s", filename)
+                logging.info("found %d TSSs", tsspos.n_tss)
+                logging.info(" of which %d were used (i.e. non-overlapping)", len(tsspos))
+                return tsspos, len(tsspos)
+            except (IOError, ValueError, KeyError), e:
+                logging.debug("ignoring unreadable cache entry %s: %s", path, e)
+        logging.info("Parsing GTF file [%s]", filename)
+        tsspos, n_used = gtf_to_tsspos(HTSeq.GFF_Reader(filename), upstream, downstream)
+        cache.write_atomic(path, tsspos.write)
     return tsspos, n_used
 
+BLOCKSIZE = 65536 # alignments converted to arrays at a time
+
+def count_block(tsspos, block, references, left, right):
+    """add the reads of a block of aligned reads, given as rows of (tid,
+    5' position, is_reverse), to the left and right counts; returns the
+    number of reads on a TSS window"""
+    n_on_tss = 0
+    tid, five, reverse = block.T
+    for t in numpy.unique(tid):
+        sel  = tid == t
+        pos  = five[sel]
+        win  = tsspos.lookup(references[t], pos)
+        hit  = win >= 0
+        if not hit.any():
+            continue
+        starts, ends, minus, _ = tsspos.chroms[references[t]]
+        win, pos = win[hit], pos[hit]
+        # position relative to the upstream end of the window
+        pos_in_window = numpy.abs(pos - numpy.where(minus[win], ends[win] - 1,
+            starts[win]))
+        if pos_in_window.max() >= len(left):
+            logging.error("pos_in_window out of bounds: %d", pos_in_window.max())
+            sys.exit(1)
+        # a read on the same strand as the TSS is on the left of a fragment
+        is_left   = minus[win] == (reverse[sel][hit] == 1)
+        left     += numpy.bincount(pos_in_window[is_left], minlength = len(left))
+        right    += numpy.bincount(pos_in_window[~is_left], minlength = len(right))
+        n_on_tss += len(win)
+    return n_on_tss
+
+def density_counts(tsspos, alns, references, size):
+    """left and right read counts of size positions, number of aligned
+    reads and number of reads on a TSS window of an iterable of pysam
+    alignments (in any order); reads are converted to arrays (see
+    gosr.common.bam.alignment_arrays) and counted in blocks"""
+    left     = numpy.zeros(size, dtype = numpy.int64)
+    right    = numpy.zeros(size, dtype = numpy.int64)
+    n_reads  = 0
+    n_on_tss = 0
+    for rows in bamsplit.alignment_arrays(alns, BLOCKSIZE):
+        tid, pos, flag, alen, _ = rows.T
+        mapped  = (flag & 4) == 0
+        reverse = (flag & 16) != 0
+        # the 5' end of a minus strand read is its last aligned base
+        five    = numpy.where(reverse, pos + numpy.maximum(alen, 1) - 1, pos)
+        block   = numpy.column_stack((tid, five, reverse))[mapped]
+        n_reads  += len(block)
+        n_on_tss += count_block(tsspos, block, references, left, right)
+    return left, right, n_reads, n_on_tss
+
 def make_density(tsspos, bamfile, up, down):
-    """calculate tag density in RPKM around TSSs in tsspos GenomicArray;
+    """calculate tag density in RPKM around TSSs in tsspos TssIndex;
     separate densities by whether they represent the left or right side of
     a fragment.  note that this depends on the strand of the feature:
         * for a plus strand feature, a plus strand read is left, a minus
@@ -68,33 +137,89 @@ def make_density(tsspos, bamfile, up, down):
         * for a minus strand feature, a plus strand read is right, a minus
           strand read is left
     """
-    n_reads        = 0
-    n_reads_on_tss = 0
-    locd           = {'+': {'+': "left", "-": "right"},
-                      '-': {"+": "right", "-": "left"}}
-    d              = {
-            'left'  : numpy.zeros(up + down + 1, dtype = "i"),
-            'right' : numpy.zeros(up + down + 1, dtype = "i") }
-    for aln in bamfile:
-        if aln.aligned:
-            n_reads += 1
-            alniv = aln.iv
-            tss = tsspos[alniv.start_d_as_pos]
-            if tss is not None:
-                n_reads_on_tss += 1
-                pos_in_window = numpy.abs(alniv.start_d - tss.start_d)
-                loc = locd[tss.strand][alniv.strand]
-                try:
-                    d[loc][pos_in_window] += 1
-                except IndexError:
-                    logging.error("pos_in_window out of bounds: %d",
-                            pos_in_window)
-                    logging.error("tss: %s", str(tss))
-                    logging.error("aln: %s", str(alniv))
-                    sys.exit(1)
+    left, right, n_reads, n_reads_on_tss = density_counts(tsspos, bamfile,
+            bamfile.references, up + down + 1)
     logging.info("Reads processed: %9d", n_reads)
     logging.info("Reads on tss:    %9d", n_reads_on_tss)
-    return d, n_reads
+    return {'left': left.astype("i"), 'right': right.astype("i")}, n_reads
+
+#===============================================================================
+# parallel density of chromosomes or bgzf block ranges
+#===============================================================================
+
+_worker = {}
+
+def _init_worker(filename, tsspos, size, first):
+    _worker["filename"] = filename
+    _worker["bam"]      = pysam.Samfile(filename, "rb")
+    _worker["args"]     = (tsspos, size, first)
+
+def _density_chrom(chrom):
+    """pool worker: partial counts of the reads of a chromosome of an
+    indexed bam file"""
+    tsspos, size, _ = _worker["args"]
+    bam = _worker["bam"]
+    return density_counts(tsspos, bam.fetch(chrom), bam.references, size)
+
+def _alignments_until(bam, end): # this is a generator function
+    """yields alignments starting before virtual offset end (None for the
+    end of the file)"""
+    while end is None or bam.tell() < end:
+        try:
+            yield next(bam)
+        except StopIteration:
+            return
+
+def _density_range(blocks):
+    """pool worker: partial counts of the reads starting in a range of bgzf
+    blocks of an unindexed bam file"""
+    tsspos, size, first = _worker["args"]
+    start, end = blocks
+    bam    = _worker["bam"]
+    offset = start == first >> 16 and first or \
+            bamsplit.first_record(_worker["filename"], start, bam.lengths)
+    if offset is None:
+        return density_counts(tsspos, [], bam.references, size)
+    bam.seek(offset)
+    return density_counts(tsspos, _alignments_until(bam,
+        end is not None and end << 16 or None), bam.references, size)
+
+def density_parallel(filename, tsspos, up, down, threads):
+    """make_density with the reads counted by a pool of processes; the
+    chromosomes of an indexed bam file or ranges of bgzf blocks of an
+    unindexed one are counted separately and the partial counts summed"""
+    size = up + down + 1
+    bam  = pysam.Samfile(filename, "rb")
+    try:
+        first = bam.tell()
+        try:
+            bam.fetch(bam.references[0], 0, 1)
+            jobs   = [c for _, c in sorted(zip(bam.lengths, bam.references), reverse = True)]
+            worker = _density_chrom
+            logging.info("Counting %d chromosomes with %d processes", len(jobs), threads)
+        except (ValueError, IOError):
+            jobs   = bamsplit.split(filename, 4 * threads, first)
+            worker = _density_range
+            logging.info("No index found; counting %d ranges of the bam file "
+                    "with %d processes", len(jobs), threads)
+    finally:
+        bam.close()
+    left, right = numpy.zeros(size, dtype = numpy.int64), numpy.zeros(size, dtype = numpy.int64)
+    n_reads, n_reads_on_tss = 0, 0
+    pool = multiprocessing.Pool(threads, _init_worker, (filename, tsspos, size, first))
+    try:
+        for l, r, n, n_on in pool.imap_unordered(worker, jobs):
+            left           += l
+            right          += r
+            n_reads        += n
+            n_reads_on_tss += n_on
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    logging.info("Reads processed: %9d", n_reads)
+    logging.info("Reads on tss:    %9d", n_reads_on_tss)
+    return {'left': left.astype("i"), 'right': right.astype("i")}, n_reads
 
 def dist(x, y):
     assert(len(x) == len(y))
@@ -122,7 +247,7 @@ def determine_frag_size(density, extra):
     return optimal_shift[0][0] * 2
 
 
-def output(density, up, down, extra, frag_size, n_tss, n_reads):
+def output(out, density, up, down, extra, frag_size, n_tss, n_reads):
     smooth_filter_size = 101
     shift = int(frag_size / 2)
     pos   = range(-up, down + 1)
@@ -131,16 +256,16 @@ def output(density, up, down, extra, frag_size, n_tss, n_reads):
     left = (density["left"].astype(float) / n_reads) * 1e9 / n_tss
     left_smooth = dsp.savitzky_golay_filter(left, smooth_filter_size,
             order = 4)
-    print "\n".join("{0}|{1}|{2}|left".format(a, b, c) for a, b, c in
+    out.write("\n".join("{0}|{1}|{2}|left".format(a, b, c) for a, b, c in
             zip(pos[extra:(extra + n)], left[extra:(extra + n)], 
-                left_smooth[extra:(extra + n)]))
+                left_smooth[extra:(extra + n)])) + "\n")
     
     right = (density["right"].astype(float) / n_reads) * 1e9 / n_tss
     right_smooth = dsp.savitzky_golay_filter(right, smooth_filter_size,
             order = 4)
-    print "\n".join("{0}|{1}|{2}|right".format(a, b, c) for a, b, c in
+    out.write("\n".join("{0}|{1}|{2}|right".format(a, b, c) for a, b, c in
             zip(pos[extra:(extra + n)], right[extra:(extra + n)], 
-                right_smooth[extra:(extra + n)]))
+                right_smooth[extra:(extra + n)])) + "\n")
     
     combined = numpy.zeros(len(left), dtype = float)
     cs = extra + 1
@@ -150,9 +275,9 @@ def output(density, up, down, extra, frag_size, n_tss, n_reads):
     combined[cs:(cs + n)] += right[right_start:(right_start + n)]
     combined_smooth = dsp.savitzky_golay_filter(combined, smooth_filter_size,
             order = 4)
-    print "\n".join("{0}|{1}|{2}|combined".format(a, b, c) for a, b, c in
+    out.write("\n".join("{0}|{1}|{2}|combined".format(a, b, c) for a, b, c in
             zip(pos[extra:(extra + n)], combined[extra:(extra + n)], 
-                combined_smooth[extra:(extra + n)]))
+                combined_smooth[extra:(extra + n)])) + "\n")
 
 
 ################################################################################
@@ -167,18 +292,26 @@ def process(args):
     down       = args.downstream
     logging.info("Window: <-- %d --TSS-- %d -->", up, down)
 
-    logging.info("Parsing GTF file [%s]", args.gtffile)
-    gtffile = HTSeq.GFF_Reader(args.gtffile)
-    tsspos, n_tss_used  = gtf_to_tsspos(gtffile, up + extra, down + extra)
+    tsspos, n_tss_used  = load_tsspos(args.gtffile, up + extra, down + extra)
 
-    bamfile = HTSeq.BAM_Reader(args.bamfile)
-    density, n_reads = make_density(tsspos, bamfile, up + extra, down + extra)
+    if args.threads > 1 and args.bamfile == "-":
+        logging.warn("Reading from stdin; counting serially")
+    if args.threads > 1 and args.bamfile != "-":
+        density, n_reads = density_parallel(args.bamfile, tsspos, up + extra,
+                down + extra, args.threads)
+    else:
+        bamfile = pysam.Samfile(args.bamfile, "rb")
+        try:
+            density, n_reads = make_density(tsspos, bamfile, up + extra, down + extra)
+        finally:
+            bamfile.close()
     if args.frag_size == -1:
         frag_size = determine_frag_size(density, extra)
     else:
         frag_size = args.frag_size
-    output(density, up + extra, down + extra, extra,
-            frag_size, n_tss_used, n_reads)
+    with output_file(args) as out:
+        output(out, density, up + extra, down + extra, extra,
+                frag_size, n_tss_used, n_reads)
 
 def setup(commands):
     """set up command line parser"""
@@ -196,4 +329,9 @@ def setup(commands):
             help = "nts downstream of TSS to include [%(default)s]")
     cmdline.add_argument("-s", "--frag-size", type = int, default = -1,
             help = "pre determined fragment size; if default [%(default)s] determines size estimate from data")
+    cmdline.add_argument("-p", "--threads", type = int, default = 1,
+            help = """Number of processes counting reads; the chromosomes of
+            an indexed bam file or ranges of an unindexed bam file are
+            counted in parallel [%(default)s]""")
+    arghelpers.add_output_options(cmdline)
     cmdline.set_defaults(func = process)
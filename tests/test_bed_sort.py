@@ -0,0 +1,104 @@
+"""
+tests for the external merge sort of gosr.tools.bed_sort: serial and
+parallel sorting with many runs, --merge and --check against a plain sort
+
+run with python -m unittest discover tests
+"""
+
+import os
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+
+from gosr.common import genome
+from gosr.tools import bed_sort
+
+CHUNKSIZE = 32768 # bytes per run, so that the test input makes many runs
+
+class BedSortTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.chroms = genome.load("mm9")
+        self.order  = dict((c, i) for i, c in enumerate(self.chroms.chromosomes))
+        rnd         = random.Random(1)
+        self.lines  = ["%s\t%d\t1\tx%d\n" % (rnd.choice(["chr1", "chr2", "chrX"]),
+            rnd.randint(0, 100000), i) for i in xrange(5000)]
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def key(self, line):
+        f = line.split("\t")
+        return self.order[f[0]], int(f[1])
+    def write(self, name, lines, compress = False, newline = True):
+        path = os.path.join(self.tmpdir, name)
+        text = "".join(lines)
+        if not newline:
+            text = text[:-1]
+        with (compress and gzip.open or open)(path, "wb") as fh:
+            fh.write(text)
+        return path
+    def sort(self, filenames, threads):
+        path = os.path.join(self.tmpdir, "out.bed")
+        runs = os.path.join(self.tmpdir, "runs")
+        os.mkdir(runs)
+        try:
+            with open(path, "wb") as out:
+                if threads > 1:
+                    bed_sort.sort_parallel(filenames, out, self.chroms, CHUNKSIZE,
+                            runs, threads)
+                else:
+                    bed_sort.sort_serial(filenames, out, self.chroms, CHUNKSIZE,
+                            runs)
+        finally:
+            shutil.rmtree(runs)
+        with open(path) as fh:
+            return fh.read()
+    def test_same_as_sorted(self):
+        s = sorted(self.lines, key = self.key)
+        cases = [("unsorted", self.lines), ("sorted", s),
+                 ("mostly sorted", s[:3000] + sorted(self.lines[:500],
+                     key = self.key) + s[3000:]),
+                 ("two sorted halves", s[::2] + s[1::2])]
+        for name, lines in cases:
+            # lines with the same position keep their input order
+            expected = "".join(sorted(lines, key = self.key))
+            for compress in (False, True):
+                for newline in (True, False):
+                    path = self.write("in.bed", lines, compress, newline)
+                    for threads in (1, 3):
+                        self.assertEqual(self.sort([path], threads), expected,
+                                (name, compress, newline, threads))
+    def test_several_files(self):
+        a, b = self.lines[:2000], self.lines[2000:]
+        expected = "".join(sorted(a + b, key = self.key))
+        paths = [self.write("a.bed", a), self.write("b.bed.gz", b, True)]
+        for threads in (1, 3):
+            self.assertEqual(self.sort(paths, threads), expected)
+    def test_merge(self):
+        a = sorted(self.lines[:2000], key = self.key)
+        b = sorted(self.lines[2000:], key = self.key)
+        path = os.path.join(self.tmpdir, "out.bed")
+        with open(path, "wb") as out:
+            bed_sort.merge_sorted([self.write("a.bed", a), self.write("b.bed", b)],
+                    out, self.chroms)
+        with open(path) as fh:
+            self.assertEqual(fh.read(), "".join(sorted(a + b, key = self.key)))
+        with open(path, "wb") as out:
+            self.assertRaises(ValueError, bed_sort.merge_sorted,
+                    [self.write("c.bed", self.lines)], out, self.chroms)
+    def test_check(self):
+        s = sorted(self.lines, key = self.key)
+        self.assertEqual(bed_sort.check_sorted([self.write("s.bed", s)],
+            self.chroms), None)
+        # the number of the first line out of order, also across files
+        u     = s[:1200] + [s[1500]] + s[1200:1500] + s[1501:]
+        first = next(i + 1 for i in xrange(1, len(u))
+                if self.key(u[i]) < self.key(u[i - 1]))
+        self.assertEqual(bed_sort.check_sorted([self.write("u.bed", u)],
+            self.chroms), first)
+        self.assertEqual(bed_sort.check_sorted([self.write("a.bed", s[1000:]),
+            self.write("b.bed", s[:1000])], self.chroms), 4001)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+tests for the vectorized binbam kernel, chunked bins, region parallel
+counting and the count cache against the original per-alignment loop
+
+run with python -m unittest discover tests
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import itertools
+import unittest
+import numpy
+import pysam
+
+from gosr.common.bins import ChunkedBins
+from gosr.tools import binbam
+
+# chr1 is longer than binbam.REGIONSIZE, so it is split into regions
+CHROMS = [("chr1", 45000000), ("chr2", 1000000), ("chrM", 16299)]
+
+def make_bam(filename, n, rnd):
+    """n sorted random 36nt reads with pile ups, reads at region and
+    chromosome boundaries, unmapped, gapped and clipped reads"""
+    recs = []
+    for _ in xrange(n):
+        tid = rnd.choice([0, 0, 1, 2])
+        r   = rnd.random()
+        if r < 0.3:
+            pos = rnd.randint(0, CHROMS[tid][1] // 5000) * 5000
+        elif r < 0.4:
+            pos = rnd.choice([0, binbam.REGIONSIZE, 2 * binbam.REGIONSIZE,
+                CHROMS[tid][1] - 36]) + rnd.randint(-100, 100)
+        else:
+            pos = rnd.randint(0, CHROMS[tid][1] - 36)
+        recs.append((tid, min(max(pos, 0), CHROMS[tid][1] - 36)))
+    recs.sort()
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": c, "LN": l} for c, l in CHROMS]}
+    out = pysam.Samfile(filename, "wb", header = header)
+    for i, (tid, pos) in enumerate(recs):
+        a = pysam.AlignedSegment()
+        a.query_name      = "r%d" % i
+        a.query_sequence  = "A" * 36
+        a.flag            = rnd.choice([0, 16, 0, 16, 4])
+        a.reference_id    = tid
+        a.reference_start = pos
+        a.mapping_quality = 30
+        a.cigarstring     = rnd.choice(["36M"] * 20 + ["20M2D16M", "10S26M"])
+        out.write(a)
+    out.close()
+
+def count_loop(bamfile, bins, binsize, fragsize, n_redundancy, by_strand):
+    """the original per-alignment loop on lists of bins"""
+    n_aln, n_rmred, n_igno = 0, 0, 0
+    shift = fragsize / 2
+    for _, alns in itertools.groupby(bamfile, lambda x: (x.tid, x.pos)):
+        all_alns = [x for x in alns if not x.is_unmapped]
+        n_aln   += len(all_alns)
+        plus     = [x for x in all_alns if not x.is_reverse][0:n_redundancy]
+        minus    = [x for x in all_alns if x.is_reverse][0:n_redundancy]
+        for aln in itertools.chain(plus, minus):
+            chrom = bamfile.getrname(aln.tid)
+            if chrom == "chrM":
+                n_igno += 1
+                continue
+            n_rmred += 1
+            if aln.alen != aln.rlen:
+                n_igno += 1
+                continue
+            if not aln.is_reverse:
+                bin_nr = (aln.pos + shift) // binsize
+            else:
+                bin_nr = (aln.aend - 1 - shift) // binsize
+            n_aln += 1
+            try:
+                if not by_strand:
+                    bins[chrom][bin_nr] += 1
+                else:
+                    bins[chrom][aln.is_reverse and 1 or 0][bin_nr] += 1
+            except IndexError:
+                pass
+    return n_aln, n_rmred, n_igno
+
+def as_lists(bins, by_strand):
+    return dict((c, by_strand and [s.dense().tolist() for s in b] or
+        b.dense().tolist()) for c, b in bins.items())
+
+class KernelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir   = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.tmpdir, "reads.bam")
+        make_bam(cls.filename, 20000, random.Random(1))
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+    def count(self, binsize, fragsize, by_strand):
+        bam  = pysam.Samfile(self.filename, "rb")
+        bins = binbam.make_bins(dict(CHROMS), binsize, by_strand, numpy.uint16)
+        n    = binbam.count_alignments(bam, bam.references, bins, binsize,
+                fragsize, 3, by_strand)
+        bam.close()
+        return n, bins
+    def test_same_as_loop(self):
+        for binsize, fragsize, by_strand in ((100, 200, True), (37, 0, False),
+                (1000, 150, True)):
+            bam   = pysam.Samfile(self.filename, "rb")
+            lists = dict((c, by_strand and [[0] * (l // binsize) for _ in "+-"]
+                or [0] * (l // binsize)) for c, l in CHROMS)
+            expected = count_loop(bam, lists, binsize, fragsize, 3, by_strand)
+            bam.close()
+            n, bins = self.count(binsize, fragsize, by_strand)
+            self.assertEqual(n, expected)
+            self.assertTrue(as_lists(bins, by_strand) == lists)
+    def test_small_blocks(self):
+        # (tid, pos) groups are carried over to the next block
+        n, bins = self.count(100, 200, True)
+        blocksize, binbam.BLOCKSIZE = binbam.BLOCKSIZE, 7
+        try:
+            m, small = self.count(100, 200, True)
+        finally:
+            binbam.BLOCKSIZE = blocksize
+        self.assertEqual(m, n)
+        self.assertTrue(as_lists(small, True) == as_lists(bins, True))
+    def test_parallel_same_as_serial(self):
+        filename = os.path.join(self.tmpdir, "indexed.bam")
+        shutil.copy(self.filename, filename)
+        pysam.index(filename)
+        for by_strand in (True, False):
+            bam = pysam.Samfile(filename, "rb")
+            serial, f1 = binbam.binbam(bam, 100, 200, dict(CHROMS), 3, by_strand)
+            bam.close()
+            parallel, f2 = binbam.binbam_parallel(filename, 100, 200, CHROMS, 3,
+                    by_strand, 3)
+            self.assertEqual(f1, f2)
+            self.assertTrue(as_lists(serial, by_strand) == as_lists(parallel, by_strand))
+    def test_cache_round_trip(self):
+        environ = os.environ.get("GOSR_CACHE_DIR")
+        os.environ["GOSR_CACHE_DIR"] = os.path.join(self.tmpdir, "cache")
+        try:
+            params = {"binsize": 100, "frag_size": 200, "n_redundancy": 3,
+                      "by_strand": True}
+            n, bins = self.count(100, 200, True)
+            entry   = binbam.cache_entry(self.filename, 100, 200, 3, True)
+            binbam.save_counts(entry, self.filename, bins, CHROMS, 1.5, params)
+            cached, factor = binbam.load_counts(entry, self.filename, CHROMS, params)
+            self.assertEqual(factor, 1.5)
+            self.assertTrue(as_lists(cached, True) == as_lists(bins, True))
+            # other counting parameters do not use the entry
+            self.assertEqual(binbam.load_counts(entry, self.filename, CHROMS,
+                dict(params, frag_size = 0)), None)
+        finally:
+            if environ is None:
+                del os.environ["GOSR_CACHE_DIR"]
+            else:
+                os.environ["GOSR_CACHE_DIR"] = environ
+
+class ChunkedBinsTest(unittest.TestCase):
+    def test_same_as_dense(self):
+        rnd   = numpy.random.RandomState(1)
+        dense = numpy.zeros(1000, dtype = numpy.int64)
+        bins  = ChunkedBins(1000, numpy.uint8, chunksize = 64)
+        for _ in xrange(50):
+            idx = numpy.unique(rnd.randint(0, 1000, rnd.randint(1, 30)))
+            val = rnd.randint(1, 200, len(idx))
+            bins.add(idx, val)
+            dense[idx] += val
+        start = 300
+        vals  = rnd.randint(0, 3, 200)
+        bins.set(start, vals)
+        dense[start:start + 200] = vals
+        # chunks that overflow uint8 are widened
+        self.assertTrue(dense.max() > 255)
+        numpy.testing.assert_array_equal(bins.dense(dtype = numpy.int64), dense)
+        numpy.testing.assert_array_equal(bins.dense(250, 700, numpy.int64),
+                dense[250:700])
+        idx, vals = bins.nonzero()
+        numpy.testing.assert_array_equal(idx, numpy.flatnonzero(dense))
+        numpy.testing.assert_array_equal(vals, dense[idx])
+        for factor in (1, 3, 64, 100):
+            n = 1000 // factor
+            numpy.testing.assert_array_equal(bins.aggregated(factor).dense(
+                dtype = numpy.int64), dense[:n * factor].reshape(n, factor).sum(axis = 1))
+    def test_unallocated(self):
+        bins = ChunkedBins(1000, numpy.int32, chunksize = 64)
+        bins.set(0, numpy.zeros(1000, dtype = numpy.int32))
+        self.assertEqual(bins.nbytes, 0)
+        self.assertEqual(len(bins.nonzero()[0]), 0)
+        self.assertEqual(bins.covered(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+tests for gosr.common.dsp and smoothing of chunked bins
+
+run with python -m unittest discover tests
+"""
+
+import unittest
+import numpy
+
+from gosr.common import dsp
+from gosr.common.bins import ChunkedBins
+
+class SavitzkyGolayBlocksTest(unittest.TestCase):
+    def test_same_as_whole_array(self):
+        y = numpy.random.RandomState(1).poisson(2, 5000).astype(numpy.float64)
+        for w in (5, 51, 151):
+            numpy.testing.assert_allclose(dsp.savitzky_golay_blocks(y, w, 2,
+                blocksize = 300), dsp.savitzky_golay_filter(y, w, 2), atol = 1e-9)
+    def test_shorter_than_half_window(self):
+        for n in (1, 2, 7, 25):
+            y = numpy.arange(n, dtype = numpy.float64) ** 2
+            r = dsp.savitzky_golay_blocks(y, 51, 2)
+            self.assertEqual(len(r), n)
+            self.assertTrue(numpy.isfinite(r).all())
+            # the padded signal of a constant is constant
+            numpy.testing.assert_allclose(dsp.savitzky_golay_blocks(
+                numpy.repeat(3.0, n), 51, 2), numpy.repeat(3.0, n))
+    def test_padding(self):
+        y = numpy.array([1.0, 4.0, 2.0, 8.0])
+        p = dsp._padded(y, 6)
+        self.assertEqual(len(p), 16)
+        numpy.testing.assert_array_equal(p[6:10], y)
+        # padding longer signals is the padding of savitzky_golay_filter
+        y = numpy.arange(10, dtype = numpy.float64) % 3
+        numpy.testing.assert_array_equal(dsp._padded(y, 4)[:4],
+                y[0] - numpy.abs(y[1:5][::-1] - y[0]))
+
+class SmoothShortContigTest(unittest.TestCase):
+    def test_contig_shorter_than_half_window(self):
+        # 15 bins (a 1500 bp contig at 100 bp) smoothed with a 51 bin window
+        bins = ChunkedBins(15, numpy.int32)
+        bins.set(0, numpy.arange(15, dtype = numpy.int32) % 4)
+        sg  = lambda y: dsp.savitzky_golay_blocks(y, 51, 2, out = y)
+        res = bins.filtered(sg, 25, numpy.float32).dense(0, 15, numpy.float64)
+        numpy.testing.assert_allclose(res, dsp.savitzky_golay_blocks(
+            bins.dense(0, 15, numpy.float64), 51, 2), rtol = 1e-6)
+
+class FilteredBlocksTest(unittest.TestCase):
+    def test_same_as_whole_array(self):
+        # two covered ranges, one at the end of the chromosome
+        y    = numpy.zeros(5000, dtype = numpy.int32)
+        y[100:1900] = numpy.random.RandomState(2).poisson(3, 1800)
+        y[4200:]    = numpy.random.RandomState(3).poisson(3, 800)
+        bins = ChunkedBins(len(y), numpy.int32, chunksize = 100)
+        bins.set(0, y)
+        for w in (5, 51, 151):
+            sg  = lambda v: dsp.savitzky_golay_blocks(v, w, 2, out = v)
+            res = bins.filtered(sg, w // 2, blocksize = 250).dense()
+            numpy.testing.assert_allclose(res, dsp.savitzky_golay_filter(
+                y.astype(numpy.float64), w, 2), atol = 1e-9)
+
+if __name__ == "__main__":
+    unittest.main()
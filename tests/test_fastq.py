@@ -0,0 +1,120 @@
+"""
+tests for the block based fasta/fastq reader of gosr.common.fastq
+
+run with python -m unittest discover tests
+"""
+
+import io
+import random
+import unittest
+
+from gosr.common import fastq
+
+def read_all(text, blocksize = fastq.BLOCKSIZE):
+    return list(fastq.read(io.BytesIO(text), blocksize))
+
+def readfq(fp): # the original line based reader
+    last = None
+    while True:
+        if not last:
+            for l in fp:
+                if l[0] in ">@":
+                    last = l[:-1]
+                    break
+        if not last: break
+        name, seqs, last = last[1:].split()[0], [], None
+        for l in fp:
+            if l[0] in "@+>":
+                last = l[:-1]
+                break
+            seqs.append(l[:-1])
+        if not last or last[0] != "+":
+            yield name, "".join(seqs), None
+            if not last: break
+        else:
+            seq, leng, seqs = "".join(seqs), 0, []
+            for l in fp:
+                seqs.append(l[:-1])
+                leng += len(l) - 1
+                if leng >= len(seq):
+                    last = None
+                    yield name, seq, "".join(seqs)
+                    break
+            if last:
+                yield name, seq, None
+                break
+
+def random_text(rnd):
+    """random mix of 4-line and multi-line fastq, fasta and junk lines,
+    possibly cut short"""
+    recs = []
+    for _ in xrange(rnd.randint(0, 30)):
+        r    = rnd.random()
+        name = rnd.choice(["r1", "r 2 x", " r3", "\tq", "a\tb"])
+        seq  = "".join(rnd.choice("ACGT") for _ in xrange(rnd.randint(0, 12)))
+        if r < 0.5:
+            recs.append("@%s\n%s\n+\n%s\n" % (name, seq, "I" * len(seq)))
+        elif r < 0.7:
+            recs.append(">%s\n%s\n%s\n" % (name, seq, seq[:3]))
+        elif r < 0.85:
+            recs.append("@%s\n%s\n%s\n+x\n%s\n%s\n" % (name, seq, seq[:2],
+                "I" * len(seq), "II"))
+        else:
+            recs.append("".join(rnd.choice("ACGT@+>x\n")
+                for _ in xrange(rnd.randint(0, 6))) + "\n")
+    text = "".join(recs)
+    if rnd.random() < 0.3:
+        text = text[:rnd.randint(0, len(text))]
+    return text
+
+class SameAsLineReaderTest(unittest.TestCase):
+    def test_random_input(self):
+        rnd = random.Random(1)
+        for _ in xrange(3000):
+            text = random_text(rnd)
+            # the original reader needs a final newline
+            try:
+                expected = list(readfq(io.BytesIO(text.endswith("\n") and
+                    text or text and text + "\n")))
+            except IndexError:
+                continue # a header without name
+            bs = rnd.choice([1, 2, 3, 7, 16, 64, 1000, fastq.BLOCKSIZE])
+            self.assertEqual(read_all(text, bs), expected, (text, bs))
+
+class BatchesTest(unittest.TestCase):
+    def test_fasta_runs(self):
+        # runs of fasta records are lists; batches must not restart them
+        text = "".join(">r%d\nACGT\n" % i for i in xrange(10))
+        for n in (1, 3, 20):
+            batches = list(fastq.read_batches(io.BytesIO(text), n))
+            self.assertEqual([r[0] for b in batches for r in b],
+                    ["r%d" % i for i in xrange(10)])
+    def test_same_as_records(self):
+        rnd = random.Random(2)
+        for _ in xrange(500):
+            text = random_text(rnd)
+            recs = read_all(text)
+            for n in (1, 3, 100):
+                batches = list(fastq.read_batches(io.BytesIO(text), n,
+                    rnd.choice([1, 5, 64, fastq.BLOCKSIZE])))
+                self.assertTrue(all(len(b) == n for b in batches[:-1]))
+                self.assertEqual([tuple(r) for b in batches for r in b], recs)
+
+class TruncatedHeaderTest(unittest.TestCase):
+    def test_bare_header_at_end(self):
+        # e.g. a truncated download; reading stops after the last record
+        for text in ("@r\nACGT\n+\nIIII\n@", "@r\nACGT\n+\nIIII\n@\n",
+                "@r\nAC\n+\nII\n>", ">a\nAC\n>", ">a\nAC\n@"):
+            for bs in (1, 3, 8, fastq.BLOCKSIZE):
+                self.assertEqual([r[0] for r in read_all(text, bs)],
+                        [text[1]], (text, bs))
+    def test_only_header(self):
+        for text in ("@", ">", "@\n", "> \n"):
+            self.assertEqual(read_all(text), [])
+    def test_empty_name(self):
+        self.assertEqual(read_all("@\nACGT\n+\nIIII\n"), [("", "ACGT", "IIII")])
+        self.assertEqual(read_all(">\nACGT\n>b\nA"), [("", "ACGT", None),
+            ("b", "A", None)])
+
+if __name__ == "__main__":
+    unittest.main()
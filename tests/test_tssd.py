@@ -0,0 +1,151 @@
+"""
+tests for the TSS window index and the block based and parallel tssd
+density against per-read lookups
+
+run with python -m unittest discover tests
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy
+import pysam
+
+from gosr.common.intervals import TssIndex
+from gosr.tools import tssd
+
+CHROMS   = [("chr1", 300000), ("chr2", 200000), ("chr3", 50000)]
+UP, DOWN = 500, 300
+
+def random_tsss(rnd, n):
+    return [(c, rnd.randint(0, l), rnd.choice("+-"))
+            for c, l in (rnd.choice(CHROMS[:2]) for _ in xrange(n))]
+
+def make_bam(filename, n, rnd):
+    """n sorted random reads of varying length, some gapped or unmapped"""
+    recs = sorted((t, rnd.randint(0, CHROMS[t][1] - 40))
+            for t in (rnd.randint(0, len(CHROMS) - 1) for _ in xrange(n)))
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": c, "LN": l} for c, l in CHROMS]}
+    out = pysam.Samfile(filename, "wb", header = header)
+    for i, (tid, pos) in enumerate(recs):
+        cigar, length = rnd.choice([("36M", 36), ("36M", 36), ("30M", 30),
+            ("20M2D16M", 36)])
+        a = pysam.AlignedSegment()
+        a.query_name      = "r%d" % i
+        a.query_sequence  = "A" * length
+        a.flag            = rnd.choice([0, 16, 0, 16, 4])
+        a.reference_id    = tid
+        a.reference_start = pos
+        a.mapping_quality = 30
+        a.cigarstring     = cigar
+        out.write(a)
+    out.close()
+
+def density_loop(tsspos, bamfile, up, down):
+    """per-read lookups with TssIndex.find"""
+    d    = {"left": numpy.zeros(up + down + 1, dtype = "i"),
+            "right": numpy.zeros(up + down + 1, dtype = "i")}
+    side = {"+": {"+": "left", "-": "right"}, "-": {"+": "right", "-": "left"}}
+    n_reads = 0
+    for aln in bamfile:
+        if aln.is_unmapped:
+            continue
+        n_reads += 1
+        five     = aln.aend - 1 if aln.is_reverse else aln.pos
+        tss      = tsspos.find(bamfile.getrname(aln.tid), five)
+        if tss is not None:
+            start, end, strand, _ = tss
+            anchor = start if strand == "+" else end - 1
+            d[side[strand][aln.is_reverse and "-" or "+"]][abs(five - anchor)] += 1
+    return d, n_reads
+
+class TssIndexTest(unittest.TestCase):
+    def test_windows(self):
+        tsss  = random_tsss(random.Random(1), 400)
+        index = TssIndex.build(tsss, UP, DOWN)
+        # a window is used if it does not overlap any window used before it
+        used  = {}
+        for chrom, pos, strand in tsss:
+            start = pos - UP if strand == "+" else pos - DOWN
+            end   = start + UP + DOWN + 1
+            if all(e <= start or s >= end for s, e, _, _ in used.get(chrom, [])):
+                used.setdefault(chrom, []).append((start, end, strand, pos))
+        self.assertEqual(index.n_tss, len(tsss))
+        self.assertEqual(len(index), sum(len(w) for w in used.values()))
+        for chrom, windows in used.items():
+            windows.sort()
+            for i, (s, e, strand, pos) in enumerate(windows):
+                self.assertEqual(index.find(chrom, s), (s, e, strand, pos))
+                self.assertEqual(index.find(chrom, e - 1), (s, e, strand, pos))
+            # every position against a linear search
+            pos  = numpy.arange(-1000, dict(CHROMS)[chrom] + 1000)
+            hits = numpy.repeat(-1, len(pos))
+            for i, (s, e, _, _) in enumerate(windows):
+                hits[(pos >= s) & (pos < e)] = i
+            numpy.testing.assert_array_equal(index.lookup(chrom, pos), hits)
+        self.assertEqual(index.find("chr3", 100), None)
+        self.assertTrue((index.lookup("chr3", numpy.arange(10)) == -1).all())
+    def test_write_read(self):
+        index  = TssIndex.build(random_tsss(random.Random(2), 100), UP, DOWN)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "index.npz")
+            with open(path, "wb") as fh:
+                index.write(fh)
+            copy = TssIndex.read(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(copy.n_tss, index.n_tss)
+        self.assertEqual(sorted(copy.chroms), sorted(index.chroms))
+        for chrom in index.chroms:
+            for a, b in zip(copy.chroms[chrom], index.chroms[chrom]):
+                numpy.testing.assert_array_equal(a, b)
+
+class DensityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir   = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.tmpdir, "reads.bam")
+        cls.tsspos   = TssIndex.build(random_tsss(random.Random(3), 300), UP, DOWN)
+        # enough reads for many bgzf blocks to split
+        make_bam(cls.filename, 30000, random.Random(4))
+        bam = pysam.Samfile(cls.filename, "rb")
+        cls.expected = density_loop(cls.tsspos, bam, UP, DOWN)
+        bam.close()
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+    def assertSameDensity(self, result):
+        (d, n), (e, m) = result, self.expected
+        self.assertEqual(n, m)
+        for side in ("left", "right"):
+            numpy.testing.assert_array_equal(d[side], e[side])
+    def test_blocks_same_as_loop(self):
+        self.assertTrue(self.expected[0]["left"].sum() > 0)
+        blocksize, tssd.BLOCKSIZE = tssd.BLOCKSIZE, 1000
+        try:
+            bam = pysam.Samfile(self.filename, "rb")
+            self.assertSameDensity(tssd.make_density(self.tsspos, bam, UP, DOWN))
+            bam.close()
+        finally:
+            tssd.BLOCKSIZE = blocksize
+    def test_ranges_same_as_loop(self):
+        # unindexed: ranges of bgzf blocks
+        bam   = pysam.Samfile(self.filename, "rb")
+        first = bam.tell()
+        bam.close()
+        self.assertTrue(len(tssd.bamsplit.split(self.filename, 12, first)) > 5)
+        self.assertSameDensity(tssd.density_parallel(self.filename, self.tsspos,
+            UP, DOWN, 3))
+    def test_chromosomes_same_as_loop(self):
+        filename = os.path.join(self.tmpdir, "indexed.bam")
+        shutil.copy(self.filename, filename)
+        pysam.index(filename)
+        self.assertSameDensity(tssd.density_parallel(filename, self.tsspos,
+            UP, DOWN, 3))
+
+if __name__ == "__main__":
+    unittest.main()